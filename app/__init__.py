@@ -1,15 +1,19 @@
-
 from importlib.metadata import PackageNotFoundError
 
-try:
-    import importlib.metadata
 
-    __version__ = importlib.metadata.version(__package__ or __name__)
-    del importlib
-except PackageNotFoundError:
-    import toml
-    from pathlib import Path
+def __getattr__(name: str):
+    # Looked up on first use, so importing the app doesn't read package metadata or pyproject.toml
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        import importlib.metadata
+
+        version = importlib.metadata.version(__package__ or __name__)
+    except PackageNotFoundError:
+        import tomllib
+        from pathlib import Path
 
-    path = Path(__file__).parent.parent / "pyproject.toml"
-    __version__ = toml.load(path)["tool"]["poetry"]["version"]
-    del toml, Path, path
+        with open(Path(__file__).parent.parent / "pyproject.toml", "rb") as f:
+            version = tomllib.load(f)["tool"]["poetry"]["version"]
+    globals()["__version__"] = version
+    return version
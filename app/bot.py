@@ -1,28 +1,267 @@
+import asyncio
+import signal
+import time
+from typing import Optional
+
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiohttp import web
 from calmlib.utils import setup_logger, heartbeat_for_sync
 from dotenv import load_dotenv
 from loguru import logger
 from pathlib import Path
 
-from botspot.core.bot_manager import BotManager
-
 # Load environment variables
 load_dotenv(Path(__file__).parent.parent / ".env")
 
 from .routers.settings import router as settings_router
 from .router import app, router as main_router
+from .services.cache import PersonCache
+from .services.candidate_pool import CandidatePools
+from .services.database import DatabaseService
+from .services.storage import Storage
+from .services.delivery import DeliveryService
+from .services.leader import LeaderLease
+from .services.matching import MatchingService
+from .services.metrics import MetricsMiddleware, MongoCommandListener, WorkerMetrics, metrics, report_metrics
+from .services.response_cache import ResponseCache
+from .services.supervisor import UpdateSupervisor
+from .services.throttling import ThrottlingMiddleware
+from .services.update_queue import UpdateIngressMiddleware, UpdateWorker
+from .web import BoundedRequestHandler, create_web_app, start_web_server
 
 # Initialize bot and dispatcher
 dp = Dispatcher()
 dp.include_router(main_router)
 dp.include_router(settings_router)
+# Knows the updates being handled, to let them finish on shutdown
+update_supervisor = UpdateSupervisor()
+dp.update.outer_middleware(update_supervisor)
+# Outer to the rest, so the time spent in the other middlewares is counted too
+dp.update.outer_middleware(MetricsMiddleware())
+# Duplicate and throttled updates are dropped before any handler (or database call) runs
+dp.update.outer_middleware(ThrottlingMiddleware(
+    user_rate=app.config.throttle_user_rate,
+    user_burst=app.config.throttle_user_burst,
+    chat_rate=app.config.throttle_chat_rate,
+    chat_burst=app.config.throttle_chat_burst,
+    coalesce_window=app.config.list_coalesce_window,
+))
 
+background_tasks = set()
+services = {}
 
-@heartbeat_for_sync(app.name)
-def main(debug=False) -> None:
-    setup_logger(logger, level="DEBUG" if debug else "INFO")
+
+def create_db_service() -> Storage:
+    config = app.config
+    cache = None
+    if config.person_cache_enabled:
+        cache = PersonCache(ttl=config.person_cache_ttl, max_size=config.person_cache_max_size)
+
+    if config.database_backend == "sqlite":
+        # aiosqlite is only needed (and imported) with this backend
+        from .services.sqlite_database import SQLiteDatabaseService
+
+        return SQLiteDatabaseService(
+            config.sqlite_path, cache=cache, roster_scope=config.roster_scope, max_rosters=config.max_rosters
+        )
+
+    client_options = {
+        "maxPoolSize": config.mongo_max_pool_size,
+        "minPoolSize": config.mongo_min_pool_size,
+        "connectTimeoutMS": config.mongo_connect_timeout_ms,
+        "serverSelectionTimeoutMS": config.mongo_server_selection_timeout_ms,
+        "readPreference": config.mongo_read_preference,
+        "w": int(config.mongo_write_concern) if config.mongo_write_concern.isdigit() else config.mongo_write_concern,
+        "event_listeners": [MongoCommandListener()],
+    }
+    if config.mongo_max_idle_time_ms is not None:
+        client_options["maxIdleTimeMS"] = config.mongo_max_idle_time_ms
+    if config.mongo_socket_timeout_ms is not None:
+        client_options["socketTimeoutMS"] = config.mongo_socket_timeout_ms
+
+    return DatabaseService(
+        config.mongo_conn_str.get_secret_value(),
+        config.mongo_database,
+        cache=cache,
+        roster_scope=config.roster_scope,
+        max_rosters=config.max_rosters,
+        **client_options,
+    )
+
+
+async def receive_updates(bot: Bot, dispatcher: Dispatcher, webhook: bool) -> None:
+    """Point Telegram at the webhook or clear it for polling, for the updates dp handles"""
+    if webhook:
+        await bot.set_webhook(
+            app.config.webhook_url.rstrip("/") + app.config.webhook_path,
+            secret_token=app.config.webhook_secret.get_secret_value() if app.config.webhook_secret else None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        # getUpdates doesn't work while a webhook is set
+        await bot.delete_webhook()
+        # The webhook runtime serves /health itself, with polling it runs next to the loop
+        services["web"] = await start_web_server(
+            create_web_app(dispatcher), app.config.web_server_host, app.config.web_server_port
+        )
+
+
+@dp.startup()
+async def on_startup(bot: Bot, debug: bool = False, webhook: bool = False, worker: Optional[int] = None) -> None:
+    # Services are created here, inside the running event loop, and reach the handlers
+    # through the dispatcher workflow data
+    db_service = create_db_service()
+    dp["db_service"] = db_service
+    matching_service = MatchingService(db_service)
+    dp["matching_service"] = matching_service
+    dp["response_cache"] = ResponseCache(app.config.response_cache_size)
+    dp["candidate_pools"] = CandidatePools(app.config.random_pool_size)
+
+    # Create and verify indexes before the first update is handled
+    if app.config.mongo_warm_up:
+        await db_service.warm_up(app.config.mongo_min_pool_size)
+    else:
+        await db_service.initialize()
+    if debug:
+        await db_service.explain_tag_queries()
+
+    # Workers get their updates from the queue, the ingress process receives them
+    if worker is None:
+        await receive_updates(bot, dp, webhook)
+
+    # Per-chat rosters warm their own caches and search indexes on first use
+    if db_service.roster_scope == "global":
+        if db_service.cache is not None:
+            await db_service.warm_cache()
+            if app.config.person_cache_watch_changes:
+                task = asyncio.create_task(db_service.watch_changes())
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+        # Built before the first update, from the warm cache if there is one
+        await db_service.get_search_index()
+
+    # Deliveries and scheduled rounds run once per deployment - in the first worker of the
+    # instance holding the scheduler lease, the other replicas take over if it goes away
+    if worker:
+        return
+
+    async def on_acquired() -> None:
+        start_scheduled_jobs(bot, db_service, matching_service)
+
+    async def on_lost() -> None:
+        await stop_scheduled_jobs(app.config.shutdown_timeout)
+
+    leader = LeaderLease(
+        db_service, "scheduler", on_acquired, on_lost, seconds=app.config.scheduler_lease_seconds
+    )
+    services["leader"] = leader
+    # Startup fails on a bad schedule if this instance takes the lease right away
+    await leader.renew()
+    leader.start()
+
+
+def start_scheduled_jobs(bot: Bot, db_service: Storage, matching_service: MatchingService) -> None:
+    # Sends whatever round notifications were left pending before a restart
+    delivery_service = DeliveryService(
+        bot, db_service, rate=app.config.delivery_rate, workers=app.config.delivery_workers
+    )
+    delivery_service.start()
+    services["delivery"] = delivery_service
+
+    if app.config.coffee_round_schedules:
+        # APScheduler is only imported when there's something to schedule
+        from .services.rounds import RoundScheduler
+
+        round_scheduler = RoundScheduler(matching_service, delivery_service, app.config.coffee_round_timezone)
+        for schedule in app.config.coffee_round_schedules:
+            round_scheduler.add_schedule(schedule.cron, schedule.tags, schedule.chat_id)
+        round_scheduler.start()
+        services["rounds"] = round_scheduler
+
+
+async def stop_scheduled_jobs(timeout: float) -> None:
+    if "rounds" in services:
+        services.pop("rounds").shutdown()
+    if "delivery" in services:
+        await services.pop("delivery").stop(timeout)
+
+
+@dp.shutdown()
+async def on_shutdown(bot: Bot, webhook: bool = False, worker: Optional[int] = None) -> None:
+    # The updates taken share one deadline with the notifications being sent
+    deadline = time.monotonic() + app.config.shutdown_timeout
+    await update_supervisor.drain(app.config.shutdown_timeout)
+    if not webhook and worker is None:
+        await update_supervisor.confirm(bot)
+    leader = services.pop("leader", None)
+    if leader is not None:
+        await leader.stop()
+    await stop_scheduled_jobs(max(deadline - time.monotonic(), 0))
+    if leader is not None:
+        # Only once nothing is being sent, the next holder may send it again otherwise
+        await leader.release()
+    for task in list(background_tasks):
+        task.cancel()
+    if "web" in services:
+        await services.pop("web").cleanup()
+    if "candidate_pools" in dp.workflow_data:
+        await dp.workflow_data.pop("candidate_pools").close()
+    if "db_service" in dp.workflow_data:
+        await dp.workflow_data.pop("db_service").close()
+        dp.workflow_data.pop("matching_service", None)
+        dp.workflow_data.pop("response_cache", None)
+    # Metrics live in memory, their last summary goes to the log
+    logger.info("Metrics at shutdown:\n" + "\n".join(metrics.summary()))
+
+
+# The ingress process of the worker mode: receives updates and queues them for the workers
+ingress_dp = Dispatcher()
+ingress_supervisor = UpdateSupervisor()
+ingress_dp.update.outer_middleware(ingress_supervisor)
+ingress_dp.update.outer_middleware(UpdateIngressMiddleware())
+
+
+@ingress_dp.startup()
+async def on_ingress_startup(bot: Bot, webhook: bool = False) -> None:
+    db_service = create_db_service()
+    ingress_dp["db_service"] = db_service
+    await db_service.initialize()
+    await receive_updates(bot, ingress_dp, webhook)
+
+
+@ingress_dp.shutdown()
+async def on_ingress_shutdown(bot: Bot, webhook: bool = False) -> None:
+    # Updates being queued are confirmed only once they are
+    await ingress_supervisor.drain(app.config.shutdown_timeout)
+    if not webhook:
+        await ingress_supervisor.confirm(bot)
+    if "web" in services:
+        await services.pop("web").cleanup()
+    if "db_service" in ingress_dp.workflow_data:
+        await ingress_dp.workflow_data.pop("db_service").close()
+
+
+def run_webhook(bot: Bot, debug: bool = False, dispatcher: Dispatcher = dp) -> None:
+    from aiogram.webhook.aiohttp_server import setup_application
+
+    web_app = create_web_app(dispatcher)
+    BoundedRequestHandler(
+        dispatcher,
+        bot,
+        max_concurrent=app.config.webhook_max_concurrent_updates,
+        drain_timeout=app.config.shutdown_timeout,
+        secret_token=app.config.webhook_secret.get_secret_value() if app.config.webhook_secret else None,
+    ).register(web_app, path=app.config.webhook_path)
+    # Runs the dispatcher startup/shutdown hooks with the web app
+    setup_application(web_app, dispatcher, bot=bot, debug=debug, webhook=True)
+    web.run_app(web_app, host=app.config.web_server_host, port=app.config.web_server_port)
+
+
+def create_bot() -> Bot:
+    # The component manager, and whatever its components import, is only loaded once the bot is started
+    from botspot.core.bot_manager import BotManager
 
     # Initialize Bot instance with a default parse mode
     bot = Bot(
@@ -40,9 +279,90 @@ def main(debug=False) -> None:
 
     # Setup dispatcher with our components
     bm.setup_dispatcher(dp)
+    return bot
+
+
+async def serve_worker(bot: Bot, worker: int, workers: int, metrics_queue, debug: bool) -> None:
+    await dp.emit_startup(bot=bot, debug=debug, worker=worker)
+    # The ingress serves /metrics for the workers too
+    reporter = asyncio.create_task(report_metrics(metrics_queue, worker))
+    update_worker = UpdateWorker(
+        dp,
+        bot,
+        dp["db_service"],
+        worker,
+        workers,
+        max_concurrent=app.config.update_worker_concurrency,
+        lease_seconds=app.config.update_lease_seconds,
+        drain_timeout=app.config.shutdown_timeout,
+    )
+    # Stops taking updates and lets the taken ones finish, instead of dying mid-update
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, update_worker.stop)
+    try:
+        await update_worker.run()
+    finally:
+        await dp.emit_shutdown(bot=bot, worker=worker)
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        await bot.session.close()
+
+
+def run_worker(worker: int, workers: int, metrics_queue, debug: bool = False) -> None:
+    """Entry point of a worker process"""
+    setup_logger(logger, level="DEBUG" if debug else "INFO")
+    asyncio.run(serve_worker(create_bot(), worker, workers, metrics_queue, debug))
+
+
+@heartbeat_for_sync(app.name)
+def main(debug=False, webhook: Optional[bool] = None, workers: Optional[int] = None) -> None:
+    setup_logger(logger, level="DEBUG" if debug else "INFO")
+    bot = create_bot()
+
+    if webhook is None:
+        webhook = bool(app.config.webhook_url)
+    if webhook and not app.config.webhook_url:
+        raise ValueError("WEBHOOK_URL is required in webhook mode")
+    if workers is None:
+        workers = app.config.update_workers
+
+    if workers:
+        import multiprocessing
 
-    # Start polling
-    dp.run_polling(bot)
+        # One process receives the updates, the workers handle them - each a share of the chats
+        context = multiprocessing.get_context("spawn")
+        worker_metrics = WorkerMetrics(context.Queue())
+        worker_metrics.start()
+        ingress_dp["worker_metrics"] = worker_metrics
+        processes = [
+            context.Process(target=run_worker, args=(i, workers, worker_metrics.queue, debug), daemon=True)
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            if webhook:
+                run_webhook(bot, debug=debug, dispatcher=ingress_dp)
+            else:
+                ingress_dp.run_polling(
+                    bot,
+                    allowed_updates=dp.resolve_used_update_types(),
+                    tasks_concurrency_limit=app.config.polling_max_concurrent_updates,
+                    webhook=False,
+                )
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+    elif webhook:
+        run_webhook(bot, debug=debug)
+    else:
+        # Start polling
+        # The next update is taken only once fewer than the limit are being handled
+        dp.run_polling(
+            bot, tasks_concurrency_limit=app.config.polling_max_concurrent_updates, debug=debug, webhook=False
+        )
 
 
 if __name__ == "__main__":
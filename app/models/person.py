@@ -31,4 +31,85 @@ class Person(BaseModel):
     id: Optional[PyObjectId] = Field(default=None, alias="_id")
     username: str
     tags: List[str] = Field(default_factory=list)
-    created_at: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    # Telegram user id, known once the person has started the bot - needed to message them
+    user_id: Optional[int] = None
+    # Fair selection: weight is priority * time since last picked, 0 never gets picked
+    priority: float = Field(default=1.0, ge=0)
+    last_picked_at: Optional[datetime] = None
+
+
+class PersonRecord:
+    """Read-only view of a stored person, built without validation
+
+    Documents in the persons collection are written through Person, so validating them
+    again on every read only costs CPU - a lot of it on big listings. This plain
+    __slots__ object is ~3x cheaper to build and has the same attributes as Person.
+    """
+
+    __slots__ = ("id", "username", "tags", "created_at", "user_id", "priority", "last_picked_at")
+
+    def __init__(
+        self,
+        id: Optional[str],
+        username: str,
+        tags: List[str],
+        created_at: Optional[datetime] = None,
+        user_id: Optional[int] = None,
+        priority: float = 1.0,
+        last_picked_at: Optional[datetime] = None,
+    ):
+        self.id = id
+        self.username = username
+        self.tags = tags
+        self.created_at = created_at
+        self.user_id = user_id
+        self.priority = priority
+        self.last_picked_at = last_picked_at
+
+    @classmethod
+    def from_db(cls, person_dict: dict) -> "PersonRecord":
+        """Fields left out by a projection are None (tags: empty)"""
+        person_id = person_dict.get("_id")
+        return cls(
+            str(person_id) if person_id is not None else None,
+            person_dict["username"],
+            person_dict.get("tags") or [],
+            person_dict.get("created_at"),
+            person_dict.get("user_id"),
+            person_dict.get("priority", 1.0),
+            person_dict.get("last_picked_at"),
+        )
+
+    @classmethod
+    def from_person(cls, person: Person) -> "PersonRecord":
+        return cls(
+            person.id,
+            person.username,
+            list(person.tags),
+            person.created_at,
+            person.user_id,
+            person.priority,
+            person.last_picked_at,
+        )
+
+    def to_person(self) -> Person:
+        fields = {
+            "username": self.username,
+            "tags": self.tags,
+            "user_id": self.user_id,
+            "priority": self.priority,
+            "last_picked_at": self.last_picked_at,
+        }
+        if self.created_at is not None:
+            fields["created_at"] = self.created_at
+        return Person(_id=self.id, **fields)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PersonRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"PersonRecord({fields})"
@@ -1,4 +1,4 @@
-from aiogram import Router
+from aiogram import Router, html
 from aiogram.filters import Command
 from aiogram.types import Message
 
@@ -6,6 +6,8 @@ from botspot.user_interactions import ask_user, ask_user_choice
 from botspot.commands_menu import add_command
 from botspot.utils import reply_safe
 
+from ..services.metrics import metrics
+
 router = Router()
 
 TIMEZONE_SETUP_METHODS = [
@@ -62,3 +64,10 @@ async def timezone_setup(message: Message, state) -> None:
 async def error_test(message: Message) -> None:
     """Demonstrate error handling"""
     raise ValueError("This is a test error!")
+
+
+@add_command("stats", "Show latency and error stats", visibility="hidden")
+@router.message(Command("stats"))
+async def stats(message: Message) -> None:
+    """Summary of the metrics served on /metrics"""
+    await reply_safe(message, "<pre>" + html.quote("\n".join(metrics.summary())) + "</pre>")
@@ -0,0 +1,180 @@
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from ..models.person import PersonRecord
+from .fair_sampler import FairSampler, fair_picked_at
+
+
+class PersonCache:
+    """In-memory copy of the persons collection with a tag -> usernames inverted index
+
+    The cache is all-or-nothing: tag queries are only answered from it while it holds the
+    whole roster. It goes cold when its TTL runs out (and gets reloaded by the owner) or
+    when the roster grows past max_size (then reads fall back to the database).
+    """
+
+    def __init__(self, ttl: float = 300, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._persons: Dict[str, PersonRecord] = {}
+        self._usernames_by_id: Dict[str, str] = {}
+        self._tag_index: Dict[str, Set[str]] = defaultdict(set)
+        # Built on the first fair draw, then kept up to date by the writes
+        self._sampler: Optional[FairSampler] = None
+        self._loaded_at: Optional[float] = None
+        self._attempted_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._persons)
+
+    @property
+    def is_warm(self) -> bool:
+        if self._loaded_at is None:
+            return False
+        return time.monotonic() - self._loaded_at < self.ttl
+
+    @property
+    def should_reload(self) -> bool:
+        """Cold and not retried within the last TTL (an oversized roster is not rescanned on every read)"""
+        if self.is_warm:
+            return False
+        return self._attempted_at is None or time.monotonic() - self._attempted_at >= self.ttl
+
+    def load(self, persons: Iterable[PersonRecord]) -> bool:
+        """Replace the cache contents, returns False if the roster doesn't fit"""
+        self.invalidate()
+        for person in persons:
+            if len(self._persons) >= self.max_size:
+                self.invalidate()
+                self._attempted_at = time.monotonic()
+                return False
+            self._put(person)
+        self._loaded_at = self._attempted_at = time.monotonic()
+        return True
+
+    def invalidate(self) -> None:
+        """Drop the contents, the owner reloads them on the next read"""
+        self._attempted_at = None
+        self._persons.clear()
+        self._usernames_by_id.clear()
+        self._tag_index.clear()
+        self._sampler = None
+        self._loaded_at = None
+
+    # region write-through
+
+    def upsert(self, person: PersonRecord) -> None:
+        if not self.is_warm:
+            return
+        if person.username not in self._persons and len(self._persons) >= self.max_size:
+            self.invalidate()
+            return
+        self.remove(person.username)
+        self._put(person)
+
+    def add_tags(self, username: str, tags: List[str]) -> None:
+        person = self._persons.get(username)
+        if person is None:
+            return
+        new_tags = [sys.intern(tag) for tag in dict.fromkeys(tags) if tag not in person.tags]
+        person.tags = person.tags + new_tags
+        for tag in new_tags:
+            self._tag_index[tag].add(username)
+
+    def remove(self, username: str) -> None:
+        person = self._persons.pop(username, None)
+        if person is None:
+            return
+        self._usernames_by_id.pop(person.id, None)
+        if self._sampler is not None:
+            self._sampler.remove(username)
+        for tag in person.tags:
+            members = self._tag_index.get(tag)
+            if members is not None:
+                members.discard(username)
+                if not members:
+                    del self._tag_index[tag]
+
+    def remove_by_id(self, person_id: str) -> None:
+        username = self._usernames_by_id.get(person_id)
+        if username is not None:
+            self.remove(username)
+
+    def _put(self, person: PersonRecord) -> None:
+        # Every person shares one copy of each tag string with the index
+        person.tags = [sys.intern(tag) for tag in person.tags]
+        self._persons[person.username] = person
+        if person.id is not None:
+            self._usernames_by_id[person.id] = person.username
+        for tag in person.tags:
+            self._tag_index[tag].add(person.username)
+        if self._sampler is not None:
+            self._add_to_sampler(person)
+
+    def _add_to_sampler(self, person: PersonRecord) -> None:
+        self._sampler.set(person.username, person.priority, fair_picked_at(person))
+
+    # endregion write-through
+
+    # region reads
+
+    def get_person(self, username: str) -> Optional[PersonRecord]:
+        return self._persons.get(username)
+
+    def get_all_persons(self) -> List[PersonRecord]:
+        return list(self._persons.values())
+
+    def match_any(self, tags: List[str]) -> Set[str]:
+        """Usernames having at least one of the tags - the $in query"""
+        return set().union(*(self._tag_index.get(tag, ()) for tag in tags))
+
+    def match_all(self, tags: List[str]) -> Set[str]:
+        """Usernames having all of the tags - the $all query"""
+        # Intersect starting from the rarest tag so the working set only shrinks
+        member_sets = sorted((self._tag_index.get(tag, set()) for tag in set(tags)), key=len)
+        if not member_sets:
+            return set()
+        return member_sets[0].intersection(*member_sets[1:])
+
+    def get_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]:
+        candidates = self.match_any(tags) if tags else self._persons.keys()
+        if exclude:
+            candidates = candidates - set(exclude)
+        candidates = list(candidates)
+        if not candidates:
+            return None
+        return self._persons[random.choice(candidates)]
+
+    def sample_persons(self, tags: Optional[List[str]] = None, size: int = 20) -> List[PersonRecord]:
+        candidates = list(self.match_any(tags) if tags else self._persons)
+        return [self._persons[username] for username in random.sample(candidates, min(size, len(candidates)))]
+
+    def get_all_persons_by_tags(self, tags: List[str]) -> List[PersonRecord]:
+        return [self._persons[username] for username in self.match_all(tags)]
+
+    def get_fair_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None, now: Optional[datetime] = None
+    ) -> Optional[PersonRecord]:
+        """Random person weighted by priority * time since they were last picked"""
+        now = now or datetime.utcnow()
+        if self._sampler is None:
+            self._sampler = FairSampler()
+            for person in self._persons.values():
+                self._add_to_sampler(person)
+
+        excluded = set(exclude or ())
+        tag_set = set(tags or ())
+
+        def matches(username: str) -> bool:
+            return username not in excluded and (not tag_set or not tag_set.isdisjoint(self._persons[username].tags))
+
+        username = self._sampler.sample_matching(matches, lambda: self.match_any(tags) if tags else self._persons, now)
+        return self._persons[username] if username is not None else None
+
+    # endregion reads
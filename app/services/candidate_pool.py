@@ -0,0 +1,188 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from .storage import Storage
+from ..models.person import PersonRecord
+from ..utils import normalize_tags
+
+
+class CandidatePool:
+    """Shuffled candidates of one roster and tag filter, handed out from the end"""
+
+    def __init__(self, version: int, recent: Deque[str]):
+        self.candidates: List[PersonRecord] = []
+        # The roster version the candidates were drawn at
+        self.version = version
+        self.checked_at = time.monotonic()
+        # The last ones handed out, left out of the next draws so that rerolls don't repeat them
+        self.recent = recent
+
+
+class CandidatePools:
+    """Per-chat pools of random persons for /random, its "another one" button and inline queries
+
+    A pool is drawn with one sample_persons query and handed out without replacement, so a
+    reroll costs no database round trip and doesn't repeat the last picks. When the pool runs
+    low, or recheck_interval seconds after its last check, it is checked against the roster
+    version and refilled in the background. A pool drawn before a write is dropped, so the pick
+    that notices the change is the last one from before it.
+    """
+
+    def __init__(self, size: int = 20, max_pools: int = 1024, recheck_interval: float = 5.0):
+        # Persons drawn per query, 0 disables the pools
+        self.size = size
+        self.low = max(1, size // 4)
+        self.max_pools = max_pools
+        self.recheck_interval = recheck_interval
+        self._pools: "OrderedDict[Hashable, CandidatePool]" = OrderedDict()
+        self._refreshing: Dict[Hashable, asyncio.Task] = {}
+        # Recent partners by (chat_id, user_id), with the round number they were looked up at
+        self._exclusions: "OrderedDict[Tuple[int, int], Tuple[int, List[str]]]" = OrderedDict()
+        # The latest round number by chat, with when it was read: pair history changes only with a round
+        self._rounds: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pools)
+
+    async def take(
+        self,
+        db_service: Storage,
+        tags: Optional[List[str]] = None,
+        count: int = 1,
+        exclude: Optional[List[str]] = None,
+    ) -> List[PersonRecord]:
+        """Up to count random persons of the roster (having any of the tags), none of exclude"""
+        tags = normalize_tags(tags) if tags else []
+        key = (db_service.chat_id, frozenset(tags))
+        pool = self._pools.get(key)
+        if pool is None:
+            # The only round trips on the way to the reply: a cold pool
+            pool = await self._draw(db_service, key, tags)
+        else:
+            self._pools.move_to_end(key)
+
+        excluded = set(exclude or ())
+        picked = self._pick(pool, count, excluded)
+        if len(picked) < count:
+            # Everyone left was handed out or is excluded - draw again right away
+            pool = await self._draw(db_service, key, tags, pool)
+            picked += self._pick(pool, count - len(picked), excluded.union(person.username for person in picked))
+
+        if len(pool.candidates) < self.low or time.monotonic() - pool.checked_at > self.recheck_interval:
+            self._refresh_later(db_service, key, tags)
+        return picked
+
+    def _pick(self, pool: CandidatePool, count: int, excluded: Set[str]) -> List[PersonRecord]:
+        picked, skipped = [], []
+        while pool.candidates and len(picked) < count:
+            person = pool.candidates.pop()
+            if person.username in excluded:
+                skipped.append(person)
+            else:
+                picked.append(person)
+                pool.recent.append(person.username)
+        # Only excluded for this user, the next one may get them
+        pool.candidates.extend(reversed(skipped))
+        return picked
+
+    async def _draw(
+        self,
+        db_service: Storage,
+        key: Hashable,
+        tags: List[str],
+        pool: Optional[CandidatePool] = None,
+        version: Optional[int] = None,
+    ) -> CandidatePool:
+        # Read before the sample: a write in between only makes the pool look older than it is
+        if version is None:
+            version = await db_service.get_roster_version()
+        sample = await db_service.sample_persons(tags, self.size)
+
+        recent = pool.recent if pool is not None else deque(maxlen=max(1, self.size // 2))
+        remaining = pool.candidates if pool is not None and pool.version == version else []
+        taken = set(recent).union(person.username for person in remaining)
+        fresh = [person for person in sample if person.username not in taken]
+        if not fresh and not remaining:
+            # A roster smaller than the recent picks: anyone but the last one
+            fresh = [person for person in sample if not recent or person.username != recent[-1]] or sample
+        random.shuffle(fresh)
+
+        new_pool = CandidatePool(version, recent)
+        # What was left of the pool goes first
+        new_pool.candidates = fresh + remaining
+        self._pools[key] = new_pool
+        self._pools.move_to_end(key)
+        while len(self._pools) > self.max_pools:
+            self._pools.popitem(last=False)
+        return new_pool
+
+    def _refresh_later(self, db_service: Storage, key: Hashable, tags: List[str]) -> None:
+        if key in self._refreshing:
+            return
+        task = asyncio.create_task(self._refresh(db_service, key, tags))
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _refresh(self, db_service: Storage, key: Hashable, tags: List[str]) -> None:
+        try:
+            pool = self._pools.get(key)
+            if pool is None:
+                return
+            version = await db_service.get_roster_version()
+            pool.checked_at = time.monotonic()
+            if version != pool.version or len(pool.candidates) < self.low:
+                await self._draw(db_service, key, tags, pool, version)
+        except Exception as e:
+            logger.warning(f"Refilling the candidate pool {key} failed: {e}")
+
+    def forget(self, chat_id: Optional[int]) -> None:
+        """Drop the pools of a roster this process just wrote to (chat_id as in db_service.chat_id)
+
+        The next pick draws afresh, instead of handing out a deleted person until the recheck.
+        Writes of other processes are still only seen by the version check.
+        """
+        for key in [key for key in self._pools if key[0] == chat_id]:
+            del self._pools[key]
+        # A refill in flight would store what it read before the write
+        for key, task in list(self._refreshing.items()):
+            if key[0] == chat_id:
+                task.cancel()
+
+    def remember_round(self, chat_id: int, round_number: int) -> None:
+        self._rounds[chat_id] = (round_number, time.monotonic())
+        self._rounds.move_to_end(chat_id)
+        while len(self._rounds) > self.max_pools:
+            self._rounds.popitem(last=False)
+
+    def round_number(self, chat_id: int) -> Optional[int]:
+        """The chat's latest round number, None if it wasn't read in the last recheck_interval seconds"""
+        remembered = self._rounds.get(chat_id)
+        if remembered is None or time.monotonic() - remembered[1] > self.recheck_interval:
+            return None
+        return remembered[0]
+
+    def remember_exclusions(self, chat_id: int, user_id: int, round_number: int, usernames: List[str]) -> None:
+        key = (chat_id, user_id)
+        self._exclusions[key] = (round_number, usernames)
+        self._exclusions.move_to_end(key)
+        while len(self._exclusions) > self.max_pools:
+            self._exclusions.popitem(last=False)
+
+    def exclusions(self, chat_id: int, user_id: int, round_number: int) -> Optional[List[str]]:
+        """The recent partners of the user in the chat as of the round, None if they aren't remembered"""
+        remembered = self._exclusions.get((chat_id, user_id))
+        if remembered is None or remembered[0] != round_number:
+            return None
+        return remembered[1]
+
+    async def close(self) -> None:
+        tasks = list(self._refreshing.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pools.clear()
@@ -1,102 +1,1178 @@
-from typing import List, Optional
-import random
+import asyncio
+import copy
+import math
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from loguru import logger
 from motor.motor_asyncio import AsyncIOMotorClient
-from ..models.person import Person
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from .cache import PersonCache
+from .fair_sampler import FairIndex
+from .pair_history import PairHistory, canonical_pair
+from .search import SearchIndex
+from .storage import ROSTER_SCOPES, BulkUpsertResult, TagUpdate
+from ..models.person import Person, PersonRecord
+from ..utils import normalize_tags
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# Global scope and the per-chat collections
+PERSON_INDEXES = [
+    # Lookups and writes by username
+    IndexModel([("username", ASCENDING)], unique=True),
+    # Multikey index for the tag queries ($in for /random, $all for /list_by_tags),
+    # username as the second key keeps tag listings sorted without an in-memory sort
+    IndexModel([("tags", ASCENDING), ("username", ASCENDING)]),
+]
+
+PAIR_HISTORY_INDEXES = [
+    # One document per pair, user_a < user_b
+    IndexModel([("user_a", ASCENDING), ("user_b", ASCENDING)], unique=True),
+    # Partners of a single user: user_a lookups use the unique index prefix
+    IndexModel([("user_b", ASCENDING), ("round", ASCENDING)]),
+    # Covers the whole "recent pairs" scan, no documents are fetched
+    IndexModel([("round", ASCENDING), ("user_a", ASCENDING), ("user_b", ASCENDING)]),
+]
+
+ROUND_INDEXES = [IndexModel([("round", ASCENDING)])]
+
+TAG_INDEXES = [
+    # /tags lists the most popular tags first
+    IndexModel([("count", DESCENDING)]),
+]
+
+# Chat scope: the same indexes led by chat_id, so a roster's queries only touch its own keys
+CHAT_PERSON_INDEXES = [
+    IndexModel([("chat_id", ASCENDING), ("username", ASCENDING)], unique=True),
+    IndexModel([("chat_id", ASCENDING), ("tags", ASCENDING), ("username", ASCENDING)]),
+]
+
+CHAT_PAIR_HISTORY_INDEXES = [
+    IndexModel([("chat_id", ASCENDING), ("user_a", ASCENDING), ("user_b", ASCENDING)], unique=True),
+    IndexModel([("chat_id", ASCENDING), ("user_b", ASCENDING), ("round", ASCENDING)]),
+    IndexModel(
+        [("chat_id", ASCENDING), ("round", ASCENDING), ("user_a", ASCENDING), ("user_b", ASCENDING)]
+    ),
+]
+
+CHAT_ROUND_INDEXES = [IndexModel([("chat_id", ASCENDING), ("round", ASCENDING)])]
+
+CHAT_TAG_INDEXES = [IndexModel([("chat_id", ASCENDING), ("count", DESCENDING)])]
+
+# Unique indexes of the global scope that would keep two chats from having the same person
+GLOBAL_UNIQUE_INDEXES = {"persons": "username_1", "pair_history": "user_a_1_user_b_1"}
+
+DELIVERY_INDEXES = [
+    # A round of a roster notifies each chat at most once, also if enqueued again after a restart
+    IndexModel(
+        [("roster_chat_id", ASCENDING), ("round", ASCENDING), ("chat_id", ASCENDING)], unique=True
+    ),
+    IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+]
+# Available updates of the queue, oldest first: the leased ones are out of the lease_until range
+UPDATE_QUEUE_INDEXES = [IndexModel([("lease_until", ASCENDING), ("_id", ASCENDING)])]
+
+# Replaced by the roster_chat_id one: round numbers repeat across rosters
+LEGACY_DELIVERY_INDEX = "round_1_chat_id_1"
+
+# Tags held by at least this share of the roster are filtered after $sample instead of before
+DENSE_TAGS_FRACTION = 0.1
+# How many matches a dense sample is expected to contain, a miss falls back to the exact query
+DENSE_SAMPLE_MATCHES = 4
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Flatten the stage names of an explain() plan tree"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+
+# Weighted draws that lost the race with another replica picking the same person
+FAIR_PICK_ATTEMPTS = 3
+# Seconds between checks of the fair index against the roster version, for writes made elsewhere
+FAIR_INDEX_RECHECK = 5.0
+
+
+# Fields needed to render roster listings
+LISTING_PROJECTION = {"username": 1, "tags": 1}
+
 
 class DatabaseService:
-    def __init__(self, connection_string: str, database_name: str):
-        self.client = AsyncIOMotorClient(connection_string)
+    """The MongoDB storage (see storage.Storage), through Motor"""
+
+    def __init__(
+        self,
+        connection_string: str,
+        database_name: str,
+        cache: Optional[PersonCache] = None,
+        roster_scope: str = "global",
+        max_rosters: int = 1024,
+        **client_options,
+    ):
+        if roster_scope not in ROSTER_SCOPES:
+            raise ValueError(
+                f"Unknown roster scope {roster_scope}, use one of: {', '.join(ROSTER_SCOPES)}"
+            )
+        # client_options go to the Motor client: pool size, timeouts, read preference, write concern
+        self.client = AsyncIOMotorClient(connection_string, **client_options)
         self.db = self.client[database_name]
+        self.roster_scope = roster_scope
+        # The chat whose roster this service works with, None for the deployment-wide service
+        self.chat_id: Optional[int] = None
+        # Merged into every roster query and written into every roster document
+        self.scope: dict = {}
         self.collection = self.db.persons
+        # One document per group of a coffee round
+        self.rounds = self.db.coffee_rounds
+        # One document per pair of persons who have met, with the last round they met in
+        self.pair_history = self.db.pair_history
+        # One document per normalized tag: {tag, count: number of persons having it}
+        self.tags = self.db.tags
+        # Shared by all rosters: round number counters, outgoing round notifications and their
+        # delivery state, Telegram user ids by username
+        self.counters = self.db.counters
+        self.deliveries = self.db.deliveries
+        self.users = self.db.users
+        # Updates received by the ingress process, waiting for a worker (see update_queue.py)
+        self.update_queue = self.db.update_queue
+        # Named leases: the one instance of a deployment running rounds and deliveries holds one
+        self.leases = self.db.leases
+        self.cache = cache
+        self._cache_lock = asyncio.Lock()
+        self.search_index = SearchIndex()
+        self._search_lock = asyncio.Lock()
+        # Fair picks when the cache can't make them
+        self.fair_index = FairIndex()
+        self._fair_lock = asyncio.Lock()
+        # Roster views by chat, the least recently used ones beyond max_rosters are dropped
+        self._rosters: "OrderedDict[int, DatabaseService]" = OrderedDict()
+        self.max_rosters = max_rosters
+        self._rosters_lock = asyncio.Lock()
+
+    async def for_chat(self, chat_id: int) -> "DatabaseService":
+        """The service for the roster of a chat, sharing the client - self in the global scope
+
+        Views are kept for reuse, each with its own cache and indexes, up to max_rosters of the
+        chats used last. In the collection scope the chat's collections get their indexes on first
+        use (and again after their view was dropped, a no-op round trip).
+        """
+        if self.roster_scope == "global" or self.chat_id is not None:
+            return self
+        roster = self._rosters.get(chat_id)
+        if roster is not None:
+            self._rosters.move_to_end(chat_id)
+            return roster
+        async with self._rosters_lock:
+            if chat_id in self._rosters:
+                return self._rosters[chat_id]
+            roster = copy.copy(self)
+            roster.chat_id = chat_id
+            roster.cache = (
+                PersonCache(self.cache.ttl, self.cache.max_size) if self.cache is not None else None
+            )
+            roster._cache_lock = asyncio.Lock()
+            roster.search_index = SearchIndex()
+            roster._search_lock = asyncio.Lock()
+            roster.fair_index = FairIndex()
+            roster._fair_lock = asyncio.Lock()
+            roster._rosters = OrderedDict()
+            if self.roster_scope == "chat":
+                roster.scope = {"chat_id": chat_id}
+            else:
+                roster.collection = self.db[f"persons_{chat_id}"]
+                roster.rounds = self.db[f"coffee_rounds_{chat_id}"]
+                roster.pair_history = self.db[f"pair_history_{chat_id}"]
+                roster.tags = self.db[f"tags_{chat_id}"]
+                await roster._initialize_roster()
+            self._rosters[chat_id] = roster
+            while len(self._rosters) > self.max_rosters:
+                self._rosters.popitem(last=False)
+            return roster
+
+    @property
+    def _counter_id(self) -> str:
+        return "coffee_round" if self.chat_id is None else f"coffee_round:{self.chat_id}"
+
+    @property
+    def _version_id(self) -> str:
+        return "roster_version" if self.chat_id is None else f"roster_version:{self.chat_id}"
+
+    def _tag_id(self, tag: str, chat_id: Optional[int] = None) -> str:
+        """Registry key of a tag, prefixed with the chat in the chat scope (shared collection)"""
+        chat_id = self.scope.get("chat_id", chat_id)
+        return tag if chat_id is None else f"{chat_id}:{tag}"
 
     async def initialize(self):
         """Initialize the database with required collections and indexes"""
-        # Create unique index on username
-        await self.collection.create_index("username", unique=True)
+        if LEGACY_DELIVERY_INDEX in await self.deliveries.index_information():
+            await self.deliveries.drop_index(LEGACY_DELIVERY_INDEX)
+        await self.deliveries.create_indexes(DELIVERY_INDEXES)
+        await self.update_queue.create_indexes(UPDATE_QUEUE_INDEXES)
+        # First start with the users collection: take over the user ids stored on persons
+        if not await self.users.estimated_document_count():
+            cursor = self.collection.find(
+                {"user_id": {"$ne": None}}, {"username": 1, "user_id": 1, "_id": 0}
+            )
+            requests = [
+                UpdateOne(
+                    {"_id": person_dict["username"]},
+                    {"$set": {"user_id": person_dict["user_id"]}},
+                    upsert=True,
+                )
+                async for person_dict in cursor
+            ]
+            if requests:
+                await self.users.bulk_write(requests, ordered=False)
+        await self._initialize_roster()
 
-    async def add_person(self, username: str, tags: Optional[List[str]] = None) -> Person:
+    async def _initialize_roster(self):
+        chat_scope = self.roster_scope == "chat"
+        person_indexes = CHAT_PERSON_INDEXES if chat_scope else PERSON_INDEXES
+        if chat_scope:
+            # Documents of the global scope would be invisible to every chat roster, and the
+            # unique indexes dropped below are what keeps them consistent
+            for collection in (self.collection, self.pair_history):
+                if await collection.find_one({"chat_id": None}, {"_id": 1}) is not None:
+                    raise RuntimeError(
+                        f"{collection.name} has documents without a chat_id, left from the global "
+                        "roster scope - set the chat_id of each to the chat it belongs to before "
+                        "switching to the chat scope"
+                    )
+            for collection in (self.collection, self.pair_history):
+                legacy_index = GLOBAL_UNIQUE_INDEXES[collection.name]
+                if legacy_index in await collection.index_information():
+                    await collection.drop_index(legacy_index)
+        await self.collection.create_indexes(person_indexes)
+        await self.rounds.create_indexes(CHAT_ROUND_INDEXES if chat_scope else ROUND_INDEXES)
+        await self.pair_history.create_indexes(
+            CHAT_PAIR_HISTORY_INDEXES if chat_scope else PAIR_HISTORY_INDEXES
+        )
+        await self.tags.create_indexes(CHAT_TAG_INDEXES if chat_scope else TAG_INDEXES)
+        # First start with the tag registry: migrate the tags of the existing persons and count them
+        if (
+            not await self.tags.estimated_document_count()
+            and await self.collection.estimated_document_count()
+        ):
+            await self.normalize_stored_tags()
+            await self.rebuild_tag_counts()
+
+        # Verify the indexes are actually there - e.g. an existing non-unique username index
+        # with the same name would make create_indexes a no-op
+        existing = await self.collection.index_information()
+        for index in person_indexes:
+            name = index.document["name"]
+            if name not in existing:
+                raise RuntimeError(f"Index {name} is missing on {self.collection.name}")
+            if index.document.get("unique") and not existing[name].get("unique"):
+                raise RuntimeError(f"Index {name} on {self.collection.name} is not unique")
+        logger.info(f"Indexes on {self.collection.name}: {', '.join(sorted(existing))}")
+
+    async def warm_up(self, connections: int = 1):
+        """Open pool connections and create indexes ahead of the first request"""
+        # Concurrent pings can't share a connection, so each one opens its own
+        await asyncio.gather(
+            *(self.client.admin.command("ping") for _ in range(max(connections, 1)))
+        )
+        await self.initialize()
+
+    async def close(self):
+        self.client.close()
+
+    async def ping(self, timeout: float = 2.0) -> bool:
+        """Check that MongoDB answers - for the health check"""
         try:
-            # Create person without _id first
-            person_dict = {
-                "username": username,
-                "tags": tags or [],
-                "created_at": datetime.utcnow()
-            }
-            result = await self.collection.insert_one(person_dict)
-            
-            # Now create the full person object with the generated _id
-            person_dict["_id"] = str(result.inserted_id)
-            return Person(**person_dict)
+            await asyncio.wait_for(self.client.admin.command("ping"), timeout)
+            return True
         except Exception as e:
-            if "duplicate key error" in str(e):
-                raise ValueError(f"Person with username {username} already exists")
-            raise
+            logger.warning(f"MongoDB ping failed: {e}")
+            return False
 
-    async def add_tags(self, username: str, tags: List[str]) -> bool:
-        """Add multiple tags to a person"""
-        result = await self.collection.update_one(
-            {"username": username},
-            {"$addToSet": {"tags": {"$each": tags}}}
+    async def explain_tag_queries(self, tags: Optional[List[str]] = None) -> List[dict]:
+        """Log the query plans of the tag queries - to check that none of them is a COLLSCAN"""
+        if not tags:
+            tags = (await self.collection.distinct("tags", self.scope))[:2] or ["example"]
+
+        queries = {
+            "random ($in)": {**self.scope, "tags": {"$in": tags}},
+            "list_by_tags ($all)": {**self.scope, "tags": {"$all": tags}},
+        }
+        reports = []
+        for name, query in queries.items():
+            explain = await self.collection.find(query).explain()
+            stats = explain.get("executionStats", {})
+            stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+            report = {
+                "query": name,
+                "stages": stages,
+                "keys_examined": stats.get("totalKeysExamined"),
+                "docs_examined": stats.get("totalDocsExamined"),
+                "docs_returned": stats.get("nReturned"),
+            }
+            reports.append(report)
+
+            message = (
+                f"Query plan for {name} {tags}: {' <- '.join(stages)}, "
+                f"keys examined: {report['keys_examined']}, "
+                f"docs examined: {report['docs_examined']}, "
+                f"docs returned: {report['docs_returned']}"
+            )
+            if "COLLSCAN" in stages:
+                logger.warning(message)
+            else:
+                logger.debug(message)
+        return reports
+
+    async def warm_cache(self) -> bool:
+        """Load the whole roster into the cache in one scan, False without a cache or if too big"""
+        if self.cache is None:
+            return False
+        async with self._cache_lock:
+            if self.cache.is_warm:
+                return True
+            # One document over the limit is enough to know the roster doesn't fit
+            cursor = self.collection.find(self.scope).limit(self.cache.max_size + 1)
+            persons = [self._to_record(person_dict) async for person_dict in cursor]
+            if not self.cache.load(persons):
+                logger.warning(
+                    f"Roster has more than {self.cache.max_size} persons, "
+                    "serving reads from the database"
+                )
+                return False
+            logger.info(f"Person cache warmed with {len(self.cache)} persons")
+            return True
+
+    async def _warm_cache_or_none(self) -> Optional[PersonCache]:
+        """The cache if it can answer reads right now"""
+        if self.cache is None:
+            return None
+        if self.cache.should_reload:
+            await self.warm_cache()
+        return self.cache if self.cache.is_warm else None
+
+    async def watch_changes(self):
+        """Apply writes made by other bot replicas to the cache - requires a replica set"""
+        if self.cache is None:
+            return
+        pipeline = []
+        if self.scope:
+            # Deletes carry only the _id, ids of other rosters are simply not in the cache
+            pipeline.append(
+                {
+                    "$match": {
+                        "$or": [
+                            {"fullDocument.chat_id": self.chat_id},
+                            {"operationType": {"$nin": ["insert", "update", "replace"]}},
+                        ]
+                    }
+                }
+            )
+        try:
+            async with self.collection.watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    operation = change["operationType"]
+                    if operation in ("insert", "update", "replace") and change.get("fullDocument"):
+                        self.cache.upsert(self._to_record(change["fullDocument"]))
+                    elif operation == "delete":
+                        self.cache.remove_by_id(str(change["documentKey"]["_id"]))
+                    elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+                        self.cache.invalidate()
+        except OperationFailure as e:
+            # Change streams are only available on replica sets and sharded clusters
+            logger.warning(
+                f"Can't watch {self.collection.name} for changes, relying on cache TTL: {e}"
+            )
+
+    @staticmethod
+    def _to_record(person_dict: dict) -> PersonRecord:
+        # Reads come from our own collection, validation stays on the write path
+        return PersonRecord.from_db(person_dict)
+
+    async def add_person(self, username: str, tags: Optional[List[str]] = None) -> Person:
+        tags = normalize_tags(tags or [])
+        person_dict = {
+            **self.scope,
+            "username": username,
+            "tags": tags,
+            "created_at": datetime.utcnow(),
+        }
+        try:
+            # The driver sets _id on person_dict before sending it, nothing needs to be read back
+            await self.collection.insert_one(person_dict)
+        except DuplicateKeyError:
+            raise ValueError(f"Person with username {username} already exists")
+        await asyncio.gather(
+            self._inc_tag_counts(dict.fromkeys(tags, 1)), self._bump_roster_version()
+        )
+
+        person_dict["_id"] = str(person_dict["_id"])
+        person = Person(**person_dict)
+        record = PersonRecord.from_person(person)
+        if self.cache is not None:
+            self.cache.upsert(record)
+        self.search_index.add_person(username, tags)
+        self.fair_index.written([record])
+        return person
+
+    @staticmethod
+    def _tag_update(username: str, before: Optional[dict], tags: List[str]) -> TagUpdate:
+        """The result of $addToSet-ing the tags, from the document before the write"""
+        if before is None:
+            return TagUpdate(username)
+        old_tags = before.get("tags") or []
+        added = [tag for tag in tags if tag not in old_tags]
+        # $addToSet appends the missing tags in the given order
+        before["tags"] = old_tags + added
+        return TagUpdate(username, PersonRecord.from_db(before), added)
+
+    async def add_tags(self, username: str, tags: List[str]) -> TagUpdate:
+        """Add multiple tags to a person, falsy if there's no such person or they had all of them"""
+        tags = normalize_tags(tags)
+        # The document from before the update tells which tags are new, to count only those
+        before = await self.collection.find_one_and_update(
+            {**self.scope, "username": username},
+            {"$addToSet": {"tags": {"$each": tags}}},
+            return_document=ReturnDocument.BEFORE,
         )
-        return result.modified_count > 0
+        result = self._tag_update(username, before, tags)
+        if result.added:
+            await asyncio.gather(
+                self._inc_tag_counts(dict.fromkeys(result.added, 1)), self._bump_roster_version()
+            )
+            if self.cache is not None:
+                self.cache.add_tags(username, result.added)
+            self.search_index.add_tags(result.added)
+            self.fair_index.written([result.person])
+        return result
 
-    async def delete_person(self, username: str) -> bool:
-        result = await self.collection.delete_one({"username": username})
-        return result.deleted_count > 0
+    async def bulk_add_tags(self, changes: Dict[str, List[str]]) -> Dict[str, TagUpdate]:
+        """Add tags to several persons in one unordered bulk write, a result per username, in order
+
+        Which tags are new is read before the write, like in bulk_upsert_persons - a concurrent
+        write adding the same tag to the same person in between can make its count drift
+        (rebuild_tag_counts fixes that).
+        """
+        changes = {username: normalize_tags(tags) for username, tags in changes.items()}
+        cursor = self.collection.find({**self.scope, "username": {"$in": list(changes)}})
+        found = {person_dict["username"]: person_dict async for person_dict in cursor}
+
+        results = {
+            username: self._tag_update(username, found.get(username), tags)
+            for username, tags in changes.items()
+        }
+        updated = [result for result in results.values() if result.added]
+        if not updated:
+            return results
+
+        tag_deltas: Dict[str, int] = {}
+        for result in updated:
+            for tag in result.added:
+                tag_deltas[tag] = tag_deltas.get(tag, 0) + 1
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {**self.scope, "username": result.username},
+                    {"$addToSet": {"tags": {"$each": result.added}}},
+                )
+                for result in updated
+            ],
+            ordered=False,
+        )
+        await asyncio.gather(self._inc_tag_counts(tag_deltas), self._bump_roster_version())
+        if self.cache is not None:
+            for result in updated:
+                self.cache.add_tags(result.username, result.added)
+        self.search_index.add_tags([tag for result in updated for tag in result.added])
+        self.fair_index.written([result.person for result in updated])
+        return results
 
-    async def get_random_person(self, tags: Optional[List[str]] = None) -> Optional[Person]:
-        query = {}
+    async def delete_person(self, username: str) -> Optional[PersonRecord]:
+        deleted = await self.collection.find_one_and_delete({**self.scope, "username": username})
+        if self.cache is not None:
+            self.cache.remove(username)
+        if deleted is None:
+            return None
+        await asyncio.gather(
+            self._inc_tag_counts(dict.fromkeys(deleted.get("tags", []), -1)),
+            self._bump_roster_version(),
+        )
+        self.search_index.remove_person(username, deleted.get("tags", []))
+        self.fair_index.written(removed=[username])
+        return self._to_record(deleted)
+
+    async def get_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]:
+        """Get a uniformly random person (optionally having any of the tags)"""
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_random_person(tags, exclude)
+
+        query = dict(self.scope)
         if tags:
             query["tags"] = {"$in": tags}
-        
-        count = await self.collection.count_documents(query)
-        if count == 0:
-            return None
-            
-        random_index = random.randint(0, count - 1)
-        cursor = self.collection.find(query).skip(random_index).limit(1)
-        person_dict = await cursor.next()
-        if person_dict and "_id" in person_dict:
-            person_dict["_id"] = str(person_dict["_id"])
-        return Person(**person_dict) if person_dict else None
+        if exclude:
+            query["username"] = {"$nin": exclude}
 
-    async def add_tag(self, username: str, tag: str) -> bool:
-        result = await self.collection.update_one(
-            {"username": username},
-            {"$addToSet": {"tags": tag}}
+        if tags:
+            # Plan by how many persons have the tags - an upper bound, a person may have several
+            counts, total = await asyncio.gather(self.get_tag_counts(tags), self._roster_size())
+            matching = sum(counts.values())
+            if not matching:
+                return None
+            # A leading $sample draws from the whole collection: shared ones always $match first
+            if total and not self.scope and matching >= DENSE_TAGS_FRACTION * total:
+                # $match first would fetch every match to sample one of them. Instead sample enough
+                # documents to contain a few matches and take the first one - still uniform.
+                size = math.ceil(DENSE_SAMPLE_MATCHES * total / matching)
+                pipeline = [{"$sample": {"size": size}}, {"$match": query}, {"$limit": 1}]
+                async for person_dict in self.collection.aggregate(pipeline):
+                    return self._to_record(person_dict)
+                # No match in the sample (or stale counts), fall back to the exact query
+
+        pipeline = []
+        if query:
+            pipeline.append({"$match": query})
+        # As the first stage $sample walks a random cursor instead of scanning the collection,
+        # after $match it samples only the matched documents
+        pipeline.append({"$sample": {"size": 1}})
+
+        async for person_dict in self.collection.aggregate(pipeline):
+            return self._to_record(person_dict)
+        return None
+
+    async def sample_persons(
+        self, tags: Optional[List[str]] = None, size: int = 20
+    ) -> List[PersonRecord]:
+        """Up to size distinct random persons (optionally with any of the tags), in random order"""
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.sample_persons(tags, size)
+
+        query = dict(self.scope)
+        if tags:
+            query["tags"] = {"$in": tags}
+        # After a $match every match is read to sample from - a pool is drawn rarely, unlike /random
+        pipeline = (
+            [{"$match": query}, {"$sample": {"size": size}}]
+            if query
+            else [{"$sample": {"size": size}}]
+        )
+        persons = {}
+        async for person_dict in self.collection.aggregate(pipeline):
+            # A leading $sample may return a document more than once
+            persons.setdefault(person_dict["_id"], self._to_record(person_dict))
+        return list(persons.values())
+
+    async def pick_fair_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]:
+        """Pick a person weighted by priority * time since their last pick, and mark them picked
+
+        A draw is O(log n) on Fenwick trees: the warm cache's, or else the fair index's.
+        """
+        tags = normalize_tags(tags) if tags else None
+        person = None
+        for _ in range(FAIR_PICK_ATTEMPTS):
+            now = datetime.utcnow()
+            cache = await self._warm_cache_or_none()
+            if cache is not None:
+                person = cache.get_fair_random_person(tags, exclude, now)
+            else:
+                person = (await self._get_fair_index()).draw(tags, exclude, now)
+            if person is None:
+                return None
+
+            # Compare-and-set on the last pick time: two replicas can't both hand out the same turn
+            updated = await self.collection.find_one_and_update(
+                {"_id": ObjectId(person.id), "last_picked_at": person.last_picked_at},
+                {"$set": {"last_picked_at": now}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if updated is not None:
+                record = self._to_record(updated)
+                if self.cache is not None:
+                    self.cache.upsert(record)
+                self.fair_index.upsert(record)
+                return record
+
+            # Picked (or deleted) elsewhere meanwhile: refresh our copy and draw again
+            current = await self.collection.find_one({"_id": ObjectId(person.id)})
+            if current is not None:
+                record = self._to_record(current)
+                if self.cache is not None:
+                    self.cache.upsert(record)
+                self.fair_index.upsert(record)
+            else:
+                if self.cache is not None:
+                    self.cache.remove(person.username)
+                self.fair_index.remove(person.username)
+        logger.warning(
+            f"Couldn't mark a fair pick after {FAIR_PICK_ATTEMPTS} attempts, returning it unmarked"
         )
-        return result.modified_count > 0
+        return person
+
+    async def _get_fair_index(self) -> FairIndex:
+        """The fair index, loaded with one roster scan if it's cold or the roster changed elsewhere
+
+        The version is checked at most every FAIR_INDEX_RECHECK seconds, so a pick costs only its
+        write.
+        """
+        if (
+            self.fair_index.version is not None
+            and time.monotonic() - self.fair_index.checked_at < FAIR_INDEX_RECHECK
+        ):
+            return self.fair_index
+        async with self._fair_lock:
+            # Read before the scan: a write in between only makes the index look older than it is
+            version = await self.get_roster_version()
+            if self.fair_index.version != version:
+                persons = [
+                    self._to_record(person_dict)
+                    async for person_dict in self.collection.find(self.scope)
+                ]
+                self.fair_index.load(persons, version)
+                logger.info(f"Fair index built: {len(persons)} persons")
+            self.fair_index.checked_at = time.monotonic()
+        return self.fair_index
+
+    async def set_priority(self, username: str, priority: float) -> bool:
+        """How often a person is picked in fair mode, relative to others (1 by default, 0 never)"""
+        if priority < 0:
+            raise ValueError("Priority can't be negative")
+        updated = await self.collection.find_one_and_update(
+            {**self.scope, "username": username},
+            {"$set": {"priority": priority}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if updated is None:
+            return False
+        record = self._to_record(updated)
+        if self.cache is not None:
+            self.cache.upsert(record)
+        self.fair_index.upsert(record)
+        return True
+
+    async def add_tag(self, username: str, tag: str) -> bool:
+        return bool(await self.add_tags(username, [tag]))
+
+    async def get_person(self, username: str) -> Optional[PersonRecord]:
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_person(username)
 
-    async def get_person(self, username: str) -> Optional[Person]:
-        person_dict = await self.collection.find_one({"username": username})
-        if person_dict and "_id" in person_dict:
-            person_dict["_id"] = str(person_dict["_id"])
-        return Person(**person_dict) if person_dict else None
+        person_dict = await self.collection.find_one({**self.scope, "username": username})
+        return self._to_record(person_dict) if person_dict else None
 
     async def cleanup(self):
         """Clean up the database - used for testing"""
         await self.collection.delete_many({})
         await self.collection.drop_indexes()
+        await self.rounds.drop()
+        await self.pair_history.drop()
+        await self.counters.drop()
+        await self.deliveries.drop()
+        await self.users.drop()
+        await self.update_queue.drop()
+        await self.leases.drop()
+        await self.tags.drop()
+        if self.cache is not None:
+            self.cache.invalidate()
+        self.search_index.invalidate()
+        self.fair_index.invalidate()
 
-    async def get_all_persons(self) -> List[Person]:
+    async def get_all_persons(self) -> List[PersonRecord]:
         """Get all persons from the database"""
-        cursor = self.collection.find()
-        persons = []
-        async for person_dict in cursor:
-            if person_dict and "_id" in person_dict:
-                person_dict["_id"] = str(person_dict["_id"])
-            persons.append(Person(**person_dict))
-        return persons
-
-    async def get_all_persons_by_tags(self, tags: List[str]) -> List[Person]:
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_all_persons()
+
+        cursor = self.collection.find(self.scope)
+        return [self._to_record(person_dict) async for person_dict in cursor]
+
+    async def get_all_persons_by_tags(self, tags: List[str]) -> List[PersonRecord]:
         """Get all persons that have ALL of the specified tags"""
-        query = {"tags": {"$all": tags}}
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_all_persons_by_tags(normalize_tags(tags))
+
+        query = {**self.scope, "tags": {"$all": normalize_tags(tags)}}
         cursor = self.collection.find(query)
-        persons = []
-        async for person_dict in cursor:
-            if person_dict and "_id" in person_dict:
-                person_dict["_id"] = str(person_dict["_id"])
-            persons.append(Person(**person_dict))
-        return persons 
\ No newline at end of file
+        return [self._to_record(person_dict) async for person_dict in cursor]
+
+    async def iter_persons(
+        self, tags: Optional[List[str]] = None, batch_size: int = 500
+    ) -> AsyncIterator[PersonRecord]:
+        """Iterate over persons (optionally having ALL of the tags) ordered by username
+
+        Only username and tags are loaded. Pages are fetched with keyset pagination on the
+        username index, so memory stays bounded by batch_size whatever the roster size.
+        """
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            persons = cache.get_all_persons_by_tags(tags) if tags else cache.get_all_persons()
+            for person in sorted(persons, key=lambda p: p.username):
+                yield person
+            return
+
+        last_username = None
+        while True:
+            page = await self.get_persons_page(tags, after=last_username, limit=batch_size)
+            for person in page:
+                yield person
+            if len(page) < batch_size:
+                return
+            last_username = page[-1].username
+
+    async def get_persons_page(
+        self, tags: Optional[List[str]] = None, after: Optional[str] = None, limit: int = 50
+    ) -> List[PersonRecord]:
+        """Up to limit persons (optionally with ALL of the tags) with usernames after this one"""
+        query = dict(self.scope)
+        if tags:
+            query["tags"] = {"$all": normalize_tags(tags)}
+        if after is not None:
+            query["username"] = {"$gt": after}
+        cursor = self.collection.find(query, LISTING_PROJECTION).sort("username", 1).limit(limit)
+        return [self._to_record(person_dict) async for person_dict in cursor]
+
+    async def bulk_upsert_persons(
+        self, rows: Iterable[Tuple[str, List[str]]], batch_size: int = 1000
+    ) -> BulkUpsertResult:
+        """Insert persons or add the tags to existing ones, in unordered bulk writes"""
+        result = BulkUpsertResult()
+
+        # Merge repeated usernames first so each one is a single upsert
+        merged = {}
+        for username, tags in rows:
+            if username in merged:
+                result.duplicates += 1
+            merged.setdefault(username, {}).update(dict.fromkeys(normalize_tags(tags)))
+
+        now = datetime.utcnow()
+        items = list(merged.items())
+        # A write error other than a lost race stops the import, once what got written is counted
+        failure: Optional[BulkWriteError] = None
+        for start in range(0, len(items), batch_size):
+            batch_items = items[start : start + batch_size]
+            # Tags the persons already have aren't counted again
+            cursor = self.collection.find(
+                {**self.scope, "username": {"$in": [username for username, _ in batch_items]}},
+                {"username": 1, "tags": 1, "_id": 0},
+            )
+            existing = {
+                person_dict["username"]: set(person_dict.get("tags", []))
+                async for person_dict in cursor
+            }
+
+            batch = [
+                UpdateOne(
+                    # The equality filter fields, chat_id too, are written into inserted documents
+                    {**self.scope, "username": username},
+                    {
+                        "$addToSet": {"tags": {"$each": list(tags)}},
+                        "$setOnInsert": {"created_at": now},
+                    },
+                    upsert=True,
+                )
+                for username, tags in batch_items
+            ]
+            failed = set()
+            try:
+                bulk_result = (
+                    await self.collection.bulk_write(batch, ordered=False)
+                ).bulk_api_result
+            except BulkWriteError as e:
+                bulk_result = e.details
+                failed = {error["index"] for error in bulk_result["writeErrors"]}
+                # Concurrent upserts of the same username lose the race on the unique index
+                result.duplicates += sum(
+                    1 for error in bulk_result["writeErrors"] if error["code"] == 11000
+                )
+                if any(error["code"] != 11000 for error in bulk_result["writeErrors"]):
+                    failure = e
+            result.inserted += bulk_result["nUpserted"]
+            result.updated += bulk_result["nModified"]
+            result.duplicates += bulk_result["nMatched"] - bulk_result["nModified"]
+
+            tag_deltas: Dict[str, int] = {}
+            for i, (username, tags) in enumerate(batch_items):
+                if i in failed:
+                    continue
+                for tag in tags:
+                    if tag not in existing.get(username, ()):
+                        tag_deltas[tag] = tag_deltas.get(tag, 0) + 1
+            await self._inc_tag_counts(tag_deltas)
+            if failure is not None:
+                break
+
+        if result.inserted or result.updated:
+            await self._bump_roster_version()
+            if self.cache is not None:
+                self.cache.invalidate()
+            self.search_index.invalidate()
+            self.fair_index.invalidate()
+        if failure is not None:
+            raise failure
+        return result
+
+    async def get_usernames(self, tags: Optional[List[str]] = None) -> List[str]:
+        """Get usernames of all persons (optionally having ALL of the tags) in one query"""
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return (
+                list(cache.match_all(normalize_tags(tags)))
+                if tags
+                else [p.username for p in cache.get_all_persons()]
+            )
+
+        query = {**self.scope, "tags": {"$all": normalize_tags(tags)}} if tags else self.scope
+        cursor = self.collection.find(query, {"username": 1, "_id": 0})
+        return [person_dict["username"] async for person_dict in cursor]
+
+    async def _bump_roster_version(self) -> None:
+        await self.counters.update_one(
+            {"_id": self._version_id}, {"$inc": {"value": 1}}, upsert=True
+        )
+
+    async def get_roster_version(self) -> int:
+        """Grows with every write changing what a listing shows (usernames, tags), 0 before any"""
+        counter = await self.counters.find_one({"_id": self._version_id})
+        return counter["value"] if counter else 0
+
+    async def get_search_index(self) -> SearchIndex:
+        """The search index, rebuilt with one username scan after writes made elsewhere (or cold)"""
+        version = await self.get_roster_version()
+        if self.search_index.version == version:
+            return self.search_index
+        async with self._search_lock:
+            # Read before the scan: a write in between only makes the index look older than it is
+            version = await self.get_roster_version()
+            if self.search_index.version != version:
+                usernames, tag_counts = await asyncio.gather(
+                    self.get_usernames(), self.get_popular_tags()
+                )
+                self.search_index.load(usernames, tag_counts, version)
+                logger.info(
+                    f"Search index built: {len(usernames)} usernames, {len(tag_counts)} tags"
+                )
+        return self.search_index
+
+    async def _roster_size(self) -> int:
+        # Counting a chat_id prefix of the username index reads only the roster's keys
+        if self.scope:
+            return await self.collection.count_documents(self.scope)
+        return await self.collection.estimated_document_count()
+
+    async def _inc_tag_counts(self, deltas: Dict[str, int]) -> None:
+        requests = [
+            UpdateOne(
+                {"_id": self._tag_id(tag)},
+                {"$inc": {"count": delta}, "$setOnInsert": {**self.scope, "tag": tag}},
+                upsert=True,
+            )
+            for tag, delta in deltas.items()
+            if delta
+        ]
+        if requests:
+            await self.tags.bulk_write(requests, ordered=False)
+
+    async def get_tag_counts(self, tags: List[str]) -> Dict[str, int]:
+        """How many persons have each of the tags, without touching the persons"""
+        tags_by_id = {self._tag_id(tag): tag for tag in normalize_tags(tags)}
+        counts = dict.fromkeys(tags_by_id.values(), 0)
+        async for tag in self.tags.find({"_id": {"$in": list(tags_by_id)}}):
+            counts[tags_by_id[tag["_id"]]] = tag["count"]
+        return counts
+
+    async def get_popular_tags(self, limit: int = 0) -> List[Tuple[str, int]]:
+        """(tag, number of persons) for every tag in use, most popular first"""
+        cursor = (
+            self.tags.find({**self.scope, "count": {"$gt": 0}})
+            .sort("count", DESCENDING)
+            .limit(limit)
+        )
+        # Registries from before the tag field was stored keep the tag in _id
+        return [(tag.get("tag", tag["_id"]), tag["count"]) async for tag in cursor]
+
+    async def normalize_stored_tags(self, batch_size: int = 1000) -> int:
+        """Rewrite tags stored as typed ("#Python") normalized, returns how many persons changed"""
+        requests = []
+        changed = 0
+        async for person_dict in self.collection.find(
+            {**self.scope, "tags.0": {"$exists": True}}, {"tags": 1}
+        ):
+            tags = normalize_tags(person_dict["tags"])
+            if tags != person_dict["tags"]:
+                requests.append(UpdateOne({"_id": person_dict["_id"]}, {"$set": {"tags": tags}}))
+            if len(requests) >= batch_size:
+                changed += (
+                    await self.collection.bulk_write(requests, ordered=False)
+                ).modified_count
+                requests = []
+        if requests:
+            changed += (await self.collection.bulk_write(requests, ordered=False)).modified_count
+        if changed:
+            await self._bump_roster_version()
+            if self.cache is not None:
+                self.cache.invalidate()
+            self.search_index.invalidate()
+            self.fair_index.invalidate()
+        return changed
+
+    async def rebuild_tag_counts(self) -> int:
+        """Recount the tags from the persons, after a migration or to fix counts that drifted"""
+        # Grouped by chat too: the deployment-wide service recounts every roster of the chat scope
+        pipeline = [
+            {"$match": self.scope},
+            {"$unwind": "$tags"},
+            {"$group": {"_id": {"chat_id": "$chat_id", "tag": "$tags"}, "count": {"$sum": 1}}},
+        ]
+        tags = {}
+        async for group in self.collection.aggregate(pipeline):
+            chat_id, tag = group["_id"].get("chat_id"), group["_id"]["tag"]
+            document = {"tag": tag, "count": group["count"]}
+            if chat_id is not None:
+                document["chat_id"] = chat_id
+            tags[self._tag_id(tag, chat_id)] = document
+        if tags:
+            await self.tags.bulk_write(
+                [
+                    ReplaceOne({"_id": tag_id}, document, upsert=True)
+                    for tag_id, document in tags.items()
+                ],
+                ordered=False,
+            )
+        await self.tags.delete_many({**self.scope, "_id": {"$nin": list(tags)}})
+        # The counts changed without a version bump
+        for roster in [self, *self._rosters.values()]:
+            roster.search_index.invalidate()
+        logger.info(f"Tag registry rebuilt: {len(tags)} tags")
+        return len(tags)
+
+    async def next_round_number(self) -> int:
+        counter = await self.counters.find_one_and_update(
+            {"_id": self._counter_id},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["value"]
+
+    async def get_round_number(self) -> int:
+        """Number of the latest coffee round, 0 before the first one"""
+        counter = await self.counters.find_one({"_id": self._counter_id})
+        return counter["value"] if counter else 0
+
+    async def load_pair_history(self, usernames: List[str], since_round: int) -> PairHistory:
+        """Load who met whom after since_round among the given persons, in one covered query"""
+        history = PairHistory(usernames)
+        cursor = self.pair_history.find(
+            {**self.scope, "round": {"$gt": since_round}}, {"user_a": 1, "user_b": 1, "_id": 0}
+        )
+        async for pair in cursor:
+            history.add(pair["user_a"], pair["user_b"])
+        return history
+
+    async def get_recent_partners(self, username: str, since_round: int) -> List[str]:
+        """Get everyone the person met after since_round"""
+        cursor = self.pair_history.find(
+            {
+                **self.scope,
+                "$or": [{"user_a": username}, {"user_b": username}],
+                "round": {"$gt": since_round},
+            },
+            {"user_a": 1, "user_b": 1, "_id": 0},
+        )
+        return [
+            pair["user_b"] if pair["user_a"] == username else pair["user_a"]
+            async for pair in cursor
+        ]
+
+    async def save_round(
+        self, round_number: int, groups: List[List[str]], tags: Optional[List[str]] = None
+    ):
+        """Store all groups of a round and record every pair in them in the pair history"""
+        if not groups:
+            return
+        now = datetime.utcnow()
+        await self.rounds.insert_many(
+            [
+                {
+                    **self.scope,
+                    "round": round_number,
+                    "tags": tags or [],
+                    "usernames": group,
+                    "created_at": now,
+                }
+                for group in groups
+            ],
+            ordered=False,
+        )
+
+        requests = []
+        for group in groups:
+            for i, first in enumerate(group):
+                for second in group[i + 1 :]:
+                    user_a, user_b = canonical_pair(first, second)
+                    requests.append(
+                        UpdateOne(
+                            {**self.scope, "user_a": user_a, "user_b": user_b},
+                            {"$max": {"round": round_number}},
+                            upsert=True,
+                        )
+                    )
+        await self.pair_history.bulk_write(requests, ordered=False)
+
+    async def set_user_id(self, username: str, user_id: int) -> bool:
+        """Remember the Telegram user id of a username in every roster, False if not in this one"""
+        await self.users.update_one({"_id": username}, {"$set": {"user_id": user_id}}, upsert=True)
+        result = await self.collection.update_one(
+            {**self.scope, "username": username}, {"$set": {"user_id": user_id}}
+        )
+        if result.matched_count and self.cache is not None:
+            person = self.cache.get_person(username)
+            if person is not None:
+                person.user_id = user_id
+        return result.matched_count > 0
+
+    async def get_user_ids(self, usernames: List[str]) -> Dict[str, int]:
+        """Map usernames to Telegram user ids, persons who never started the bot are left out"""
+        # A user starts the bot in a private chat, so the ids are kept apart from the rosters
+        cursor = self.users.find({"_id": {"$in": usernames}})
+        return {user["_id"]: user["user_id"] async for user in cursor}
+
+    async def enqueue_deliveries(self, round_number: int, messages: Dict[int, str]) -> int:
+        """Store round notifications (chat id -> text) as pending, returns how many are new"""
+        if not messages:
+            return 0
+        now = datetime.utcnow()
+        documents = [
+            {
+                "roster_chat_id": self.chat_id,
+                "round": round_number,
+                "chat_id": chat_id,
+                "text": text,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now,
+            }
+            for chat_id, text in messages.items()
+        ]
+        try:
+            result = await self.deliveries.insert_many(documents, ordered=False)
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            # Already enqueued before a restart
+            return e.details["nInserted"]
+
+    async def push_update(self, update_id: int, chat_key: int, update: dict) -> bool:
+        """Queue a received update for the workers, False if it's already queued (a redelivery)"""
+        try:
+            await self.update_queue.insert_one(
+                {
+                    "_id": update_id,
+                    "chat_key": chat_key,
+                    "update": update,
+                    # Available right away
+                    "lease_until": datetime.utcnow(),
+                }
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def lease_updates(
+        self, worker: int, workers: int, limit: int, lease_seconds: float
+    ) -> List[dict]:
+        """Take up to limit of the oldest available updates of the worker's chats, oldest first
+
+        A worker owns the chats with chat_key % workers == worker, so taking them in update_id
+        order keeps every chat's updates in the order Telegram sent them. They are leased in one
+        update under a lease token and read back by it.
+        """
+        now = datetime.utcnow()
+        available = {"chat_key": {"$mod": [workers, worker]}, "lease_until": {"$lte": now}}
+        cursor = self.update_queue.find(available, {"_id": 1}).sort("_id", 1).limit(limit)
+        ids = [item["_id"] async for item in cursor]
+        if not ids:
+            return []
+        lease = ObjectId()
+        await self.update_queue.update_many(
+            {"_id": {"$in": ids}, **available},
+            {"$set": {"lease_until": now + timedelta(seconds=lease_seconds), "lease": lease}},
+        )
+        cursor = self.update_queue.find({"_id": {"$in": ids}, "lease": lease}).sort("_id", 1)
+        return await cursor.to_list(length=limit)
+
+    async def release_updates(self, worker: int, workers: int) -> int:
+        """Make the leased updates of the worker's chats available again - on restart, for order"""
+        result = await self.update_queue.update_many(
+            {"chat_key": {"$mod": [workers, worker]}}, {"$set": {"lease_until": datetime.utcnow()}}
+        )
+        return result.modified_count
+
+    async def ack_update(self, update_id: int) -> None:
+        await self.update_queue.delete_one({"_id": update_id})
+
+    async def acquire_lease(self, name: str, holder: str, seconds: float) -> bool:
+        """Take or renew the named lease for seconds, False while another holder's is valid"""
+        now = datetime.utcnow()
+        try:
+            # Matches the lease if it's ours or expired, else the upsert collides with its _id
+            await self.leases.update_one(
+                {"_id": name, "$or": [{"holder": holder}, {"lease_until": {"$lte": now}}]},
+                {"$set": {"holder": holder, "lease_until": now + timedelta(seconds=seconds)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self.leases.delete_one({"_id": name, "holder": holder})
+
+    async def claim_deliveries(self, limit: int = 500, lease_seconds: float = 300) -> List[dict]:
+        """Take up to limit of the due deliveries for sending, oldest first
+
+        A claimed delivery is "sending" with its next attempt at the end of the lease: senders
+        overlapping in time skip it, and once a crashed sender's lease is over it's due again.
+        """
+        now = datetime.utcnow()
+        due = {"status": {"$in": ["pending", "sending"]}, "next_attempt_at": {"$lte": now}}
+        cursor = self.deliveries.find(due, {"_id": 1}).sort("next_attempt_at", 1).limit(limit)
+        ids = [delivery["_id"] async for delivery in cursor]
+        if not ids:
+            return []
+        # Claims the ones still due, another sender may have taken some since they were found
+        claim = ObjectId()
+        await self.deliveries.update_many(
+            {"_id": {"$in": ids}, **due},
+            {
+                "$set": {
+                    "status": "sending",
+                    "claim": claim,
+                    "next_attempt_at": now + timedelta(seconds=lease_seconds),
+                }
+            },
+        )
+        claimed = {
+            delivery["_id"]: delivery
+            async for delivery in self.deliveries.find({"_id": {"$in": ids}, "claim": claim})
+        }
+        return [claimed[delivery_id] for delivery_id in ids if delivery_id in claimed]
+
+    async def update_delivery(self, delivery_id, status: str, **fields) -> None:
+        await self.deliveries.update_one(
+            {"_id": delivery_id}, {"$set": {"status": status, **fields}}
+        )
@@ -0,0 +1,189 @@
+import asyncio
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from loguru import logger
+
+from .storage import Storage
+
+
+class RateLimiter:
+    """Token bucket shared by concurrent senders"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters queue up on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while - Telegram asked us to back off"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Start refilling from empty once the pause is over
+        self._tokens = 0
+        self._updated_at = self._paused_until
+
+
+class DeliveryService:
+    """Sends round notifications from the deliveries collection within Telegram limits
+
+    Progress is stored per message, so after a restart only the pending ones are sent
+    (a message that was in flight during a crash may be sent twice, stop() lets it finish).
+    Each batch is claimed for claim_seconds, so another sender never picks it up meanwhile;
+    the claims of a sender that crashed run out and its messages are sent by the next one.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        db_service: Storage,
+        rate: float = 25,
+        per_chat_interval: float = 1.0,
+        workers: int = 8,
+        max_attempts: int = 5,
+        claim_seconds: float = 300,
+    ):
+        self.bot = bot
+        self.db_service = db_service
+        # Telegram allows ~30 messages per second overall, stay a bit below
+        self.limiter = RateLimiter(rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.claim_seconds = claim_seconds
+        self._chat_next_send: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def enqueue(
+        self, round_number: int, messages: Dict[int, str], roster: Optional[Storage] = None
+    ) -> int:
+        """Store the notifications of a round - of the roster's own rounds, which are numbered per roster"""
+        count = await (roster or self.db_service).enqueue_deliveries(round_number, messages)
+        self._wakeup.set()
+        return count
+
+    def start(self) -> None:
+        """Start sending, including whatever was left pending before a restart"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 0) -> None:
+        """Stop sending: the messages being sent get up to timeout seconds, the queued ones stay pending"""
+        if self._task is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            done, _ = await asyncio.wait([self._task], timeout=timeout)
+            if not done:
+                logger.warning(f"Notifications still being sent after {timeout:g}s are cancelled")
+                self._task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await self._task
+            self._task = None
+
+    async def run(self) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        stopping = asyncio.create_task(self._stopping.wait())
+        try:
+            while not self._stopping.is_set():
+                deliveries = await self.db_service.claim_deliveries(lease_seconds=self.claim_seconds)
+                if not deliveries:
+                    self._wakeup.clear()
+                    try:
+                        # Retries become due without a wakeup, so poll once in a while
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=30)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                for delivery in deliveries:
+                    queue.put_nowait(delivery)
+                # A batch is finished before the next one is read, so nothing is picked twice
+                joined = asyncio.create_task(queue.join())
+                await asyncio.wait([joined, stopping], return_when=asyncio.FIRST_COMPLETED)
+                joined.cancel()
+
+            # Stopping: the rest of the batch is pending again, the workers finish what they are sending
+            unsent = []
+            while not queue.empty():
+                unsent.append(queue.get_nowait())
+                queue.task_done()
+            for delivery in unsent:
+                await self.db_service.update_delivery(delivery["_id"], "pending", next_attempt_at=datetime.utcnow())
+            for _ in workers:
+                queue.put_nowait(None)
+            await asyncio.gather(*workers)
+        finally:
+            stopping.cancel()
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            delivery = await queue.get()
+            if delivery is None:
+                return
+            try:
+                await self._send(delivery)
+            except Exception as e:
+                logger.exception(f"Delivery {delivery['_id']} failed: {e}")
+            finally:
+                queue.task_done()
+
+    async def _wait_for_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        send_at = max(now, self._chat_next_send.get(chat_id, 0))
+        self._chat_next_send[chat_id] = send_at + self.per_chat_interval
+        if len(self._chat_next_send) > 10_000:
+            self._chat_next_send = {key: value for key, value in self._chat_next_send.items() if value > now}
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+    async def _send(self, delivery: dict) -> None:
+        while True:
+            await self._wait_for_chat(delivery["chat_id"])
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(delivery["chat_id"], delivery["text"])
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control, pausing deliveries for {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+                continue
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Blocked the bot, deleted account etc. - retrying won't help
+                await self.db_service.update_delivery(delivery["_id"], "failed", error=str(e))
+                return
+            except Exception as e:
+                attempts = delivery["attempts"] + 1
+                if attempts >= self.max_attempts:
+                    await self.db_service.update_delivery(delivery["_id"], "failed", attempts=attempts, error=str(e))
+                else:
+                    retry_at = datetime.utcnow() + timedelta(seconds=2 ** attempts)
+                    await self.db_service.update_delivery(
+                        delivery["_id"], "pending", attempts=attempts, next_attempt_at=retry_at, error=str(e)
+                    )
+                return
+            await self.db_service.update_delivery(delivery["_id"], "sent", sent_at=datetime.utcnow())
+            return
@@ -0,0 +1,244 @@
+import random
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+from ..models.person import PersonRecord
+
+# Weighted draws rejected for not matching before the candidates are weighed one by one
+FAIR_DRAW_ATTEMPTS = 32
+# Draws landing on the residue of removed persons, retried before deciding nobody is left
+RESIDUE_DRAW_ATTEMPTS = 8
+
+
+class FenwickTree:
+    """Prefix sums over a growable array, O(log n) updates"""
+
+    def __init__(self, values: Optional[List[float]] = None):
+        values = values or []
+        # 1-based, tree[0] is unused
+        self.tree = [0.0] + list(values)
+        # O(n) build: push every node into its parent
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self) -> int:
+        return len(self.tree) - 1
+
+    def add(self, index: int, delta: float) -> None:
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self) -> float:
+        result = 0.0
+        i = len(self)
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+
+
+class FairSampler:
+    """Draws usernames with probability proportional to priority * seconds since last picked
+
+    The weight of a person at time now is priority * (now - picked_at), linear in now, so
+    the sum over any range is now * sum(priority) - sum(priority * picked_at). Two Fenwick
+    trees hold these two sums: weights keep growing with time without any updates, and a
+    draw is a single O(log n) descent. (An alias table would need the weights frozen.)
+    Times are seconds relative to the sampler creation to keep the float sums precise.
+    """
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+        self._origin = datetime.utcnow()
+        self._slots: Dict[str, int] = {}
+        self._usernames: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._priority: List[float] = []
+        self._weighted_time: List[float] = []
+        self._priority_tree = FenwickTree()
+        self._weighted_time_tree = FenwickTree()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _seconds(self, moment: datetime) -> float:
+        return (moment - self._origin).total_seconds()
+
+    def set(self, username: str, priority: float, picked_at: datetime) -> None:
+        """Add a person or update their weight, picked_at is the last pick (or when they joined)"""
+        # A timestamp from a replica with a clock ahead must not make the weight negative
+        picked_at = min(picked_at, datetime.utcnow())
+        priority = max(priority, 0.0)
+        weighted_time = priority * self._seconds(picked_at)
+
+        slot = self._slots.get(username)
+        if slot is None:
+            slot = self._free.pop() if self._free else self._grow()
+            self._slots[username] = slot
+            self._usernames[slot] = username
+        self._priority_tree.add(slot, priority - self._priority[slot])
+        self._weighted_time_tree.add(slot, weighted_time - self._weighted_time[slot])
+        self._priority[slot] = priority
+        self._weighted_time[slot] = weighted_time
+
+    def remove(self, username: str) -> None:
+        slot = self._slots.pop(username, None)
+        if slot is None:
+            return
+        self._priority_tree.add(slot, -self._priority[slot])
+        self._weighted_time_tree.add(slot, -self._weighted_time[slot])
+        self._priority[slot] = self._weighted_time[slot] = 0.0
+        self._usernames[slot] = None
+        self._free.append(slot)
+
+    def _grow(self) -> int:
+        """Double the capacity (rebuilding the trees in O(n)), returns a free slot"""
+        size = len(self._usernames)
+        new_size = max(16, size * 2)
+        self._usernames += [None] * (new_size - size)
+        self._priority += [0.0] * (new_size - size)
+        self._weighted_time += [0.0] * (new_size - size)
+        self._priority_tree = FenwickTree(self._priority)
+        self._weighted_time_tree = FenwickTree(self._weighted_time)
+        self._free += range(new_size - 1, size, -1)
+        return size
+
+    def weight(self, username: str, now: Optional[datetime] = None) -> float:
+        slot = self._slots.get(username)
+        if slot is None:
+            return 0.0
+        now_seconds = self._seconds(now or datetime.utcnow())
+        return self._priority[slot] * now_seconds - self._weighted_time[slot]
+
+    def sample(self, now: Optional[datetime] = None) -> Optional[str]:
+        """One weighted draw, None if there's nobody with a positive weight"""
+        now_seconds = self._seconds(now or datetime.utcnow())
+        priority_tree = self._priority_tree.tree
+        weighted_time_tree = self._weighted_time_tree.tree
+        size = len(self._priority_tree)
+
+        total = now_seconds * self._priority_tree.total() - self._weighted_time_tree.total()
+        if total <= 0:
+            return None
+        for _ in range(RESIDUE_DRAW_ATTEMPTS):
+            # Walk down the implicit tree: skip every node whose whole range sums below the target
+            target = self.rng.random() * total
+            position = 0
+            step = 1 << (size.bit_length() - 1) if size else 0
+            while step:
+                node = position + step
+                if node <= size:
+                    node_weight = now_seconds * priority_tree[node] - weighted_time_tree[node]
+                    if node_weight <= target:
+                        position = node
+                        target -= node_weight
+                step >>= 1
+            # The trees keep the float residue of every removal, so a draw can land past the end or
+            # on an empty slot - a slot's own weight is exact, draw again instead of searching
+            if position < size and self._usernames[position] is not None:
+                if self._priority[position] * now_seconds > self._weighted_time[position]:
+                    return self._usernames[position]
+        return None
+
+    def sample_matching(
+        self, matches: Callable[[str], bool], candidates: Callable[[], Iterable[str]], now: Optional[datetime] = None
+    ) -> Optional[str]:
+        """One weighted draw among the usernames that match, candidates() lists a superset of them
+
+        Rejection keeps the draw weighted among the matching ones, and is cheap unless they are rare.
+        """
+        now = now or datetime.utcnow()
+        for _ in range(FAIR_DRAW_ATTEMPTS):
+            username = self.sample(now)
+            if username is None:
+                return None
+            if matches(username):
+                return username
+
+        matching = [username for username in candidates() if matches(username)]
+        weights = [self.weight(username, now) for username in matching]
+        if not matching or sum(weights) <= 0:
+            return None
+        return self.rng.choices(matching, weights)[0]
+
+
+def fair_picked_at(person: PersonRecord) -> datetime:
+    """When the wait of a person started: the last pick, or when they joined if never picked"""
+    return person.last_picked_at or person.created_at or datetime.utcnow()
+
+
+class FairIndex:
+    """The fair draws of a roster the person cache doesn't hold: a FairSampler and the persons in it
+
+    Loaded with one scan of the roster, then kept up to date by the storage's own writes.
+    version is the roster version it's up to date with, so writes made elsewhere show up
+    as a newer one. Picks and priorities don't bump the version: a pick made elsewhere is
+    caught by the compare-and-set of the next pick of that person.
+    """
+
+    def __init__(self):
+        self._persons: Dict[str, PersonRecord] = {}
+        self._sampler = FairSampler()
+        # The roster version the index is up to date with, None until it's loaded
+        self.version: Optional[int] = None
+        # time.monotonic() of the last version check
+        self.checked_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self._persons)
+
+    def load(self, persons: Iterable[PersonRecord], version: int) -> None:
+        self.invalidate()
+        for person in persons:
+            self._set(person)
+        self.version = version
+
+    def invalidate(self) -> None:
+        """Drop the contents, the storage loads them again on the next fair pick"""
+        self._persons.clear()
+        self._sampler = FairSampler()
+        self.version = None
+
+    # region write-through
+
+    def upsert(self, person: PersonRecord) -> None:
+        """A person changed by a write that doesn't bump the roster version: a pick or a priority"""
+        if self.version is not None:
+            self._set(person)
+
+    def written(self, persons: Iterable[PersonRecord] = (), removed: Iterable[str] = ()) -> None:
+        """The persons added, changed or removed by one roster write (one version bump)"""
+        if self.version is None:
+            return
+        for person in persons:
+            self._set(person)
+        for username in removed:
+            self.remove(username)
+        self.version += 1
+
+    def remove(self, username: str) -> None:
+        if self._persons.pop(username, None) is not None:
+            self._sampler.remove(username)
+
+    def _set(self, person: PersonRecord) -> None:
+        self._persons[person.username] = person
+        self._sampler.set(person.username, person.priority, fair_picked_at(person))
+
+    # endregion write-through
+
+    def draw(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None, now: Optional[datetime] = None
+    ) -> Optional[PersonRecord]:
+        """Random person having any of the (normalized) tags, weighted by priority * time since last picked"""
+        excluded = set(exclude or ())
+        tag_set = set(tags or ())
+
+        def matches(username: str) -> bool:
+            return username not in excluded and (not tag_set or not tag_set.isdisjoint(self._persons[username].tags))
+
+        username = self._sampler.sample_matching(matches, lambda: self._persons, now)
+        return self._persons[username] if username is not None else None
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import socket
+import uuid
+from contextlib import suppress
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+
+from .storage import Storage
+
+
+class LeaderLease:
+    """Runs jobs in one instance of a deployment at a time: the one holding a database lease
+
+    Every replica runs one. The holder renews the lease every third of its length, the others
+    try to take it and get it once the holder stops renewing - stopped, crashed or cut off from
+    the database. An instance that fails to renew stops its jobs before the lease runs out.
+    """
+
+    def __init__(
+        self,
+        db_service: Storage,
+        name: str,
+        on_acquired: Callable[[], Awaitable[None]],
+        on_lost: Callable[[], Awaitable[None]],
+        seconds: float = 30.0,
+    ):
+        self.db_service = db_service
+        self.name = name
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.seconds = seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> bool:
+        """Stop renewing, returns whether the lease is held - release() it once the jobs stopped"""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        return self.held
+
+    async def release(self) -> None:
+        """Let another instance take over right away instead of once the lease runs out"""
+        if self.held:
+            self.held = False
+            await self.db_service.release_lease(self.name, self.holder)
+
+    async def run(self) -> None:
+        """Renew every third of the lease length - the first renew() is awaited by the caller"""
+        while True:
+            await asyncio.sleep(self.seconds / 3)
+            await self.renew()
+
+    async def renew(self) -> bool:
+        """Take or renew the lease and start or stop the jobs to match, returns whether it's held"""
+        try:
+            acquired = await self.db_service.acquire_lease(self.name, self.holder, self.seconds)
+        except Exception as e:
+            # Another instance takes over once the lease runs out, so stop before it does
+            logger.warning(f"Couldn't renew the {self.name} lease: {e}")
+            acquired = False
+        if acquired and not self.held:
+            self.held = True
+            logger.info(f"Took the {self.name} lease as {self.holder}")
+            await self.on_acquired()
+        elif not acquired and self.held:
+            self.held = False
+            logger.warning(f"Lost the {self.name} lease, stopping its jobs")
+            await self.on_lost()
+        return self.held
@@ -0,0 +1,91 @@
+import random
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from .storage import Storage
+from .pair_history import PairHistory
+
+# How many of the next shuffled candidates are checked for someone not met recently
+LOOKAHEAD = 16
+
+
+@dataclass
+class MatchRound:
+    number: int
+    groups: List[List[str]] = field(default_factory=list)
+    # Groups where nobody new could be found within the lookahead
+    repeats: int = 0
+
+
+def make_pairs(history: PairHistory, rng: Optional[random.Random] = None) -> MatchRound:
+    """Split the history's pool into pairs (plus one trio for an odd count) avoiding recent pairs
+
+    Greedy over a shuffled pool: each person takes the first of the next LOOKAHEAD
+    candidates they haven't met recently, so the whole pass is O(n).
+    """
+    rng = rng or random.Random()
+    pool = list(range(len(history.usernames)))
+    rng.shuffle(pool)
+
+    def is_new(first: int, second: int) -> bool:
+        return not history.has_met_ids(first, second)
+
+    result = MatchRound(number=0)
+    while len(pool) >= 2:
+        first = pool.pop()
+        for offset in range(1, min(LOOKAHEAD, len(pool)) + 1):
+            if is_new(first, pool[-offset]):
+                # Popping near the end of the list only shifts the few elements after it
+                result.groups.append([first, pool.pop(-offset)])
+                break
+        else:
+            second = pool.pop()
+            # Nobody new left nearby (typical for the last few people) - try to swap partners
+            # with one of the latest groups
+            for group in reversed(result.groups[-LOOKAHEAD:]):
+                left, right = group
+                if is_new(first, left) and is_new(second, right):
+                    group[0], second = second, left
+                    break
+                if is_new(first, right) and is_new(second, left):
+                    group[1], second = second, right
+                    break
+            else:
+                result.repeats += 1
+            result.groups.append([first, second])
+
+    if pool and result.groups:
+        result.groups[-1].append(pool.pop())
+    result.groups = [[history.usernames[i] for i in group] for group in result.groups]
+    return result
+
+
+class MatchingService:
+    def __init__(self, db_service: Storage, history_rounds: int = 4):
+        self.db_service = db_service
+        self.history_rounds = history_rounds
+
+    async def for_chat(self, chat_id: int) -> "MatchingService":
+        """Matching within the roster of a chat, see Storage.for_chat"""
+        db_service = await self.db_service.for_chat(chat_id)
+        if db_service is self.db_service:
+            return self
+        return MatchingService(db_service, self.history_rounds)
+
+    async def create_round(self, tags: Optional[List[str]] = None) -> MatchRound:
+        """Pair everyone having ALL of the tags (or everyone) and store the round"""
+        usernames = await self.db_service.get_usernames(tags)
+        number = await self.db_service.next_round_number()
+        history = await self.db_service.load_pair_history(usernames, since_round=number - self.history_rounds)
+
+        match_round = make_pairs(history)
+        match_round.number = number
+        await self.db_service.save_round(number, match_round.groups, tags)
+        return match_round
+
+    async def get_recent_partners(self, username: str, round_number: Optional[int] = None) -> List[str]:
+        """Persons the user was grouped with in the last history_rounds rounds (up to round_number, the latest)"""
+        if round_number is None:
+            round_number = await self.db_service.get_round_number()
+        since_round = round_number - self.history_rounds
+        return await self.db_service.get_recent_partners(username, since_round)
@@ -0,0 +1,335 @@
+import asyncio
+import bisect
+import pickle
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware, Router
+from aiogram.filters import Command
+from aiogram.types import TelegramObject, Update
+from pymongo import monitoring
+
+# Upper bounds of the latency buckets, seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with fixed buckets"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram") -> None:
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside its bucket, like histogram_quantile()"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """The metrics of a process
+
+    MongoDB commands are observed from the threads of the driver, so changes go through
+    observe() and count() and the readers take the lock too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.command_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.command_errors: Dict[str, int] = defaultdict(int)
+        self.in_flight = 0
+        # Updates skipped before reaching the handlers, by reason (see throttling.py)
+        self.updates_dropped: Dict[str, int] = defaultdict(int)
+        # Rendered listings served from the response cache or rendered again, by (command, hit/miss)
+        self.response_cache_requests: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.mongo_latency: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.mongo_failures: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def observe(self, histograms: str, key: Any, seconds: float) -> None:
+        """Add a duration to a histogram, e.g. observe("mongo_latency", ("persons", "find"), 0.002)"""
+        with self._lock:
+            getattr(self, histograms)[key].observe(seconds)
+
+    def count(self, counters: str, key: Any, amount: int = 1) -> None:
+        """Increment a counter, e.g. count("updates_dropped", "duplicate")"""
+        with self._lock:
+            getattr(self, counters)[key] += amount
+
+    def snapshot(self) -> bytes:
+        """The registry pickled as of now, for report_metrics"""
+        with self._lock:
+            return pickle.dumps(self)
+
+    def merge(self, other: "MetricsRegistry") -> None:
+        """Add the counts of another registry (of a worker process) to this one"""
+        with self._lock, other._lock:
+            for name in ("command_latency", "mongo_latency"):
+                histograms = getattr(self, name)
+                for key, histogram in getattr(other, name).items():
+                    histograms[key].merge(histogram)
+            for name in ("command_errors", "updates_dropped", "response_cache_requests", "mongo_failures"):
+                counters = getattr(self, name)
+                for key, value in getattr(other, name).items():
+                    counters[key] += value
+            self.in_flight += other.in_flight
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            return self._render_prometheus()
+
+    def _render_prometheus(self) -> str:
+        lines = []
+        lines += _render_histograms(
+            "bot_command_duration_seconds", "Update handling time by command", self.command_latency, ("command",)
+        )
+        lines += _render_counters(
+            "bot_command_errors_total", "Updates whose handler raised", self.command_errors, ("command",)
+        )
+        lines += [
+            "# HELP bot_updates_in_flight Updates being handled right now",
+            "# TYPE bot_updates_in_flight gauge",
+            f"bot_updates_in_flight {self.in_flight}",
+        ]
+        lines += _render_counters(
+            "bot_updates_dropped_total", "Updates dropped as duplicate or throttled", self.updates_dropped, ("reason",)
+        )
+        lines += _render_counters(
+            "bot_response_cache_requests_total",
+            "Listings served from the response cache (hit) or rendered (miss)",
+            self.response_cache_requests,
+            ("command", "result"),
+        )
+        lines += _render_histograms(
+            "mongo_command_duration_seconds",
+            "MongoDB command time by collection and command",
+            self.mongo_latency,
+            ("collection", "command"),
+        )
+        lines += _render_counters(
+            "mongo_command_failures_total", "Failed MongoDB commands", self.mongo_failures, ("collection", "command")
+        )
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Human-readable p50/p95/p99 lines, slowest first"""
+        with self._lock:
+            return self._summary()
+
+    def _summary(self) -> List[str]:
+        lines = [f"In flight: {self.in_flight}"]
+        if self.updates_dropped:
+            dropped = ", ".join(f"{reason}={count}" for reason, count in sorted(self.updates_dropped.items()))
+            lines.append(f"Dropped: {dropped}")
+        for command in sorted({command for command, _ in self.response_cache_requests}):
+            hits = self.response_cache_requests.get((command, "hit"), 0)
+            misses = self.response_cache_requests.get((command, "miss"), 0)
+            lines.append(f"Response cache {command}: {hits} hits, {misses} misses")
+        for title, histograms, errors in (
+            ("Commands", self.command_latency, self.command_errors),
+            ("MongoDB", self.mongo_latency, self.mongo_failures),
+        ):
+            lines.append(f"\n{title}:")
+            for key, histogram in sorted(histograms.items(), key=lambda item: -item[1].quantile(0.99)):
+                name = "/".join(key) if isinstance(key, tuple) else key
+                lines.append(
+                    f"{name}: n={histogram.count} p50={histogram.quantile(0.5) * 1000:.1f}ms "
+                    f"p95={histogram.quantile(0.95) * 1000:.1f}ms p99={histogram.quantile(0.99) * 1000:.1f}ms "
+                    f"errors={errors.get(key, 0)}"
+                )
+        return lines
+
+
+def _escape(value: Any) -> str:
+    """A label value as the exposition format wants it: backslash, double quote and newline escaped"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values) -> str:
+    values = values if isinstance(values, tuple) else (values,)
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _render_histograms(name: str, help_text: str, histograms: Dict, label_names: Tuple[str, ...]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        labels = _labels(label_names, key)
+        cumulative = 0
+        for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def _render_counters(name: str, help_text: str, counters: Dict, label_names: Tuple[str, ...]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for key, value in sorted(counters.items()):
+        lines.append(f"{name}{{{_labels(label_names, key)}}} {value}")
+    return lines
+
+
+# Process-wide registry, like the default one of prometheus_client
+metrics = MetricsRegistry()
+
+
+class WorkerMetrics:
+    """The registries of the worker processes, as last sent by report_metrics, for the ingress /metrics
+
+    Handlers run in the workers, so the ingress registry alone has no command metrics. Every
+    worker sends a pickled snapshot of its registry to the queue (a multiprocessing one shared
+    at spawn), a thread of the ingress keeps the last one of each worker.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._snapshots: Dict[int, MetricsRegistry] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._receive, name="worker-metrics", daemon=True)
+        self._thread.start()
+
+    def _receive(self) -> None:
+        while True:
+            worker, snapshot = self.queue.get()
+            self._snapshots[worker] = pickle.loads(snapshot)
+
+    def merged(self, registry: MetricsRegistry = metrics) -> MetricsRegistry:
+        """A registry adding up the given one (the ingress's own) and the last snapshot of every worker"""
+        total = MetricsRegistry()
+        for other in (registry, *list(self._snapshots.values())):
+            total.merge(other)
+        return total
+
+
+async def report_metrics(queue, worker: int, registry: MetricsRegistry = metrics, interval: float = 5.0) -> None:
+    """Worker side of WorkerMetrics: a snapshot every interval seconds, and a last one when cancelled"""
+    try:
+        while True:
+            # Pickled right here - the queue's feeder thread would read the dicts while they change
+            queue.put((worker, registry.snapshot()))
+            await asyncio.sleep(interval)
+    finally:
+        queue.put((worker, registry.snapshot()))
+
+
+def registered_commands(router: Router) -> Set[str]:
+    """The "/command" names the message handlers of the router and the routers it includes filter on"""
+    commands = set()
+    for sub_router in router.chain_tail:
+        for handler in sub_router.message.handlers:
+            for filter_object in handler.filters or ():
+                if isinstance(filter_object.callback, Command):
+                    commands.update(
+                        "/" + command.lower() for command in filter_object.callback.commands if isinstance(command, str)
+                    )
+    return commands
+
+
+def command_name(update: Update, commands: Optional[Set[str]] = None) -> str:
+    """Metric label for an update: the command for commands, the update type otherwise
+
+    Commands not in commands (when given) are all "other", so users can't create series by typing them.
+    """
+    message = update.message or update.edited_message
+    text = message and (message.text or message.caption)
+    if text and text.startswith("/"):
+        # "/list@my_bot tag" -> "/list"
+        name = text.split(maxsplit=1)[0].split("@", 1)[0].lower()
+        return name if commands is None or name in commands else "other"
+    return update.event_type
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Outer update middleware timing every update"""
+
+    def __init__(self, registry: MetricsRegistry = metrics, commands: Optional[Set[str]] = None):
+        self.registry = registry
+        # Read from the dispatcher on the first update, once every router is included
+        self.commands = commands
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.commands is None and "dispatcher" in data:
+            self.commands = registered_commands(data["dispatcher"])
+        name = command_name(event, self.commands) if isinstance(event, Update) else type(event).__name__
+        self.registry.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.count("command_errors", name)
+            raise
+        finally:
+            self.registry.observe("command_latency", name, time.perf_counter() - start)
+            self.registry.in_flight -= 1
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every MongoDB command, pass it to the client with event_listeners=[...]"""
+
+    def __init__(self, registry: MetricsRegistry = metrics):
+        self.registry = registry
+        # The collection is only known from the started event. Single dict operations are atomic,
+        # so the driver threads share it without a lock
+        self._collections: Dict[Tuple[int, Any], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        # getMore carries the cursor id under its name and the collection separately
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self._collections[(event.request_id, event.connection_id)] = (
+            collection if isinstance(collection, str) else event.database_name
+        )
+
+    def _pop_key(self, event) -> Tuple[str, str]:
+        collection: Optional[str] = self._collections.pop((event.request_id, event.connection_id), None)
+        return collection or event.database_name, event.command_name
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self.registry.observe("mongo_latency", self._pop_key(event), event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        key = self._pop_key(event)
+        self.registry.observe("mongo_latency", key, event.duration_micros / 1e6)
+        self.registry.count("mongo_failures", key)
@@ -0,0 +1,44 @@
+from typing import Iterable, List, Set, Tuple
+
+
+def canonical_pair(first: str, second: str) -> Tuple[str, str]:
+    """The (user_a, user_b) key a pair is stored under - ordered so both directions match"""
+    return (first, second) if first < second else (second, first)
+
+
+class PairHistory:
+    """Who met whom recently within a pool of persons
+
+    Persons are numbered by their position in the pool and every met pair is kept as a
+    single int (smaller id * pool size + larger id), so a check is one set lookup.
+    """
+
+    def __init__(self, usernames: Iterable[str]):
+        self.usernames: List[str] = list(usernames)
+        self.ids = {username: i for i, username in enumerate(self.usernames)}
+        self._pairs: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def _key(self, first_id: int, second_id: int) -> int:
+        if first_id > second_id:
+            first_id, second_id = second_id, first_id
+        return first_id * len(self.usernames) + second_id
+
+    def add(self, first: str, second: str) -> None:
+        """Record a meeting, pairs with someone outside of the pool are ignored"""
+        first_id = self.ids.get(first)
+        second_id = self.ids.get(second)
+        if first_id is not None and second_id is not None:
+            self._pairs.add(self._key(first_id, second_id))
+
+    def has_met_ids(self, first_id: int, second_id: int) -> bool:
+        return self._key(first_id, second_id) in self._pairs
+
+    def has_met(self, first: str, second: str) -> bool:
+        first_id = self.ids.get(first)
+        second_id = self.ids.get(second)
+        if first_id is None or second_id is None:
+            return False
+        return self.has_met_ids(first_id, second_id)
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+
+from .metrics import MetricsRegistry, metrics
+
+
+class ResponseCache:
+    """LRU cache of rendered listings: key -> the message chunks that were sent
+
+    Keys carry the roster version, so a write makes the old entries unreachable instead of
+    having to find and drop them - they just age out of the LRU.
+    """
+
+    def __init__(self, max_size: int = 256, max_chars: int = 1_000_000, registry: MetricsRegistry = metrics):
+        self.max_size = max_size
+        # Bigger listings are rendered on every call rather than pinned in memory
+        self.max_chars = max_chars
+        self.registry = registry
+        self._entries: "OrderedDict[Hashable, List[str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, command: str, key: Hashable) -> Optional[List[str]]:
+        chunks = self._entries.get(key)
+        if chunks is None:
+            self.registry.count("response_cache_requests", (command, "miss"))
+            return None
+        self._entries.move_to_end(key)
+        self.registry.count("response_cache_requests", (command, "hit"))
+        return chunks
+
+    def put(self, key: Hashable, chunks: List[str]) -> None:
+        if self.max_size <= 0 or sum(map(len, chunks)) > self.max_chars:
+            return
+        self._entries[key] = chunks
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,72 @@
+import csv
+import io
+import json
+from typing import AsyncIterable, AsyncIterator, Iterator, List, Tuple
+
+from ..models.person import PersonRecord
+
+ROSTER_FORMATS = ("csv", "json")
+JSON_ROSTER_ERROR = 'JSON roster must be a list of {"username": ..., "tags": [...]} objects'
+
+
+def split_tags(text: str) -> List[str]:
+    """Tags separated by spaces or commas"""
+    return text.replace(",", " ").split()
+
+
+def parse_roster(data: bytes, filename: str) -> Iterator[Tuple[str, List[str]]]:
+    """Parse an uploaded roster into (username, tags) rows
+
+    CSV: a username column and an optional tags column with space or comma separated tags,
+    the header row is optional. JSON: a list of {"username": ..., "tags": [...]} objects, where
+    tags can also be a string of tags separated the same way. Malformed rows raise ValueError,
+    a malformed CSV csv.Error.
+    """
+    if filename.lower().endswith(".json"):
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise ValueError(JSON_ROSTER_ERROR)
+        for i, row in enumerate(rows, 1):
+            if not isinstance(row, dict):
+                raise ValueError(f"Row {i}: {JSON_ROSTER_ERROR}")
+            username = str(row.get("username", "")).strip().lstrip("@")
+            if not username:
+                continue
+            tags = row.get("tags") or []
+            if isinstance(tags, str):
+                tags = split_tags(tags)
+            elif not isinstance(tags, list):
+                raise ValueError(f"Row {i}: tags must be a list or a string")
+            yield username, [str(tag) for tag in tags]
+        return
+
+    reader = csv.reader(io.StringIO(data.decode("utf-8-sig")))
+    for i, row in enumerate(reader):
+        if not row or not row[0].strip():
+            continue
+        if i == 0 and row[0].strip().lower() == "username":
+            continue
+        username = row[0].strip().lstrip("@")
+        yield username, split_tags(" ".join(row[1:]))
+
+
+async def dump_roster(persons: AsyncIterable[PersonRecord], fmt: str = "csv") -> AsyncIterator[str]:
+    """Serialize persons piece by piece, in a format parse_roster reads back"""
+    if fmt == "json":
+        yield "["
+        separator = "\n"
+        async for person in persons:
+            yield separator + json.dumps({"username": person.username, "tags": person.tags}, ensure_ascii=False)
+            separator = ",\n"
+        yield "\n]\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["username", "tags"])
+    async for person in persons:
+        writer.writerow([person.username, " ".join(person.tags)])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
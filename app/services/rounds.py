@@ -0,0 +1,70 @@
+from typing import List, Optional
+
+from aiogram import html
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from loguru import logger
+
+from .delivery import DeliveryService
+from .matching import MatchingService, MatchRound
+
+
+def format_round_message(match_round: MatchRound, partners: List[str]) -> str:
+    partners_str = ", ".join(html.bold("@" + username) for username in partners)
+    return (
+        f"☕ Random coffee round #{match_round.number}!\n"
+        f"This time you're meeting {partners_str}. Drop them a message to find a time."
+    )
+
+
+class RoundScheduler:
+    """Runs coffee rounds on cron schedules and notifies every participant by DM"""
+
+    def __init__(self, matching_service: MatchingService, delivery_service: DeliveryService, timezone: str = "UTC"):
+        self.matching_service = matching_service
+        self.delivery_service = delivery_service
+        self.scheduler = AsyncIOScheduler(timezone=timezone)
+
+    def add_schedule(self, cron: str, tags: Optional[List[str]] = None, chat_id: Optional[int] = None) -> None:
+        """Add a round for everyone (in the roster of the chat) having ALL of the tags, cron is a crontab expression"""
+        if chat_id is None and self.matching_service.db_service.roster_scope != "global":
+            raise ValueError(f"Coffee round schedule {cron} needs a chat_id with per-chat rosters")
+        self.scheduler.add_job(
+            self.run_round,
+            CronTrigger.from_crontab(cron, timezone=self.scheduler.timezone),
+            kwargs={"tags": tags or None, "chat_id": chat_id},
+            # A round missed while the bot was down is run once when it's back
+            coalesce=True,
+            misfire_grace_time=3600,
+            max_instances=1,
+        )
+
+    def start(self) -> None:
+        self.scheduler.start()
+
+    def shutdown(self) -> None:
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+
+    async def run_round(self, tags: Optional[List[str]] = None, chat_id: Optional[int] = None) -> MatchRound:
+        matching_service = self.matching_service
+        if chat_id is not None:
+            matching_service = await matching_service.for_chat(chat_id)
+        match_round = await matching_service.create_round(tags)
+
+        usernames = [username for group in match_round.groups for username in group]
+        user_ids = await matching_service.db_service.get_user_ids(usernames)
+        messages = {}
+        for group in match_round.groups:
+            for username in group:
+                if username in user_ids:
+                    partners = [partner for partner in group if partner != username]
+                    messages[user_ids[username]] = format_round_message(match_round, partners)
+
+        enqueued = await self.delivery_service.enqueue(match_round.number, messages, matching_service.db_service)
+        roster = f"chat {chat_id}, " if chat_id is not None else ""
+        logger.info(
+            f"Coffee round #{match_round.number} ({roster}tags: {tags or 'all'}): {len(match_round.groups)} groups, "
+            f"{enqueued} notifications enqueued, {len(usernames) - len(user_ids)} persons haven't started the bot"
+        )
+        return match_round
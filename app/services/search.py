@@ -0,0 +1,207 @@
+import heapq
+import math
+from collections import Counter, defaultdict
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Words whose trigram similarity to the query is below this aren't suggested
+SIMILARITY_THRESHOLD = 0.3
+# Tried first: the higher the threshold, the fewer and shorter postings give candidates
+SEARCH_TIERS = (0.5,)
+
+
+def trigrams(text: str) -> Set[str]:
+    """Trigrams of the casefolded text padded with two spaces: "bob" -> "  b", " bo", "bob", "ob ", "b  " """
+    padded = f"  {text.casefold()}  "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def best_similarity(size: int, n: int) -> float:
+    """The similarity a word of size trigrams can have at best to a query of n"""
+    return min(size, n) / max(size, n)
+
+
+class TrigramIndex:
+    """Words by their trigrams, looked up by similarity: shared trigrams / all trigrams of both words
+
+    A word of s trigrams is as similar as threshold to a query of n trigrams if they share
+    threshold * (n + s) / (1 + threshold) of them, so it must be in one of the query's rarest
+    trigrams - the fewer, the larger it is. The postings are split by word size, so the rarest
+    ones are picked per size and only the sizes that can still make the top are searched,
+    the ones that can be the most similar first: each match found raises the bar for the rest.
+    """
+
+    def __init__(self):
+        # trigram -> word size (in trigrams) -> words
+        self._postings: Dict[str, Dict[int, Set[str]]] = defaultdict(lambda: defaultdict(set))
+        self._sizes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._sizes
+
+    def add(self, word: str) -> None:
+        if word in self._sizes:
+            return
+        grams = trigrams(word)
+        self._sizes[word] = len(grams)
+        for gram in grams:
+            self._postings[gram][len(grams)].add(word)
+
+    def remove(self, word: str) -> None:
+        size = self._sizes.pop(word, None)
+        if size is None:
+            return
+        for gram in trigrams(word):
+            buckets = self._postings[gram]
+            buckets[size].discard(word)
+            if not buckets[size]:
+                del buckets[size]
+                if not buckets:
+                    del self._postings[gram]
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._sizes.clear()
+
+    def search(self, query: str, limit: int = 10, threshold: float = SIMILARITY_THRESHOLD) -> List[Tuple[str, float]]:
+        """Words at least threshold (> 0) similar to the query as (word, similarity), most similar first"""
+        grams = trigrams(query)
+        # Word size -> the postings of the query's trigrams having words of that size, rarest first
+        postings: Dict[int, List[Set[str]]] = defaultdict(list)
+        for gram in grams:
+            for size, words in self._postings.get(gram, {}).items():
+                postings[size].append(words)
+        for buckets in postings.values():
+            buckets.sort(key=len)
+        # limit words as similar as a higher threshold are the top ones: the words missed there are less similar
+        for tier in (*(tier for tier in SEARCH_TIERS if tier > threshold), threshold):
+            matches = self._search(postings, len(grams), limit, tier)
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def _search(
+        self, postings: Dict[int, List[Set[str]]], n: int, limit: int, threshold: float
+    ) -> List[Tuple[str, float]]:
+        # Sizes outside of these can't be similar enough (similarity <= size / n and n / size)
+        sizes = sorted(
+            (size for size in postings if threshold * n <= size <= n / threshold),
+            key=lambda size: -best_similarity(size, n),
+        )
+        matches = []
+        # The similarities of the top limit matches so far, the lowest one first
+        top: List[float] = []
+        for size in sizes:
+            if len(top) >= limit:
+                # The words of this size (and the rest) can't beat the top ones found already
+                if best_similarity(size, n) < top[0]:
+                    break
+                threshold = max(threshold, top[0])
+            for match in _search_size(postings[size], n, size, threshold):
+                matches.append(match)
+                if len(top) < limit:
+                    heapq.heappush(top, match[1])
+                else:
+                    heapq.heappushpop(top, match[1])
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit]
+
+
+def _search_size(buckets: List[Set[str]], n: int, size: int, threshold: float) -> List[Tuple[str, float]]:
+    """Words of size trigrams at least threshold similar to a query of n, from its postings of the size"""
+    need = math.ceil(threshold * (n + size) / (1 + threshold) - 1e-9)
+    # Missing n - need + 1 of the query's trigrams a word can't be similar enough, so it's counted
+    # from that many of the rarest ones - the ones without words of the size are the rarest - and
+    # the rest only add to the counts of the words found there
+    prefix = len(buckets) - (need - 1)
+    if prefix <= 0:
+        return []
+    shared = Counter(chain.from_iterable(buckets[:prefix]))
+    candidates = set(shared)
+    shared.update(chain.from_iterable(candidates & words for words in buckets[prefix:]))
+    return [(word, count / (n + size - count)) for word, count in shared.items() if count >= need]
+
+
+class SearchIndex:
+    """Usernames and the tag vocabulary of a roster, for /find and "did you mean" suggestions
+
+    Built by the storage from one scan of the usernames and the tag registry, then kept up to
+    date by the storage's own writes. Each write method mirrors one roster version bump, so
+    version tells whether writes made elsewhere (other processes) were missed.
+    """
+
+    def __init__(self):
+        self.usernames = TrigramIndex()
+        self.tags = TrigramIndex()
+        self._tag_counts: Dict[str, int] = {}
+        # The roster version the index is up to date with, None until it's built
+        self.version: Optional[int] = None
+
+    def load(self, usernames: Iterable[str], tag_counts: Iterable[Tuple[str, int]], version: int) -> None:
+        self.invalidate()
+        for username in usernames:
+            self.usernames.add(username)
+        self._count_tags((tag, count) for tag, count in tag_counts)
+        self.version = version
+
+    def invalidate(self) -> None:
+        """Drop the contents, the storage rebuilds them on the next search"""
+        self.usernames.clear()
+        self.tags.clear()
+        self._tag_counts.clear()
+        self.version = None
+
+    # region write-through
+
+    def add_person(self, username: str, tags: List[str]) -> None:
+        if self.version is None:
+            return
+        self.usernames.add(username)
+        self._count_tags((tag, 1) for tag in tags)
+        self.version += 1
+
+    def add_tags(self, tags: List[str]) -> None:
+        """Tags added to persons by one write, a tag once per person that got it"""
+        if self.version is None:
+            return
+        self._count_tags((tag, 1) for tag in tags)
+        self.version += 1
+
+    def remove_person(self, username: str, tags: List[str]) -> None:
+        if self.version is None:
+            return
+        self.usernames.remove(username)
+        self._count_tags((tag, -1) for tag in tags)
+        self.version += 1
+
+    def _count_tags(self, deltas: Iterable[Tuple[str, int]]) -> None:
+        for tag, delta in deltas:
+            count = self._tag_counts.get(tag, 0) + delta
+            if count > 0:
+                self._tag_counts[tag] = count
+                self.tags.add(tag)
+            else:
+                self._tag_counts.pop(tag, None)
+                self.tags.remove(tag)
+
+    # endregion write-through
+
+    def find_persons(self, query: str, limit: int = 10) -> List[str]:
+        return [username for username, _ in self.usernames.search(query.lstrip("@"), limit)]
+
+    def find_tags(self, query: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """Tags similar to the query with the number of persons having them"""
+        return [(tag, self._tag_counts[tag]) for tag, _ in self.tags.search(query, limit)]
+
+    def suggest_tags(self, tags: List[str]) -> Dict[str, str]:
+        """The closest known tag for each of the (normalized) tags nobody has"""
+        suggestions = {}
+        for tag in tags:
+            if tag not in self.tags:
+                matches = self.tags.search(tag, limit=1)
+                if matches:
+                    suggestions[tag] = matches[0][0]
+        return suggestions
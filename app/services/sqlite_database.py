@@ -0,0 +1,1231 @@
+import asyncio
+import copy
+import json
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+import aiosqlite
+from loguru import logger
+
+from .cache import PersonCache
+from .fair_sampler import FairIndex
+from .pair_history import PairHistory, canonical_pair
+from .search import SearchIndex
+from .storage import ROSTER_SCOPES, BulkUpsertResult, TagUpdate
+from ..models.person import Person, PersonRecord
+from ..utils import normalize_tags
+
+# Set on every connection
+CONNECTION_PRAGMAS = """
+PRAGMA foreign_keys = ON;
+-- Writers of other processes (worker mode) wait for the lock instead of failing right away
+PRAGMA busy_timeout = 5000;
+"""
+
+# Readers don't block the writer and the other way around. With synchronous = NORMAL a commit
+# is durable once checkpointed: a power loss may drop the last transactions, never corrupt the file.
+DATABASE_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+"""
+
+# Every roster lives in the same tables under its roster key: 0 for the global one, else the chat id
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS persons (
+    id INTEGER PRIMARY KEY,
+    roster INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    user_id INTEGER,
+    priority REAL NOT NULL DEFAULT 1.0,
+    last_picked_at INTEGER,
+    -- Lookups and writes by username, listings in username order
+    UNIQUE (roster, username)
+);
+
+-- A row per tag of a person, rowid keeps the order the tags were added in
+CREATE TABLE IF NOT EXISTS person_tags (
+    person_id INTEGER NOT NULL REFERENCES persons (id) ON DELETE CASCADE,
+    roster INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    UNIQUE (person_id, tag)
+);
+-- The tag queries ($in for /random, $all for /list_by_tags) only read this index
+CREATE INDEX IF NOT EXISTS person_tags_roster_tag ON person_tags (roster, tag, person_id);
+
+-- How many persons have each tag, kept up to date by the triggers below
+CREATE TABLE IF NOT EXISTS tag_counts (
+    roster INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (roster, tag)
+) WITHOUT ROWID;
+-- /tags lists the most popular tags first
+CREATE INDEX IF NOT EXISTS tag_counts_roster_count ON tag_counts (roster, count DESC);
+
+CREATE TRIGGER IF NOT EXISTS person_tags_count_insert AFTER INSERT ON person_tags BEGIN
+    INSERT INTO tag_counts (roster, tag, count) VALUES (NEW.roster, NEW.tag, 1)
+    ON CONFLICT (roster, tag) DO UPDATE SET count = count + 1;
+END;
+
+-- Also fired by the cascade when a person is deleted
+CREATE TRIGGER IF NOT EXISTS person_tags_count_delete AFTER DELETE ON person_tags BEGIN
+    UPDATE tag_counts SET count = count - 1 WHERE roster = OLD.roster AND tag = OLD.tag;
+END;
+
+-- A row per group of a coffee round
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    roster INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    usernames TEXT NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rounds_roster_round ON rounds (roster, round);
+
+-- A row per pair of persons who have met (user_a < user_b), with the last round they met in
+CREATE TABLE IF NOT EXISTS pair_history (
+    roster INTEGER NOT NULL,
+    user_a TEXT NOT NULL,
+    user_b TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    PRIMARY KEY (roster, user_a, user_b)
+) WITHOUT ROWID;
+-- Partners of a single user: user_a lookups use the primary key prefix
+CREATE INDEX IF NOT EXISTS pair_history_user_b ON pair_history (roster, user_b, round);
+-- Covers the whole "recent pairs" scan
+CREATE INDEX IF NOT EXISTS pair_history_round ON pair_history (roster, round, user_a, user_b);
+
+-- Round number counters and roster versions
+CREATE TABLE IF NOT EXISTS counters (
+    id TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Telegram user ids by username, shared by all rosters
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY,
+    roster_chat_id INTEGER,
+    round INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt_at INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    sent_at INTEGER,
+    error TEXT
+);
+-- A round of a roster notifies each chat at most once, also if enqueued again after a restart
+CREATE UNIQUE INDEX IF NOT EXISTS deliveries_round
+    ON deliveries (IFNULL(roster_chat_id, 0), round, chat_id);
+CREATE INDEX IF NOT EXISTS deliveries_pending ON deliveries (status, next_attempt_at);
+
+-- Updates received by the ingress process, waiting for a worker (see update_queue.py)
+CREATE TABLE IF NOT EXISTS update_queue (
+    update_id INTEGER PRIMARY KEY,
+    chat_key INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    lease_until INTEGER NOT NULL
+);
+-- Available updates: the leased ones are out of the lease_until range
+CREATE INDEX IF NOT EXISTS update_queue_available ON update_queue (lease_until, update_id);
+
+-- Named leases: the one instance of a deployment running rounds and deliveries holds one
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    lease_until INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Emptied by cleanup(), person_tags before persons and tag_counts after both, as the triggers count
+TABLES = (
+    "person_tags",
+    "persons",
+    "tag_counts",
+    "rounds",
+    "pair_history",
+    "counters",
+    "users",
+    "deliveries",
+    "update_queue",
+    "leases",
+)
+
+# Tags of a person in the order they were added, space separated (normalized tags have no spaces)
+TAGS_COLUMN = (
+    "(SELECT group_concat(tag, ' ') FROM "
+    "(SELECT tag FROM person_tags WHERE person_id = p.id ORDER BY rowid))"
+)
+PERSON_COLUMNS = (
+    f"p.id, p.username, {TAGS_COLUMN}, p.created_at, p.user_id, p.priority, p.last_picked_at"
+)
+# Fields needed to render roster listings
+LISTING_COLUMNS = f"p.id, p.username, {TAGS_COLUMN}"
+SELECT_PERSON = f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.roster = ? AND p.username = ?"
+
+# Tag lists and usernames are passed as one JSON array parameter, so each query has a single
+# text whatever the number of tags and the connection's statement cache prepares it once
+ANY_TAGS = (
+    "p.id IN (SELECT person_id FROM person_tags "
+    "WHERE roster = :roster AND tag IN (SELECT value FROM json_each(:tags)))"
+)
+ALL_TAGS = (
+    "p.id IN (SELECT person_id FROM person_tags "
+    "WHERE roster = :roster AND tag IN (SELECT value FROM json_each(:tags)) "
+    "GROUP BY person_id HAVING COUNT(*) = :tag_count)"
+)
+EXCLUDE = "p.username NOT IN (SELECT value FROM json_each(:exclude))"
+
+# Uniform picks only touch the ids, the person is read once picked. Without tags: a random
+# offset into the roster's username index, no sort
+PICK_ANY = (
+    "SELECT p.id FROM persons p WHERE {where} LIMIT 1 "
+    "OFFSET (SELECT abs(random()) % max(COUNT(*), 1) FROM persons p WHERE {where})"
+)
+# With tags: straight from the tag index, grouped so that a person having several of the tags
+# isn't more likely to be picked
+PICK_TAGGED = (
+    "SELECT person_id FROM person_tags "
+    "WHERE roster = :roster AND tag IN (SELECT value FROM json_each(:tags)){exclude} "
+    "GROUP BY person_id ORDER BY random() LIMIT :limit"
+)
+EXCLUDE_IDS = (
+    " AND person_id NOT IN "
+    "(SELECT id FROM persons WHERE roster = :roster "
+    "AND username IN (SELECT value FROM json_each(:exclude)))"
+)
+
+INSERT_PERSON = "INSERT INTO persons (roster, username, created_at) VALUES (?, ?, ?)"
+INSERT_TAG = "INSERT OR IGNORE INTO person_tags (person_id, roster, tag) VALUES (?, ?, ?)"
+INC_COUNTER = (
+    "INSERT INTO counters (id, value) VALUES (?, 1) "
+    "ON CONFLICT (id) DO UPDATE SET value = value + 1"
+)
+
+DELIVERY_COLUMNS = ("_id", "roster_chat_id", "round", "chat_id", "text", "status", "attempts")
+# What update_delivery can set besides the status
+DELIVERY_FIELDS = ("attempts", "next_attempt_at", "sent_at", "error")
+
+# Weighted draws that lost the race with another process picking the same person
+FAIR_PICK_ATTEMPTS = 3
+# Seconds between checks of the fair index against the roster version, for writes made elsewhere
+FAIR_INDEX_RECHECK = 5.0
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(value: Optional[datetime]) -> Optional[int]:
+    """Naive UTC datetime -> microseconds since the epoch, exact (the fair pick compares them)"""
+    return None if value is None else (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(value: Optional[int]) -> Optional[datetime]:
+    return None if value is None else _EPOCH + timedelta(0, 0, value)
+
+
+def _plan_stage(detail: str) -> str:
+    """A line of EXPLAIN QUERY PLAN in the stage names of MongoDB's explain(), others as they are"""
+    words = detail.split()
+    if words[0] == "SEARCH":
+        return "IXSCAN"
+    if words[0] == "SCAN" and not words[1].startswith("(") and "VIRTUAL TABLE" not in detail:
+        return "COLLSCAN"
+    return detail
+
+
+class SQLiteDatabaseService:
+    """The embedded storage (see storage.Storage): one SQLite file in WAL mode, through aiosqlite
+
+    Persons and their tags are normalized into the persons and person_tags tables, tag counts
+    are kept by triggers in the same transaction as the write. Writes go through one connection
+    and take turns on it, reads go through another one and see the last committed state.
+    Both per-chat scopes keep every roster in the shared tables, keyed by the chat id.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache: Optional[PersonCache] = None,
+        roster_scope: str = "global",
+        max_rosters: int = 1024,
+    ):
+        if roster_scope not in ROSTER_SCOPES:
+            raise ValueError(
+                f"Unknown roster scope {roster_scope}, use one of: {', '.join(ROSTER_SCOPES)}"
+            )
+        self.path = path
+        self.roster_scope = roster_scope
+        # The chat whose roster this service works with, None for the deployment-wide service
+        self.chat_id: Optional[int] = None
+        # Roster key of the rows: the chat id, 0 for the global roster
+        self.roster = 0
+        self.cache = cache
+        # Opened on first use, shared by the roster views
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._reader: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        # A transaction holds the writer until it commits, so others' statements can't end up in it
+        self._write_lock = asyncio.Lock()
+        self._cache_lock = asyncio.Lock()
+        self.search_index = SearchIndex()
+        self._search_lock = asyncio.Lock()
+        # Fair picks when the cache can't make them
+        self.fair_index = FairIndex()
+        self._fair_lock = asyncio.Lock()
+        # Roster views by chat, the least recently used ones beyond max_rosters are dropped
+        self._rosters: "OrderedDict[int, SQLiteDatabaseService]" = OrderedDict()
+        self.max_rosters = max_rosters
+        self._rosters_lock = asyncio.Lock()
+
+    async def for_chat(self, chat_id: int) -> "SQLiteDatabaseService":
+        """The service for the roster of a chat, sharing the connections - self in the global scope
+
+        Views are kept for reuse, each with its own cache and indexes, up to max_rosters of the
+        chats used last.
+        """
+        if self.roster_scope == "global" or self.chat_id is not None:
+            return self
+        roster = self._rosters.get(chat_id)
+        if roster is not None:
+            self._rosters.move_to_end(chat_id)
+            return roster
+        # Connected before copying, so every view uses the same connections
+        await self._connect()
+        async with self._rosters_lock:
+            if chat_id in self._rosters:
+                return self._rosters[chat_id]
+            roster = copy.copy(self)
+            roster.chat_id = roster.roster = chat_id
+            roster.cache = (
+                PersonCache(self.cache.ttl, self.cache.max_size) if self.cache is not None else None
+            )
+            roster._cache_lock = asyncio.Lock()
+            roster.search_index = SearchIndex()
+            roster._search_lock = asyncio.Lock()
+            roster.fair_index = FairIndex()
+            roster._fair_lock = asyncio.Lock()
+            roster._rosters = OrderedDict()
+            self._rosters[chat_id] = roster
+            while len(self._rosters) > self.max_rosters:
+                self._rosters.popitem(last=False)
+            return roster
+
+    @property
+    def _counter_id(self) -> str:
+        return "coffee_round" if self.chat_id is None else f"coffee_round:{self.chat_id}"
+
+    @property
+    def _version_id(self) -> str:
+        return "roster_version" if self.chat_id is None else f"roster_version:{self.chat_id}"
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """The writer connection, opening both connections and creating the schema on first use"""
+        if self._writer is not None:
+            return self._writer
+        async with self._connect_lock:
+            if self._writer is not None:
+                return self._writer
+            in_memory = self.path == ":memory:"
+            if not in_memory:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit, transactions are started explicitly
+            writer = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+            await writer.executescript(CONNECTION_PRAGMAS + DATABASE_PRAGMAS + SCHEMA)
+            # An in-memory database only exists for its own connection
+            reader = writer
+            if not in_memory:
+                reader = await aiosqlite.connect(
+                    self.path, isolation_level=None, cached_statements=256
+                )
+                await reader.executescript(CONNECTION_PRAGMAS)
+            self._reader = reader
+            self._writer = writer
+            return writer
+
+    @asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """The writer within BEGIN IMMEDIATE ... COMMIT, rolled back on an error
+
+        IMMEDIATE takes the file's write lock up front: a writer of another process waits for
+        it (busy_timeout) instead of failing when it upgrades from reading.
+        """
+        writer = await self._connect()
+        async with self._write_lock:
+            await writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield writer
+            except BaseException:
+                await writer.execute("ROLLBACK")
+                raise
+            await writer.execute("COMMIT")
+
+    async def _execute(self, sql: str, parameters=()) -> aiosqlite.Cursor:
+        """A single write statement, atomic on its own"""
+        writer = await self._connect()
+        async with self._write_lock:
+            return await writer.execute(sql, parameters)
+
+    async def _fetchall(self, sql: str, parameters=()) -> Iterable[sqlite3.Row]:
+        await self._connect()
+        return await self._reader.execute_fetchall(sql, parameters)
+
+    async def _fetchone(self, sql: str, parameters=()) -> Optional[sqlite3.Row]:
+        rows = await self._fetchall(sql, parameters)
+        return rows[0] if rows else None
+
+    def _filter(
+        self,
+        tags: Optional[List[str]] = None,
+        match: str = "any",
+        exclude: Optional[List[str]] = None,
+    ) -> Tuple[str, dict]:
+        """WHERE clause over persons p of the roster, tags matched "any" ($in) or "all" ($all)"""
+        conditions = ["p.roster = :roster"]
+        parameters = {"roster": self.roster}
+        if tags:
+            conditions.append(ANY_TAGS if match == "any" else ALL_TAGS)
+            parameters["tags"] = json.dumps(tags)
+            parameters["tag_count"] = len(set(tags))
+        if exclude:
+            conditions.append(EXCLUDE)
+            parameters["exclude"] = json.dumps(exclude)
+        return " AND ".join(conditions), parameters
+
+    async def initialize(self):
+        """Open the database and create the tables, indexes and triggers that are missing"""
+        await self._connect()
+        # Persons of the global roster would be invisible to every chat roster
+        if self.roster_scope != "global" and await self._fetchone(
+            "SELECT 1 FROM persons WHERE roster = 0 LIMIT 1"
+        ):
+            raise RuntimeError(
+                f"{self.path} has persons of the global roster - move them to the rosters of "
+                "their chats (set their roster to the chat id) before switching roster scopes"
+            )
+        rows = await self._fetchall(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+        )
+        logger.info(f"Indexes in {self.path}: {', '.join(sorted(name for (name,) in rows))}")
+
+    async def warm_up(self, connections: int = 1):
+        """Open the connections and create the schema ahead of the first request"""
+        await self.initialize()
+
+    async def close(self):
+        for connection in {self._writer, self._reader} - {None}:
+            await connection.close()
+        self._writer = self._reader = None
+
+    async def ping(self, timeout: float = 2.0) -> bool:
+        """Check that the database file answers - for the health check"""
+        try:
+            await asyncio.wait_for(self._fetchall("SELECT 1"), timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"SQLite ping failed: {e}")
+            return False
+
+    async def explain_tag_queries(self, tags: Optional[List[str]] = None) -> List[dict]:
+        """Log the query plans of the tag queries, to check that none of them scans a whole table"""
+        if not tags:
+            rows = await self._fetchall(
+                "SELECT DISTINCT tag FROM person_tags WHERE roster = ? LIMIT 2", (self.roster,)
+            )
+            tags = [tag for (tag,) in rows] or ["example"]
+
+        reports = []
+        for name, match in (("random ($in)", "any"), ("list_by_tags ($all)", "all")):
+            where, parameters = self._filter(tags, match)
+            plan = await self._fetchall(
+                f"EXPLAIN QUERY PLAN SELECT {PERSON_COLUMNS} FROM persons p WHERE {where}",
+                parameters,
+            )
+            details = [row[3] for row in plan]
+            stages = [_plan_stage(detail) for detail in details]
+            reports.append({"query": name, "stages": stages, "plan": details})
+
+            message = f"Query plan for {name} {tags}: {'; '.join(details)}"
+            if "COLLSCAN" in stages:
+                logger.warning(message)
+            else:
+                logger.debug(message)
+        return reports
+
+    async def warm_cache(self) -> bool:
+        """Load the whole roster into the cache in one scan, False without a cache or if too big"""
+        if self.cache is None:
+            return False
+        async with self._cache_lock:
+            if self.cache.is_warm:
+                return True
+            # One row over the limit is enough to know the roster doesn't fit
+            rows = await self._fetchall(
+                f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.roster = ? LIMIT ?",
+                (self.roster, self.cache.max_size + 1),
+            )
+            if not self.cache.load(self._to_record(row) for row in rows):
+                logger.warning(
+                    f"Roster has more than {self.cache.max_size} persons, "
+                    "serving reads from the database"
+                )
+                return False
+            logger.info(f"Person cache warmed with {len(self.cache)} persons")
+            return True
+
+    async def _warm_cache_or_none(self) -> Optional[PersonCache]:
+        """The cache if it can answer reads right now"""
+        if self.cache is None:
+            return None
+        if self.cache.should_reload:
+            await self.warm_cache()
+        return self.cache if self.cache.is_warm else None
+
+    async def watch_changes(self):
+        """No change streams in SQLite: writes of other processes reach the cache after its TTL"""
+        if self.cache is not None:
+            logger.warning(f"Can't watch {self.path} for changes, relying on cache TTL")
+
+    @staticmethod
+    def _to_record(row: sqlite3.Row) -> PersonRecord:
+        """A row of PERSON_COLUMNS, or of LISTING_COLUMNS (the rest None, as with a projection)"""
+        tags = row[2].split(" ") if row[2] else []
+        if len(row) == 3:
+            return PersonRecord(str(row[0]), row[1], tags)
+        _, username, _, created_at, user_id, priority, last_picked_at = row
+        return PersonRecord(
+            str(row[0]),
+            username,
+            tags,
+            _from_us(created_at),
+            user_id,
+            priority,
+            _from_us(last_picked_at),
+        )
+
+    async def _get_record(
+        self, connection: aiosqlite.Connection, person_id: int
+    ) -> Optional[PersonRecord]:
+        rows = await connection.execute_fetchall(
+            f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.id = ?", (person_id,)
+        )
+        return self._to_record(rows[0]) if rows else None
+
+    async def add_person(self, username: str, tags: Optional[List[str]] = None) -> Person:
+        tags = normalize_tags(tags or [])
+        created_at = datetime.utcnow()
+        try:
+            async with self._transaction() as writer:
+                cursor = await writer.execute(
+                    INSERT_PERSON, (self.roster, username, _to_us(created_at))
+                )
+                person_id = cursor.lastrowid
+                await writer.executemany(
+                    INSERT_TAG, [(person_id, self.roster, tag) for tag in tags]
+                )
+                await writer.execute(INC_COUNTER, (self._version_id,))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Person with username {username} already exists")
+
+        person = Person(_id=str(person_id), username=username, tags=tags, created_at=created_at)
+        record = PersonRecord.from_person(person)
+        if self.cache is not None:
+            self.cache.upsert(record)
+        self.search_index.add_person(username, tags)
+        self.fair_index.written([record])
+        return person
+
+    @classmethod
+    def _tag_update(cls, username: str, row: Optional[sqlite3.Row], tags: List[str]) -> TagUpdate:
+        """The result of adding the tags, from the person's row (PERSON_COLUMNS) before the write"""
+        if row is None:
+            return TagUpdate(username)
+        person = cls._to_record(row)
+        added = [tag for tag in tags if tag not in person.tags]
+        person.tags += added
+        return TagUpdate(username, person, added)
+
+    async def _insert_tags(self, writer: aiosqlite.Connection, updated: List[TagUpdate]) -> None:
+        await writer.executemany(
+            INSERT_TAG,
+            [
+                (int(result.person.id), self.roster, tag)
+                for result in updated
+                for tag in result.added
+            ],
+        )
+        await writer.execute(INC_COUNTER, (self._version_id,))
+
+    async def add_tags(self, username: str, tags: List[str]) -> TagUpdate:
+        """Add multiple tags to a person, falsy if there's no such person or they had all of them"""
+        tags = normalize_tags(tags)
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(SELECT_PERSON, (self.roster, username))
+            result = self._tag_update(username, rows[0] if rows else None, tags)
+            if result.added:
+                await self._insert_tags(writer, [result])
+        if result.added:
+            if self.cache is not None:
+                self.cache.add_tags(username, result.added)
+            self.search_index.add_tags(result.added)
+            self.fair_index.written([result.person])
+        return result
+
+    async def bulk_add_tags(self, changes: Dict[str, List[str]]) -> Dict[str, TagUpdate]:
+        """Add tags to several persons in one transaction, a result per username, in order"""
+        changes = {username: normalize_tags(tags) for username, tags in changes.items()}
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(
+                f"SELECT {PERSON_COLUMNS} FROM persons p "
+                "WHERE p.roster = ? AND p.username IN (SELECT value FROM json_each(?))",
+                (self.roster, json.dumps(list(changes))),
+            )
+            found = {row[1]: row for row in rows}
+            results = {
+                username: self._tag_update(username, found.get(username), tags)
+                for username, tags in changes.items()
+            }
+            updated = [result for result in results.values() if result.added]
+            if updated:
+                await self._insert_tags(writer, updated)
+        if self.cache is not None:
+            for result in updated:
+                self.cache.add_tags(result.username, result.added)
+        if updated:
+            self.search_index.add_tags([tag for result in updated for tag in result.added])
+            self.fair_index.written([result.person for result in updated])
+        return results
+
+    async def add_tag(self, username: str, tag: str) -> bool:
+        return bool(await self.add_tags(username, [tag]))
+
+    async def delete_person(self, username: str) -> Optional[PersonRecord]:
+        # The person's tags go with them (ON DELETE CASCADE), the triggers uncount them
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(SELECT_PERSON, (self.roster, username))
+            if rows:
+                await writer.execute("DELETE FROM persons WHERE id = ?", (rows[0][0],))
+                await writer.execute(INC_COUNTER, (self._version_id,))
+        if self.cache is not None:
+            self.cache.remove(username)
+        if not rows:
+            return None
+        deleted = self._to_record(rows[0])
+        self.search_index.remove_person(username, deleted.tags)
+        self.fair_index.written(removed=[username])
+        return deleted
+
+    async def get_person(self, username: str) -> Optional[PersonRecord]:
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_person(username)
+
+        row = await self._fetchone(SELECT_PERSON, (self.roster, username))
+        return self._to_record(row) if row else None
+
+    async def get_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]:
+        """Get a uniformly random person (optionally having any of the tags)"""
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_random_person(tags, exclude)
+
+        where, parameters = self._filter(tags, "any", exclude)
+        if tags:
+            pick = PICK_TAGGED.format(exclude=EXCLUDE_IDS if exclude else "")
+            parameters["limit"] = 1
+        else:
+            pick = PICK_ANY.format(where=where)
+        row = await self._fetchone(
+            f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.id = ({pick})", parameters
+        )
+        return self._to_record(row) if row else None
+
+    async def sample_persons(
+        self, tags: Optional[List[str]] = None, size: int = 20
+    ) -> List[PersonRecord]:
+        """Up to size distinct random persons (optionally with any of the tags), in random order"""
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.sample_persons(tags, size)
+
+        where, parameters = self._filter(tags, "any")
+        parameters["limit"] = size
+        if tags:
+            pick = PICK_TAGGED.format(exclude="")
+        else:
+            pick = f"SELECT p.id FROM persons p WHERE {where} ORDER BY random() LIMIT :limit"
+        rows = await self._fetchall(
+            f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.id IN ({pick})", parameters
+        )
+        persons = [self._to_record(row) for row in rows]
+        random.shuffle(persons)
+        return persons
+
+    async def pick_fair_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]:
+        """Pick a person weighted by priority * time since their last pick, and mark them picked
+
+        A draw is O(log n) on Fenwick trees: the warm cache's, or else the fair index's.
+        """
+        tags = normalize_tags(tags) if tags else None
+        person = None
+        for _ in range(FAIR_PICK_ATTEMPTS):
+            now = datetime.utcnow()
+            cache = await self._warm_cache_or_none()
+            if cache is not None:
+                person = cache.get_fair_random_person(tags, exclude, now)
+            else:
+                person = (await self._get_fair_index()).draw(tags, exclude, now)
+            if person is None:
+                return None
+
+            # Compare-and-set on the last pick time: two processes can't both hand out the same turn
+            async with self._transaction() as writer:
+                cursor = await writer.execute(
+                    "UPDATE persons SET last_picked_at = ? WHERE id = ? AND last_picked_at IS ?",
+                    (_to_us(now), int(person.id), _to_us(person.last_picked_at)),
+                )
+                updated = (
+                    await self._get_record(writer, int(person.id)) if cursor.rowcount else None
+                )
+            if updated is not None:
+                if self.cache is not None:
+                    self.cache.upsert(updated)
+                self.fair_index.upsert(updated)
+                return updated
+
+            # Picked (or deleted) elsewhere meanwhile: refresh our copy and draw again
+            current = await self._get_record(self._reader, int(person.id))
+            if current is not None:
+                if self.cache is not None:
+                    self.cache.upsert(current)
+                self.fair_index.upsert(current)
+            else:
+                if self.cache is not None:
+                    self.cache.remove(person.username)
+                self.fair_index.remove(person.username)
+        logger.warning(
+            f"Couldn't mark a fair pick after {FAIR_PICK_ATTEMPTS} attempts, returning it unmarked"
+        )
+        return person
+
+    async def _get_fair_index(self) -> FairIndex:
+        """The fair index, loaded with one roster scan if it's cold or the roster changed elsewhere
+
+        The version is checked at most every FAIR_INDEX_RECHECK seconds, so a pick costs only its
+        write.
+        """
+        if (
+            self.fair_index.version is not None
+            and time.monotonic() - self.fair_index.checked_at < FAIR_INDEX_RECHECK
+        ):
+            return self.fair_index
+        async with self._fair_lock:
+            # Read before the scan: a write in between only makes the index look older than it is
+            version = await self.get_roster_version()
+            if self.fair_index.version != version:
+                persons = await self.get_all_persons()
+                self.fair_index.load(persons, version)
+                logger.info(f"Fair index built: {len(persons)} persons")
+            self.fair_index.checked_at = time.monotonic()
+        return self.fair_index
+
+    async def set_priority(self, username: str, priority: float) -> bool:
+        """How often a person is picked in fair mode, relative to others (1 by default, 0 never)"""
+        if priority < 0:
+            raise ValueError("Priority can't be negative")
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(
+                "UPDATE persons SET priority = ? WHERE roster = ? AND username = ? RETURNING id",
+                (priority, self.roster, username),
+            )
+            updated = await self._get_record(writer, rows[0][0]) if rows else None
+        if updated is None:
+            return False
+        if self.cache is not None:
+            self.cache.upsert(updated)
+        self.fair_index.upsert(updated)
+        return True
+
+    async def cleanup(self):
+        """Clean up the database - used for testing"""
+        async with self._transaction() as writer:
+            for table in TABLES:
+                await writer.execute(f"DELETE FROM {table}")
+        if self.cache is not None:
+            self.cache.invalidate()
+        self.search_index.invalidate()
+        self.fair_index.invalidate()
+
+    async def get_all_persons(self) -> List[PersonRecord]:
+        """Get all persons from the database"""
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_all_persons()
+
+        rows = await self._fetchall(
+            f"SELECT {PERSON_COLUMNS} FROM persons p WHERE p.roster = ?", (self.roster,)
+        )
+        return [self._to_record(row) for row in rows]
+
+    async def get_all_persons_by_tags(self, tags: List[str]) -> List[PersonRecord]:
+        """Get all persons that have ALL of the specified tags"""
+        tags = normalize_tags(tags)
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            return cache.get_all_persons_by_tags(tags)
+
+        where, parameters = self._filter(tags, "all")
+        rows = await self._fetchall(
+            f"SELECT {PERSON_COLUMNS} FROM persons p WHERE {where}", parameters
+        )
+        return [self._to_record(row) for row in rows]
+
+    async def iter_persons(
+        self, tags: Optional[List[str]] = None, batch_size: int = 500
+    ) -> AsyncIterator[PersonRecord]:
+        """Iterate over persons (optionally having ALL of the tags) by username, a page at a time"""
+        tags = normalize_tags(tags) if tags else None
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            persons = cache.get_all_persons_by_tags(tags) if tags else cache.get_all_persons()
+            for person in sorted(persons, key=lambda p: p.username):
+                yield person
+            return
+
+        last_username = None
+        while True:
+            page = await self.get_persons_page(tags, after=last_username, limit=batch_size)
+            for person in page:
+                yield person
+            if len(page) < batch_size:
+                return
+            last_username = page[-1].username
+
+    async def get_persons_page(
+        self, tags: Optional[List[str]] = None, after: Optional[str] = None, limit: int = 50
+    ) -> List[PersonRecord]:
+        """Up to limit persons (optionally with ALL of the tags) with usernames after this one"""
+        where, parameters = self._filter(normalize_tags(tags) if tags else None, "all")
+        if after is not None:
+            where += " AND p.username > :after"
+            parameters["after"] = after
+        rows = await self._fetchall(
+            f"SELECT {LISTING_COLUMNS} FROM persons p WHERE {where} ORDER BY p.username "
+            "LIMIT :limit",
+            {**parameters, "limit": limit},
+        )
+        return [self._to_record(row) for row in rows]
+
+    async def bulk_upsert_persons(
+        self, rows: Iterable[Tuple[str, List[str]]], batch_size: int = 1000
+    ) -> BulkUpsertResult:
+        """Insert persons or add the tags to existing ones, a transaction per batch"""
+        result = BulkUpsertResult()
+
+        # Merge repeated usernames first so each one is written once
+        merged = {}
+        for username, tags in rows:
+            if username in merged:
+                result.duplicates += 1
+            merged.setdefault(username, {}).update(dict.fromkeys(normalize_tags(tags)))
+
+        now = _to_us(datetime.utcnow())
+        items = list(merged.items())
+        lookup = (
+            f"SELECT {LISTING_COLUMNS} FROM persons p "
+            "WHERE p.roster = ? AND p.username IN (SELECT value FROM json_each(?))"
+        )
+        for start in range(0, len(items), batch_size):
+            batch_items = items[start : start + batch_size]
+            usernames = json.dumps([username for username, _ in batch_items])
+            async with self._transaction() as writer:
+                existing = {
+                    person.username: person
+                    for person in map(
+                        self._to_record,
+                        await writer.execute_fetchall(lookup, (self.roster, usernames)),
+                    )
+                }
+                await writer.executemany(
+                    INSERT_PERSON,
+                    [
+                        (self.roster, username, now)
+                        for username, _ in batch_items
+                        if username not in existing
+                    ],
+                )
+                ids = {
+                    username: person_id
+                    for person_id, username in await writer.execute_fetchall(
+                        "SELECT id, username FROM persons "
+                        "WHERE roster = ? AND username IN (SELECT value FROM json_each(?))",
+                        (self.roster, usernames),
+                    )
+                }
+                tag_rows = []
+                for username, tags in batch_items:
+                    person = existing.get(username)
+                    new_tags = [tag for tag in tags if person is None or tag not in person.tags]
+                    if person is None:
+                        result.inserted += 1
+                    elif new_tags:
+                        result.updated += 1
+                    else:
+                        result.duplicates += 1
+                    tag_rows += [(ids[username], self.roster, tag) for tag in new_tags]
+                await writer.executemany(INSERT_TAG, tag_rows)
+
+        if result.inserted or result.updated:
+            await self._execute(INC_COUNTER, (self._version_id,))
+            if self.cache is not None:
+                self.cache.invalidate()
+            self.search_index.invalidate()
+            self.fair_index.invalidate()
+        return result
+
+    async def get_usernames(self, tags: Optional[List[str]] = None) -> List[str]:
+        """Get usernames of all persons (optionally having ALL of the tags) in one query"""
+        cache = await self._warm_cache_or_none()
+        if cache is not None:
+            if tags:
+                return list(cache.match_all(normalize_tags(tags)))
+            return [p.username for p in cache.get_all_persons()]
+
+        where, parameters = self._filter(normalize_tags(tags) if tags else None, "all")
+        rows = await self._fetchall(f"SELECT p.username FROM persons p WHERE {where}", parameters)
+        return [username for (username,) in rows]
+
+    async def get_roster_version(self) -> int:
+        """Grows with every write changing what a listing shows (usernames, tags), 0 before any"""
+        row = await self._fetchone("SELECT value FROM counters WHERE id = ?", (self._version_id,))
+        return row[0] if row else 0
+
+    async def get_search_index(self) -> SearchIndex:
+        """The search index, rebuilt with one username scan after writes made elsewhere (or cold)"""
+        version = await self.get_roster_version()
+        if self.search_index.version == version:
+            return self.search_index
+        async with self._search_lock:
+            # Read before the scan: a write in between only makes the index look older than it is
+            version = await self.get_roster_version()
+            if self.search_index.version != version:
+                usernames, tag_counts = await asyncio.gather(
+                    self.get_usernames(), self.get_popular_tags()
+                )
+                self.search_index.load(usernames, tag_counts, version)
+                logger.info(
+                    f"Search index built: {len(usernames)} usernames, {len(tag_counts)} tags"
+                )
+        return self.search_index
+
+    async def get_tag_counts(self, tags: List[str]) -> Dict[str, int]:
+        """How many persons have each of the tags, without touching the persons"""
+        tags = normalize_tags(tags)
+        counts = dict.fromkeys(tags, 0)
+        rows = await self._fetchall(
+            "SELECT tag, count FROM tag_counts "
+            "WHERE roster = ? AND tag IN (SELECT value FROM json_each(?))",
+            (self.roster, json.dumps(tags)),
+        )
+        counts.update(rows)
+        return counts
+
+    async def get_popular_tags(self, limit: int = 0) -> List[Tuple[str, int]]:
+        """(tag, number of persons) for every tag in use, most popular first"""
+        rows = await self._fetchall(
+            "SELECT tag, count FROM tag_counts WHERE roster = ? AND count > 0 ORDER BY count DESC "
+            "LIMIT ?",
+            # LIMIT -1 is no limit
+            (self.roster, limit or -1),
+        )
+        return [tuple(row) for row in rows]
+
+    async def normalize_stored_tags(self, batch_size: int = 1000) -> int:
+        """Rewrite tags stored as typed ("#Python") normalized, returns how many persons changed"""
+        rows = await self._fetchall(
+            f"SELECT {LISTING_COLUMNS} FROM persons p WHERE p.roster = ?", (self.roster,)
+        )
+        changed = [
+            (person.id, tags)
+            for person in map(self._to_record, rows)
+            if (tags := normalize_tags(person.tags)) != person.tags
+        ]
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start : start + batch_size]
+            async with self._transaction() as writer:
+                ids = [(int(pid),) for pid, _ in batch]
+                await writer.executemany("DELETE FROM person_tags WHERE person_id = ?", ids)
+                await writer.executemany(
+                    INSERT_TAG,
+                    [
+                        (int(person_id), self.roster, tag)
+                        for person_id, tags in batch
+                        for tag in tags
+                    ],
+                )
+        if changed:
+            await self._execute(INC_COUNTER, (self._version_id,))
+            if self.cache is not None:
+                self.cache.invalidate()
+            self.search_index.invalidate()
+            self.fair_index.invalidate()
+        return len(changed)
+
+    async def rebuild_tag_counts(self) -> int:
+        """Recount the tags from person_tags - to fix drifted counts"""
+        # The deployment-wide service recounts every roster
+        where = "" if self.chat_id is None else "WHERE roster = :roster"
+        parameters = {"roster": self.roster}
+        async with self._transaction() as writer:
+            await writer.execute(f"DELETE FROM tag_counts {where}", parameters)
+            await writer.execute(
+                "INSERT INTO tag_counts (roster, tag, count) "
+                f"SELECT roster, tag, COUNT(*) FROM person_tags {where} GROUP BY roster, tag",
+                parameters,
+            )
+            rows = await writer.execute_fetchall(
+                f"SELECT COUNT(*) FROM tag_counts {where}", parameters
+            )
+        count = rows[0][0]
+        # The counts changed without a version bump
+        for roster in [self, *self._rosters.values()]:
+            roster.search_index.invalidate()
+        logger.info(f"Tag registry rebuilt: {count} tags")
+        return count
+
+    async def next_round_number(self) -> int:
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(
+                INC_COUNTER + " RETURNING value", (self._counter_id,)
+            )
+        return rows[0][0]
+
+    async def get_round_number(self) -> int:
+        """Number of the latest coffee round, 0 before the first one"""
+        row = await self._fetchone("SELECT value FROM counters WHERE id = ?", (self._counter_id,))
+        return row[0] if row else 0
+
+    async def load_pair_history(self, usernames: List[str], since_round: int) -> PairHistory:
+        """Load who met whom after since_round among the given persons, in one covered query"""
+        history = PairHistory(usernames)
+        rows = await self._fetchall(
+            "SELECT user_a, user_b FROM pair_history WHERE roster = ? AND round > ?",
+            (self.roster, since_round),
+        )
+        for user_a, user_b in rows:
+            history.add(user_a, user_b)
+        return history
+
+    async def get_recent_partners(self, username: str, since_round: int) -> List[str]:
+        """Get everyone the person met after since_round"""
+        # A query per side, each one on its own index, instead of an OR over both
+        rows = await self._fetchall(
+            "SELECT user_b FROM pair_history WHERE roster = :roster AND user_a = :username "
+            "AND round > :round "
+            "UNION ALL "
+            "SELECT user_a FROM pair_history WHERE roster = :roster AND user_b = :username "
+            "AND round > :round",
+            {"roster": self.roster, "username": username, "round": since_round},
+        )
+        return [partner for (partner,) in rows]
+
+    async def save_round(
+        self, round_number: int, groups: List[List[str]], tags: Optional[List[str]] = None
+    ):
+        """Store all groups of a round and record every pair in them in the pair history"""
+        if not groups:
+            return
+        now = _to_us(datetime.utcnow())
+        pairs = [
+            (self.roster, *canonical_pair(first, second), round_number)
+            for group in groups
+            for i, first in enumerate(group)
+            for second in group[i + 1 :]
+        ]
+        async with self._transaction() as writer:
+            await writer.executemany(
+                "INSERT INTO rounds (roster, round, tags, usernames, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.roster, round_number, json.dumps(tags or []), json.dumps(group), now)
+                    for group in groups
+                ],
+            )
+            await writer.executemany(
+                "INSERT INTO pair_history (roster, user_a, user_b, round) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (roster, user_a, user_b) "
+                "DO UPDATE SET round = MAX(round, excluded.round)",
+                pairs,
+            )
+
+    async def set_user_id(self, username: str, user_id: int) -> bool:
+        """Remember the Telegram user id of a username in every roster, False if not in this one"""
+        async with self._transaction() as writer:
+            await writer.execute(
+                "INSERT INTO users (username, user_id) VALUES (?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET user_id = excluded.user_id",
+                (username, user_id),
+            )
+            # The deployment-wide service sets it in every roster
+            cursor = await writer.execute(
+                "UPDATE persons SET user_id = :user_id "
+                "WHERE username = :username AND (:chat_id IS NULL OR roster = :roster)",
+                {
+                    "user_id": user_id,
+                    "username": username,
+                    "chat_id": self.chat_id,
+                    "roster": self.roster,
+                },
+            )
+            matched = cursor.rowcount > 0
+        if matched and self.cache is not None:
+            person = self.cache.get_person(username)
+            if person is not None:
+                person.user_id = user_id
+        return matched
+
+    async def get_user_ids(self, usernames: List[str]) -> Dict[str, int]:
+        """Map usernames to Telegram user ids, persons who never started the bot are left out"""
+        rows = await self._fetchall(
+            "SELECT username, user_id FROM users "
+            "WHERE username IN (SELECT value FROM json_each(?))",
+            (json.dumps(usernames),),
+        )
+        return dict(rows)
+
+    async def enqueue_deliveries(self, round_number: int, messages: Dict[int, str]) -> int:
+        """Store round notifications (chat id -> text) as pending, returns how many are new"""
+        if not messages:
+            return 0
+        now = _to_us(datetime.utcnow())
+        async with self._transaction() as writer:
+            # Already enqueued before a restart: ignored by the unique index
+            cursor = await writer.executemany(
+                "INSERT OR IGNORE INTO deliveries (roster_chat_id, round, chat_id, text, status, "
+                "attempts, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)",
+                [
+                    (self.chat_id, round_number, chat_id, text, now, now)
+                    for chat_id, text in messages.items()
+                ],
+            )
+            return cursor.rowcount
+
+    async def claim_deliveries(self, limit: int = 500, lease_seconds: float = 300) -> List[dict]:
+        """Take up to limit of the due deliveries for sending, oldest first (see the MongoDB one)"""
+        now = datetime.utcnow()
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(
+                "SELECT id, roster_chat_id, round, chat_id, text, status, attempts FROM deliveries "
+                "WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (_to_us(now), limit),
+            )
+            if rows:
+                await writer.execute(
+                    "UPDATE deliveries SET status = 'sending', next_attempt_at = ? "
+                    "WHERE id IN (SELECT value FROM json_each(?))",
+                    (
+                        _to_us(now + timedelta(seconds=lease_seconds)),
+                        json.dumps([row[0] for row in rows]),
+                    ),
+                )
+        return [{**dict(zip(DELIVERY_COLUMNS, row)), "status": "sending"} for row in rows]
+
+    async def update_delivery(self, delivery_id, status: str, **fields) -> None:
+        unknown = set(fields) - set(DELIVERY_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown delivery fields: {', '.join(sorted(unknown))}")
+        values = {
+            name: _to_us(value) if isinstance(value, datetime) else value
+            for name, value in fields.items()
+        }
+        assignments = ", ".join(f"{name} = :{name}" for name in ("status", *values))
+        await self._execute(
+            f"UPDATE deliveries SET {assignments} WHERE id = :id",
+            {"status": status, "id": delivery_id, **values},
+        )
+
+    async def push_update(self, update_id: int, chat_key: int, update: dict) -> bool:
+        """Queue a received update for the workers, False if it's already queued (a redelivery)"""
+        try:
+            await self._execute(
+                "INSERT INTO update_queue (update_id, chat_key, body, lease_until) "
+                "VALUES (?, ?, ?, ?)",
+                # Available right away
+                (update_id, chat_key, json.dumps(update), _to_us(datetime.utcnow())),
+            )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    async def lease_updates(
+        self, worker: int, workers: int, limit: int, lease_seconds: float
+    ) -> List[dict]:
+        """Take up to limit of the oldest available updates of the worker's chats, oldest first"""
+        now = datetime.utcnow()
+        async with self._transaction() as writer:
+            rows = await writer.execute_fetchall(
+                "SELECT update_id, chat_key, body FROM update_queue "
+                "WHERE chat_key % ? = ? AND lease_until <= ? ORDER BY update_id LIMIT ?",
+                (workers, worker, _to_us(now), limit),
+            )
+            if rows:
+                await writer.execute(
+                    "UPDATE update_queue SET lease_until = ? "
+                    "WHERE update_id IN (SELECT value FROM json_each(?))",
+                    (
+                        _to_us(now + timedelta(seconds=lease_seconds)),
+                        json.dumps([row[0] for row in rows]),
+                    ),
+                )
+        return [
+            {"_id": update_id, "chat_key": key, "update": json.loads(body)}
+            for update_id, key, body in rows
+        ]
+
+    async def release_updates(self, worker: int, workers: int) -> int:
+        """Make the leased updates of the worker's chats available again - on restart, for order"""
+        cursor = await self._execute(
+            "UPDATE update_queue SET lease_until = ? WHERE chat_key % ? = ?",
+            (_to_us(datetime.utcnow()), workers, worker),
+        )
+        return cursor.rowcount
+
+    async def ack_update(self, update_id: int) -> None:
+        await self._execute("DELETE FROM update_queue WHERE update_id = ?", (update_id,))
+
+    async def acquire_lease(self, name: str, holder: str, seconds: float) -> bool:
+        """Take or renew the named lease for seconds, False while another holder's is valid"""
+        now = datetime.utcnow()
+        # The conflicting row is only updated if the lease is ours or expired
+        cursor = await self._execute(
+            "INSERT INTO leases (name, holder, lease_until) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET "
+            "holder = excluded.holder, lease_until = excluded.lease_until "
+            "WHERE leases.holder = excluded.holder OR leases.lease_until <= ?",
+            (name, holder, _to_us(now + timedelta(seconds=seconds)), _to_us(now)),
+        )
+        return cursor.rowcount > 0
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self._execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
@@ -0,0 +1,202 @@
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Protocol, Tuple
+
+from .cache import PersonCache
+from .pair_history import PairHistory
+from .search import SearchIndex
+from ..models.person import Person, PersonRecord
+
+# How persons are split into rosters:
+# global - one roster for everyone (and the unique usernames) as before,
+# chat - a roster per chat, all in shared collections with chat_id as the leading index key,
+# collection - a roster per chat in its own collections, for very large groups
+ROSTER_SCOPES = ("global", "chat", "collection")
+
+
+@dataclass
+class BulkUpsertResult:
+    inserted: int = 0
+    updated: int = 0
+    # Rows that changed nothing: repeated within the batch or already stored with all their tags
+    duplicates: int = 0
+
+
+@dataclass
+class TagUpdate:
+    """What adding tags did to one person"""
+
+    username: str
+    # The person after the write, None if there's no such person
+    person: Optional[PersonRecord] = None
+    # The tags the person didn't have yet, in the order given
+    added: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added)
+
+
+class Storage(Protocol):
+    """Everything the bot keeps in a database
+
+    Implemented by DatabaseService (MongoDB, see database.py) and SQLiteDatabaseService
+    (an embedded file, see sqlite_database.py). Handlers and services only use this
+    interface, so the backend is picked by configuration.
+    """
+
+    roster_scope: str
+    # The chat whose roster this service works with, None for the deployment-wide service
+    chat_id: Optional[int]
+    cache: Optional[PersonCache]
+
+    async def for_chat(self, chat_id: int) -> "Storage":
+        """The service for the roster of a chat - this same one in the global scope"""
+        ...
+
+    # region lifecycle
+
+    async def initialize(self) -> None: ...
+
+    async def warm_up(self, connections: int = 1) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def ping(self, timeout: float = 2.0) -> bool: ...
+
+    async def cleanup(self) -> None:
+        """Drop everything - used for testing"""
+        ...
+
+    async def explain_tag_queries(self, tags: Optional[List[str]] = None) -> List[dict]:
+        """Log the query plans of the tag queries, each report lists its plan "stages" (COLLSCAN, IXSCAN, ...)"""
+        ...
+
+    # endregion lifecycle
+
+    # region persons
+
+    async def warm_cache(self) -> bool: ...
+
+    async def watch_changes(self) -> None: ...
+
+    async def add_person(self, username: str, tags: Optional[List[str]] = None) -> Person: ...
+
+    async def add_tags(self, username: str, tags: List[str]) -> TagUpdate: ...
+
+    async def bulk_add_tags(self, changes: Dict[str, List[str]]) -> Dict[str, TagUpdate]:
+        """Add tags to several persons at once (username -> tags), a result per username in the same order"""
+        ...
+
+    async def add_tag(self, username: str, tag: str) -> bool: ...
+
+    async def delete_person(self, username: str) -> Optional[PersonRecord]:
+        """The deleted person, None if there was no such person"""
+        ...
+
+    async def get_person(self, username: str) -> Optional[PersonRecord]: ...
+
+    async def get_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]: ...
+
+    async def pick_fair_random_person(
+        self, tags: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ) -> Optional[PersonRecord]: ...
+
+    async def sample_persons(self, tags: Optional[List[str]] = None, size: int = 20) -> List[PersonRecord]:
+        """Up to size distinct random persons (optionally having any of the tags), in random order"""
+        ...
+
+    async def set_priority(self, username: str, priority: float) -> bool: ...
+
+    async def get_all_persons(self) -> List[PersonRecord]: ...
+
+    async def get_all_persons_by_tags(self, tags: List[str]) -> List[PersonRecord]: ...
+
+    def iter_persons(self, tags: Optional[List[str]] = None, batch_size: int = 500) -> AsyncIterator[PersonRecord]: ...
+
+    async def get_persons_page(
+        self, tags: Optional[List[str]] = None, after: Optional[str] = None, limit: int = 50
+    ) -> List[PersonRecord]: ...
+
+    async def bulk_upsert_persons(
+        self, rows: Iterable[Tuple[str, List[str]]], batch_size: int = 1000
+    ) -> BulkUpsertResult: ...
+
+    async def get_usernames(self, tags: Optional[List[str]] = None) -> List[str]: ...
+
+    async def get_roster_version(self) -> int: ...
+
+    async def get_search_index(self) -> SearchIndex:
+        """The usernames and tags of the roster for fuzzy lookups, rebuilt if it changed behind the service's back"""
+        ...
+
+    # endregion persons
+
+    # region tags
+
+    async def get_tag_counts(self, tags: List[str]) -> Dict[str, int]: ...
+
+    async def get_popular_tags(self, limit: int = 0) -> List[Tuple[str, int]]: ...
+
+    async def normalize_stored_tags(self, batch_size: int = 1000) -> int: ...
+
+    async def rebuild_tag_counts(self) -> int: ...
+
+    # endregion tags
+
+    # region rounds
+
+    async def next_round_number(self) -> int: ...
+
+    async def get_round_number(self) -> int: ...
+
+    async def load_pair_history(self, usernames: List[str], since_round: int) -> PairHistory: ...
+
+    async def get_recent_partners(self, username: str, since_round: int) -> List[str]: ...
+
+    async def save_round(self, round_number: int, groups: List[List[str]], tags: Optional[List[str]] = None): ...
+
+    # endregion rounds
+
+    # region users and deliveries
+
+    async def set_user_id(self, username: str, user_id: int) -> bool: ...
+
+    async def get_user_ids(self, usernames: List[str]) -> Dict[str, int]: ...
+
+    async def enqueue_deliveries(self, round_number: int, messages: Dict[int, str]) -> int: ...
+
+    async def claim_deliveries(self, limit: int = 500, lease_seconds: float = 300) -> List[dict]:
+        """Due deliveries claimed for lease_seconds: dicts with _id, chat_id, text and attempts"""
+        ...
+
+    async def update_delivery(self, delivery_id, status: str, **fields) -> None:
+        """Set the status and any of: attempts, next_attempt_at, sent_at, error"""
+        ...
+
+    # endregion users and deliveries
+
+    # region update queue
+
+    async def push_update(self, update_id: int, chat_key: int, update: dict) -> bool: ...
+
+    async def lease_updates(self, worker: int, workers: int, limit: int, lease_seconds: float) -> List[dict]:
+        """Leased updates: dicts with _id (the update_id), chat_key and update, oldest first"""
+        ...
+
+    async def release_updates(self, worker: int, workers: int) -> int: ...
+
+    async def ack_update(self, update_id: int) -> None: ...
+
+    # endregion update queue
+
+    # region leases
+
+    async def acquire_lease(self, name: str, holder: str, seconds: float) -> bool:
+        """Take or renew the named lease for seconds, False while another holder's is valid"""
+        ...
+
+    async def release_lease(self, name: str, holder: str) -> None: ...
+
+    # endregion leases
+
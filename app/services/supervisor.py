@@ -0,0 +1,81 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import TelegramObject, Update
+from loguru import logger
+
+
+async def drain_tasks(tasks: Iterable[asyncio.Task], timeout: float, what: str = "updates") -> Set[asyncio.Task]:
+    """Give the tasks up to timeout seconds to finish and cancel the rest, returns the cancelled ones"""
+    running = {task for task in tasks if not task.done()}
+    if not running:
+        return set()
+    logger.info(f"Waiting up to {timeout:g}s for {len(running)} {what} in flight")
+    _, pending = await asyncio.wait(running, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        logger.warning(f"{len(pending)} {what} didn't finish in {timeout:g}s and were cancelled")
+    return pending
+
+
+class UpdateSupervisor(BaseMiddleware):
+    """Outermost update middleware: knows the updates being handled, to drain them on shutdown
+
+    The cap on concurrent updates is where they are taken: the polling loop takes the next
+    update only once a slot is free (tasks_concurrency_limit), so a burst waits at Telegram
+    instead of piling up tasks here. The shutdown hook, run once the polling has stopped, gives
+    the running handlers some time to finish their writes and replies, and then confirms the
+    handled updates to Telegram - which otherwise sends them again to the next start.
+    """
+
+    def __init__(self):
+        # update_id -> the task handling it
+        self._running: Dict[int, asyncio.Task] = {}
+        self._last_started: Optional[int] = None
+        # The first update drain had to cancel, Telegram sends it (and the ones after) again
+        self._first_cancelled: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._running)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        self._running[event.update_id] = asyncio.current_task()
+        self._last_started = max(self._last_started or 0, event.update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            self._running.pop(event.update_id, None)
+
+    async def drain(self, timeout: float) -> int:
+        """Wait up to timeout seconds for the updates being handled, cancel the rest, returns how many were"""
+        running = dict(self._running)
+        cancelled = await drain_tasks(running.values(), timeout)
+        cancelled_ids = [update_id for update_id, task in running.items() if task in cancelled]
+        if cancelled_ids:
+            self._first_cancelled = min(cancelled_ids)
+        return len(cancelled_ids)
+
+    async def confirm(self, bot: Bot) -> None:
+        """Mark the handled updates read with getUpdates, polling only
+
+        An update the polling loop took before its last getUpdates is confirmed already, and
+        if it was cancelled it's lost - the drain timeout is what keeps that from happening.
+        """
+        if self._last_started is None:
+            return
+        offset = self._first_cancelled if self._first_cancelled is not None else self._last_started + 1
+        try:
+            # Returns the next update without confirming it, that one comes to the next start
+            await bot.get_updates(offset=offset, limit=1, timeout=0)
+        except Exception as e:
+            logger.warning(f"Couldn't confirm the handled updates, the ones before {offset} may come again: {e}")
@@ -0,0 +1,157 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import Chat, TelegramObject, Update, User
+from loguru import logger
+
+from .metrics import MetricsRegistry, command_name, metrics
+
+# Commands whose repeats in a chat are answered once per coalescing window
+COALESCED_COMMANDS = ("/list", "/list_by_tags")
+
+
+class TokenBucket:
+    """Non-blocking token bucket: a request either gets a token right away or is dropped"""
+
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated_at = now
+
+    def take(self, rate: float, capacity: float, now: float) -> bool:
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class BucketStore:
+    """Token buckets by key, the least recently used ones are evicted past max_size
+
+    An evicted bucket was idle for longer than any kept one, so it has most likely refilled
+    anyway - forgetting it only costs a fresh bucket the next time.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_size: int = 10_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: Hashable, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, now)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(self.rate, self.capacity, now)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Outer update middleware dropping repeated, coalesced and over-the-limit updates
+
+    - an update_id that was already handled (polling retries, webhook redeliveries) is skipped;
+    - users and chats each get a token bucket, updates without a token are dropped, so one
+      noisy user or group can't take the bot from everyone else;
+    - a COALESCED_COMMANDS command repeated in a chat while the same one is being answered
+      (or was answered within coalesce_window seconds) is dropped - the chat gets one listing.
+
+    A dropped callback query still gets an empty answer, or the client keeps the button spinning.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = 1.0,
+        user_burst: float = 5,
+        chat_rate: float = 5.0,
+        chat_burst: float = 20,
+        coalesce_window: float = 5.0,
+        max_buckets: int = 10_000,
+        seen_updates: int = 10_000,
+        registry: MetricsRegistry = metrics,
+    ):
+        self.users = BucketStore(user_rate, user_burst, max_buckets)
+        self.chats = BucketStore(chat_rate, chat_burst, max_buckets)
+        self.coalesce_window = coalesce_window
+        self.seen_updates = seen_updates
+        self.registry = registry
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        # (chat id, command, arguments) -> when it was started, None while it's being handled
+        self._coalesced: Dict[tuple, Optional[float]] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+
+        if event.update_id in self._seen:
+            return await self._drop("duplicate", event, data)
+        self._seen[event.update_id] = None
+        if len(self._seen) > self.seen_updates:
+            self._seen.popitem(last=False)
+
+        # Set by aiogram's UserContextMiddleware, which runs before ours
+        user: Optional[User] = data.get("event_from_user")
+        chat: Optional[Chat] = data.get("event_chat")
+        now = time.monotonic()
+        if user is not None and not self.users.take(user.id, now):
+            return await self._drop("user_rate", event, data)
+        if chat is not None and not self.chats.take(chat.id, now):
+            return await self._drop("chat_rate", event, data)
+
+        key = self._coalesce_key(event, chat)
+        if key is None:
+            return await handler(event, data)
+        if key in self._coalesced:
+            started_at = self._coalesced[key]
+            if started_at is None or now - started_at < self.coalesce_window:
+                return await self._drop("coalesced", event, data)
+        self._coalesced[key] = None
+        try:
+            return await handler(event, data)
+        finally:
+            self._coalesced[key] = now
+            # Forget the windows that are over, the dict only holds recent listings
+            expired = [
+                other for other, started_at in self._coalesced.items()
+                if started_at is not None and time.monotonic() - started_at >= self.coalesce_window
+            ]
+            for other in expired:
+                del self._coalesced[other]
+
+    @staticmethod
+    def _coalesce_key(event: Update, chat: Optional[Chat]) -> Optional[tuple]:
+        command = command_name(event)
+        if chat is None or command not in COALESCED_COMMANDS:
+            return None
+        # Same command with the same arguments, "/list_by_tags@my_bot a b" is the same as "/list_by_tags a b"
+        message = event.message or event.edited_message
+        return chat.id, command, tuple((message.text or message.caption).split()[1:])
+
+    async def _drop(self, reason: str, event: Update, data: Dict[str, Any]) -> None:
+        self.registry.count("updates_dropped", reason)
+        logger.debug(f"Dropped update {event.update_id} ({command_name(event)}): {reason}")
+        bot = data.get("bot")
+        if event.callback_query is not None and bot is not None:
+            try:
+                await bot.answer_callback_query(event.callback_query.id)
+            except TelegramAPIError as e:
+                # Too old or already answered (a redelivered duplicate), nothing is spinning then
+                logger.debug(f"Could not answer dropped callback query {event.callback_query.id}: {e}")
+        return None
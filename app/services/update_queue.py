@@ -0,0 +1,154 @@
+import asyncio
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Chat, TelegramObject, Update, User
+from loguru import logger
+
+from .storage import Storage
+from .supervisor import drain_tasks
+
+
+def chat_key(data: Dict[str, Any]) -> int:
+    """What an update is ordered by: its chat, or its user for updates without one
+
+    Never negative: group chat ids are, and MongoDB's $mod keeps the sign of the dividend,
+    so chat_key % workers has to be in 0..workers-1 to reach a worker.
+    """
+    chat: Optional[Chat] = data.get("event_chat")
+    if chat is not None:
+        return abs(chat.id)
+    user: Optional[User] = data.get("event_from_user")
+    return user.id if user is not None else 0
+
+
+class UpdateIngressMiddleware(BaseMiddleware):
+    """Outer update middleware of the ingress process: queues every update instead of handling it
+
+    Updates are pushed one at a time, in the order they got here. Workers take a chat's oldest
+    queued update first, so with concurrent pushes update 6 could be queued (and taken) before
+    update 5 of the same chat is. asyncio.Lock wakes its waiters first come, first served.
+    """
+
+    def __init__(self):
+        self._push_lock = asyncio.Lock()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        # Stored as Telegram sent it, so the worker parses the same update back
+        update = event.model_dump(mode="json", by_alias=True, exclude_unset=True)
+        db_service: Storage = data["db_service"]
+        async with self._push_lock:
+            queued = await db_service.push_update(event.update_id, chat_key(data), update)
+        if not queued:
+            logger.debug(f"Update {event.update_id} is already queued")
+        return None
+
+
+class UpdateWorker:
+    """Handles the queued updates of every chat with chat_key % workers == worker
+
+    Updates of one chat are handled one after another in update_id order, different chats
+    concurrently (up to max_concurrent at a time). Delivery is at least once: an update
+    being handled when the worker dies is handled again after the restart. After stop() the
+    updates already taken get drain_timeout seconds to finish, so a restart repeats none of them.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        db_service: Storage,
+        worker: int,
+        workers: int,
+        max_concurrent: int = 32,
+        lease_seconds: float = 300,
+        poll_interval: float = 0.1,
+        max_poll_interval: float = 1.0,
+        drain_timeout: float = 8.0,
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.db_service = db_service
+        self.worker = worker
+        self.workers = workers
+        self.max_concurrent = max_concurrent
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(max_poll_interval, poll_interval)
+        self.drain_timeout = drain_timeout
+        self._stopping = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # The last task of each chat, the next update of the chat waits for it
+        self._tails: Dict[int, asyncio.Task] = {}
+        self._in_flight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def run(self) -> None:
+        released = await self.db_service.release_updates(self.worker, self.workers)
+        if released:
+            logger.info(f"Worker {self.worker}: {released} updates left by the previous run are queued again")
+        # An idle worker polls less and less often, down to once every max_poll_interval
+        interval = self.poll_interval
+        try:
+            while not self._stopping.is_set():
+                # Backpressure: with twice max_concurrent updates taken, the rest waits in the queue
+                room = self.max_concurrent * 2 - len(self._in_flight)
+                items = []
+                if room > 0:
+                    items = await self.db_service.lease_updates(self.worker, self.workers, room, self.lease_seconds)
+                for item in items:
+                    # Its lease ran out while it was waiting behind its chat - it's already chained
+                    if item["_id"] not in self._in_flight:
+                        self._schedule(item)
+                if items:
+                    interval = self.poll_interval
+                else:
+                    with suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._stopping.wait(), interval)
+                    interval = min(interval * 2, self.max_poll_interval)
+        finally:
+            # Cancelled updates stay leased in the queue and are released on the next start
+            timeout = self.drain_timeout if self._stopping.is_set() else 0
+            await drain_tasks(self._tasks, timeout, f"updates of worker {self.worker}")
+
+    def stop(self) -> None:
+        """Take no more updates, run() returns once the taken ones are handled or drain_timeout runs out"""
+        self._stopping.set()
+
+    def _schedule(self, item: dict) -> None:
+        key = item["chat_key"]
+        self._in_flight.add(item["_id"])
+        task = asyncio.create_task(self._handle(item, self._tails.get(key)))
+        self._tails[key] = task
+        self._tasks.add(task)
+
+        def forget(done: asyncio.Task) -> None:
+            self._tasks.discard(done)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+        task.add_done_callback(forget)
+
+    async def _handle(self, item: dict, previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                # Its errors are its own, only the order matters here
+                await asyncio.gather(previous, return_exceptions=True)
+            async with self._semaphore:
+                try:
+                    update = Update.model_validate(item["update"], context={"bot": self.bot})
+                    await self.dispatcher.feed_update(self.bot, update)
+                except Exception as e:
+                    logger.exception(f"Worker {self.worker}: update {item['_id']} failed: {e}")
+                # Acknowledged after a failure too, handling it again would fail the same way
+                await self.db_service.ack_update(item["_id"])
+        finally:
+            self._in_flight.discard(item["_id"])
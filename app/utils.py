@@ -0,0 +1,40 @@
+import unicodedata
+from typing import AsyncIterable, AsyncIterator, Iterable, List
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+async def chunk_lines(
+    lines: AsyncIterable[str], header: str = "", limit: int = TELEGRAM_MESSAGE_LIMIT
+) -> AsyncIterator[str]:
+    """Pack lines into messages of at most limit characters, header goes to the first one
+
+    Yields nothing if there are no lines. The length is counted on the raw HTML, which is
+    an upper bound of what Telegram counts after parsing the entities.
+    """
+    parts = []
+    size = 0
+    async for line in lines:
+        if not parts and header:
+            parts.append(header)
+            size = len(header)
+        if parts and size + len(line) > limit:
+            yield "".join(parts)
+            parts = []
+            size = 0
+        parts.append(line)
+        size += len(line)
+    if parts:
+        yield "".join(parts)
+
+
+def normalize_tag(tag: str) -> str:
+    """Canonical form of a tag: "#Machine Learning" -> "machine-learning" """
+    tag = unicodedata.normalize("NFKC", tag).casefold().strip().lstrip("#")
+    return "-".join(tag.split())
+
+
+def normalize_tags(tags: Iterable[str]) -> List[str]:
+    """Normalize tags, dropping empty ones and repeats, in the original order"""
+    return list(dict.fromkeys(tag for tag in map(normalize_tag, tags) if tag))
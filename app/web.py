@@ -0,0 +1,96 @@
+import asyncio
+from typing import Any, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+from loguru import logger
+
+from .services.metrics import metrics
+from .services.supervisor import drain_tasks
+
+
+def create_web_app(dp: Dispatcher) -> web.Application:
+    """The HTTP app every runtime mode serves: /health and /metrics, plus the webhook route in webhook mode"""
+
+    async def health(request: web.Request) -> web.Response:
+        # The database service only exists between the dispatcher startup and shutdown
+        db_service = dp.workflow_data.get("db_service")
+        if db_service is None:
+            return web.json_response({"status": "starting"}, status=503)
+        mongo_ok = await db_service.ping()
+        return web.json_response(
+            {"status": "ok" if mongo_ok else "degraded", "mongo": "ok" if mongo_ok else "unreachable"},
+            status=200 if mongo_ok else 503,
+        )
+
+    async def prometheus_metrics(request: web.Request) -> web.Response:
+        # In worker mode the ingress serves the metrics of every process, the handlers run in the workers
+        worker_metrics = dp.workflow_data.get("worker_metrics")
+        registry = worker_metrics.merged(metrics) if worker_metrics is not None else metrics
+        return web.Response(text=registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    web_app.router.add_get("/health", health)
+    web_app.router.add_get("/metrics", prometheus_metrics)
+    return web_app
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook handler processing at most max_concurrent updates at a time
+
+    Telegram gets its response right away and the update is handled in the background.
+    When max_pending updates are already waiting, the request is answered with 503, so
+    Telegram delivers it again later instead of us piling up tasks. The same goes for every
+    request once the app shuts down: the updates being handled get drain_timeout seconds to
+    finish before the dispatcher is shut down, and the bot session is closed after that.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        max_concurrent: int = 32,
+        max_pending: int = 1000,
+        drain_timeout: float = 8.0,
+        secret_token: Optional[str] = None,
+        **data: Any,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._closing = False
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        # Instead of super() closing the bot session on shutdown: the shutdown callbacks run in
+        # order and the dispatcher's, registered after this, still send the queued deliveries
+        app.on_shutdown.append(self._drain)
+        app.on_cleanup.append(self._handle_close)
+        app.router.add_route("POST", path, self.handle, **kwargs)
+
+    async def _drain(self, *args: Any) -> None:
+        self._closing = True
+        await drain_tasks(self._background_feed_update_tasks, self.drain_timeout)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._closing:
+            # Delivered again to the instance that replaces this one
+            return web.Response(status=503)
+        if len(self._background_feed_update_tasks) >= self.max_pending:
+            logger.warning(f"{self.max_pending} updates pending, asking Telegram to retry later")
+            return web.Response(status=503)
+        return await super()._handle_request_background(bot, request)
+
+
+async def start_web_server(web_app: web.Application, host: str, port: int) -> web.AppRunner:
+    """Serve the app next to the polling loop, returns the runner to clean up on shutdown"""
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving HTTP on {host}:{port}")
+    return runner
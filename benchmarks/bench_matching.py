@@ -0,0 +1,46 @@
+"""Time of make_pairs for a whole pool, with a few rounds of history to avoid.
+
+Pure in-memory, no database needed:
+
+    python benchmarks/bench_matching.py --sizes 10000 100000 1000000
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.services.matching import make_pairs  # noqa: E402
+from app.services.pair_history import PairHistory  # noqa: E402
+
+
+def main(sizes, history_rounds: int) -> None:
+    rng = random.Random(42)
+    print(f"{'size':>9} {'history pairs':>14} {'groups':>9} {'repeats':>8} {'time, ms':>9}")
+    for size in sizes:
+        usernames = [f"user{i}" for i in range(size)]
+
+        history = PairHistory(usernames)
+        for _ in range(history_rounds):
+            for group in make_pairs(history, rng).groups:
+                history.add(group[0], group[1])
+
+        start = time.perf_counter()
+        match_round = make_pairs(history, rng)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(
+            f"{size:>9} {len(history):>14} {len(match_round.groups):>9} "
+            f"{match_round.repeats:>8} {elapsed:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--history-rounds", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args.sizes, args.history_rounds)
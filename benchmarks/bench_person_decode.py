@@ -0,0 +1,65 @@
+"""Per-document cost of turning MongoDB documents into Person objects.
+
+Pure CPU, no database needed:
+
+    python benchmarks/bench_person_decode.py --count 100000
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.models.person import Person, PersonRecord  # noqa: E402
+from app.services.database import LISTING_PROJECTION  # noqa: E402
+
+TAGS = ["python", "backend", "frontend", "design", "ml", "devops", "product", "data", "go", "rust"]
+
+
+def validated(person_dict: dict) -> Person:
+    """The previous read path"""
+    person_dict = dict(person_dict)
+    person_dict["_id"] = str(person_dict["_id"])
+    return Person(**person_dict)
+
+
+def main(count: int) -> None:
+    documents = [
+        {
+            "_id": ObjectId(),
+            "username": f"user{i}",
+            "tags": random.sample(TAGS, random.randint(0, 4)),
+            "created_at": datetime.utcnow(),
+            "user_id": 100_000 + i,
+        }
+        for i in range(count)
+    ]
+    projected = [{key: doc[key] for key in ("_id", *LISTING_PROJECTION)} for doc in documents]
+
+    variants = {
+        "Person(**doc)": (validated, documents),
+        "PersonRecord.from_db": (PersonRecord.from_db, documents),
+        "projected validate": (validated, projected),
+        "projected from_db": (PersonRecord.from_db, projected),
+    }
+    print(f"{'variant':<22} {'total, ms':>10} {'per doc, us':>12}")
+    for name, (decode, docs) in variants.items():
+        start = time.perf_counter()
+        for doc in docs:
+            decode(doc)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22} {elapsed * 1000:>10.1f} {elapsed / count * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100_000)
+    args = parser.parse_args()
+
+    main(args.count)
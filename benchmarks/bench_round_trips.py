@@ -0,0 +1,157 @@
+"""Database commands and latency per command of the bot: /add, /add_tags, /delete and /random.
+
+Every command sent to MongoDB is a network round trip (commands the service runs
+concurrently overlap, so the latency shows how many of them are sequential). With SQLite
+the hops to the aiosqlite thread are counted instead (a cursor and its statement are two):
+
+    python benchmarks/bench_round_trips.py --backend mongod
+    python benchmarks/bench_round_trips.py --backend sqlite --users 10 --output sqlite.json
+
+"/add_tags xN one by one" is how a tag change for N persons was written before
+bulk_add_tags - one add_tags per person - and the baseline for "/add_tags xN". Likewise
+"/random" is a query per pick and "/random reroll" a pick from the chat's candidate pool.
+mongomock sends no commands, so only mongod, uri and sqlite are supported.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from pymongo import monitoring
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.services.candidate_pool import CandidatePools  # noqa: E402
+from app.services.storage import Storage  # noqa: E402
+from bench_database import database_service, git_commit, seed  # noqa: E402
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.count += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+    def count_hops(self, connection) -> None:
+        """Count every call an aiosqlite connection runs on its thread"""
+        execute = connection._execute
+
+        async def counted(fn, *args, **kwargs):
+            self.count += 1
+            return await execute(fn, *args, **kwargs)
+
+        connection._execute = counted
+
+
+def commands(service: Storage, pools: CandidatePools, size: int, users: int, rng: random.Random) -> dict:
+    """name -> func(i), the writes go to persons that exist (or get created) for the call"""
+    run_id = rng.randrange(10**9)
+
+    def some_users():
+        return [f"user{i}" for i in rng.sample(range(size), users)]
+
+    async def add(i):
+        await service.add_person(f"new{run_id}_{i}", ["python", "backend"])
+
+    async def add_tags(i):
+        await service.add_tags(f"user{rng.randrange(size)}", [f"fresh{run_id}_{i}", "python"])
+
+    async def add_tags_one_by_one(i):
+        for username in some_users():
+            await service.add_tags(username, [f"fresh{run_id}_{i}", "python"])
+
+    async def bulk_add_tags(i):
+        await service.bulk_add_tags(dict.fromkeys(some_users(), [f"fresh{run_id}_{i}", "python"]))
+
+    async def delete(i):
+        await service.delete_person(f"new{run_id}_{i}")
+
+    return {
+        "/add": add,
+        "/add_tags": add_tags,
+        f"/add_tags x{users} one by one": add_tags_one_by_one,
+        f"/add_tags x{users}": bulk_add_tags,
+        # Deletes the persons /add created
+        "/delete": delete,
+        "/random": lambda i: service.get_random_person(),
+        "/random reroll": lambda i: pools.take(service),
+    }
+
+
+async def main(args) -> None:
+    rng = random.Random(args.seed)
+    counter = CommandCounter()
+    # Clients created from now on report their commands to it
+    monitoring.register(counter)
+    results = []
+    async with database_service(args.backend, args.uri, cache=False) as service:
+        await seed(service, args.size, rng)
+        if args.backend == "sqlite":
+            for connection in {service._writer, service._reader}:
+                counter.count_hops(connection)
+
+        # Refilled in the background, those queries are counted to the rerolls
+        pools = CandidatePools()
+        print(f"{'command':<28} {'commands':>9} {'p50, ms':>9} {'mean, ms':>9}", file=sys.stderr)
+        for name, func in commands(service, pools, args.size, args.users, rng).items():
+            timings = []
+            counter.count = 0
+            for i in range(args.repeats):
+                start = time.perf_counter()
+                await func(i)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            row = {
+                "command": name,
+                "commands_per_call": round(counter.count / args.repeats, 2),
+                "p50_ms": round(timings[len(timings) // 2] * 1000, 4),
+                "mean_ms": round(sum(timings) / len(timings) * 1000, 4),
+            }
+            results.append(row)
+            print(
+                f"{name:<28} {row['commands_per_call']:>9.2f} {row['p50_ms']:>9.3f} {row['mean_ms']:>9.3f}",
+                file=sys.stderr,
+            )
+        await pools.close()
+
+    report = {
+        "benchmark": "round_trips",
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "backend": args.backend,
+        "size": args.size,
+        "users": args.users,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongod", "uri", "sqlite"], default="mongod")
+    parser.add_argument(
+        "--uri", default="mongodb://localhost:27017", help="server for --backend uri, the benchmark_db on it is dropped"
+    )
+    parser.add_argument("--size", type=int, default=1000, help="persons in the roster")
+    parser.add_argument("--users", type=int, default=10, help="persons per multi-user /add_tags")
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+"""Build time, memory and query latency of the trigram index behind /find and "did you mean".
+
+Pure in-memory, no database needed:
+
+    python benchmarks/bench_search.py --sizes 1000 10000 100000
+
+Usernames are made of common first names, surnames and words with digits, plus random
+handles. Queries are usernames as is, with two letters swapped, their first half and a
+single first name (which matches the most).
+"""
+
+import argparse
+import random
+import string
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.services.search import TrigramIndex  # noqa: E402
+
+FIRST = (
+    "alex anna anton artem boris daniil denis dmitry egor elena fedor gleb igor ilya ivan kirill ksenia maria "
+    "maxim mikhail nikita oleg olga pavel roman sergey sofia timur vera victor yana yulia john kate david emma"
+).split()
+LAST = (
+    "ivanov petrov smirnov kuznetsov popov sokolov novikov fedorov morozov volkov lebedev semenov pavlov "
+    "kozlov orlov makarov nikitin zaitsev borisov romanov frolov smith brown jones miller davis wilson clark"
+).split()
+WORDS = "dev code data cat coffee night owl wolf fox cyber pixel ghost dark moon star rock jazz byte rust ninja".split()
+
+
+def username(rng: random.Random) -> str:
+    first, last, word, year = rng.choice(FIRST), rng.choice(LAST), rng.choice(WORDS), str(rng.randint(0, 2005))
+    return rng.choice([
+        f"{first}_{last}",
+        f"{first}{last}",
+        f"{first}{last[0]}{rng.randint(0, 99)}",
+        f"{last}_{first[0]}",
+        f"{first}{year}",
+        f"{word}_{rng.choice(WORDS)}{year}",
+        f"{word}{first}",
+        f"{first[:4]}{last[:5]}",
+        "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(rng.randint(5, 12))),
+        "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(rng.randint(5, 12))),
+    ])
+
+
+def swap(rng: random.Random, word: str) -> str:
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def main(sizes, queries: int, seed: int) -> None:
+    rng = random.Random(seed)
+    print(f"{'size':>7} {'build, s':>9} {'MB':>6}  {'query':<7} {'p50, ms':>8} {'p95, ms':>8} {'found':>6}")
+    for size in sizes:
+        usernames = set()
+        while len(usernames) < size:
+            usernames.add(username(rng))
+        usernames = sorted(usernames)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        index = TrigramIndex()
+        for name in usernames:
+            index.add(name)
+        build = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0] / 2**20
+        tracemalloc.stop()
+
+        picked = [rng.choice(usernames) for _ in range(queries)]
+        kinds = {
+            "exact": picked,
+            "typo": [swap(rng, name) for name in picked],
+            "prefix": [name[:max(3, len(name) // 2)] for name in picked],
+            "name": [rng.choice(FIRST) for _ in range(queries)],
+        }
+        for i, (kind, texts) in enumerate(kinds.items()):
+            timings, found = [], 0
+            for text in texts:
+                start = time.perf_counter()
+                found += bool(index.search(text))
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            p50, p95 = timings[len(timings) // 2] * 1000, timings[len(timings) * 95 // 100] * 1000
+            columns = f"{size:>7} {build:>9.2f} {memory:>6.1f}" if i == 0 else " " * 24
+            print(f"{columns}  {kind:<7} {p50:>8.3f} {p95:>8.3f} {found / len(texts):>6.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.sizes, args.queries, args.seed)
@@ -0,0 +1,56 @@
+"""What a cold start of the bot spends its time importing, from python -X importtime.
+
+    python benchmarks/bench_startup.py --top 25
+    python benchmarks/bench_startup.py --module app.services.database
+
+Prints the modules with the largest cumulative import time, run once per --repeats to see
+the spread. tests/test_imports.py keeps the total under a budget.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile(module: str) -> list:
+    """(cumulative us, self us, depth, module) for every import of a fresh interpreter"""
+    env = {"TELEGRAM_BOT_TOKEN": "benchmark", **os.environ}
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(cumulative_us), int(self_us), len(indent) // 2, name))
+    return rows
+
+
+def main(args) -> None:
+    for run in range(args.repeats):
+        rows = profile(args.module)
+        total = next(cumulative for cumulative, _, _, name in reversed(rows) if name == args.module)
+        print(f"import {args.module}: {total / 1e6:.3f}s, {len(rows)} modules (run {run + 1})")
+    print(f"\n{'cumulative, ms':>15} {'self, ms':>9}  module")
+    for cumulative, self_us, depth, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>15.1f} {self_us / 1000:>9.1f}  {'  ' * depth}{name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="app.bot")
+    parser.add_argument("--top", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,140 @@
+"""Throughput and latency of the worker mode's update queue: push -> lease -> ack.
+
+The ingress side is the real UpdateIngressMiddleware fed as many updates at a time as the
+polling loop would hand it, the worker side real UpdateWorker instances leasing and
+acknowledging them, against SQLite or MongoDB (spawned or existing, as in bench_database.py -
+mongomock has no $mod to lease by). Handlers are a stand-in taking --handle-ms each, so the
+numbers show the queue overhead:
+
+    python benchmarks/bench_workers.py --backend sqlite --workers 1 2 4 --updates 2000
+    python benchmarks/bench_workers.py --backend mongod --workers 1 4 --handle-ms 5 --output workers.json
+
+Workers run as tasks of this one process, each polling the queue like a worker process would.
+Every run also checks that each chat's updates were handled in the order they were pushed.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiogram.types import Chat, Update
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.services.update_queue import UpdateIngressMiddleware, UpdateWorker  # noqa: E402
+from bench_database import database_service  # noqa: E402
+
+
+class StandInDispatcher:
+    """Takes handle_ms per update and records when each one was handled"""
+
+    def __init__(self, handle_ms: float):
+        self.handle_ms = handle_ms
+        self.handled = {}
+        self.order = []
+
+    async def feed_update(self, bot, update: Update):
+        if self.handle_ms:
+            await asyncio.sleep(self.handle_ms / 1000)
+        self.handled[update.update_id] = time.perf_counter()
+        self.order.append((update.message.chat.id, update.update_id))
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    message = {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "group"}, "text": "/random"}
+    return Update.model_validate({"update_id": update_id, "message": message})
+
+
+async def run(service, workers: int, updates: list, concurrency: int, handle_ms: float) -> dict:
+    await service.cleanup()
+    await service.initialize()
+    ingress = UpdateIngressMiddleware()
+    dispatcher = StandInDispatcher(handle_ms)
+    update_workers = [
+        UpdateWorker(dispatcher, None, service, worker, workers, poll_interval=0.005, max_poll_interval=0.005)
+        for worker in range(workers)
+    ]
+    tasks = [asyncio.create_task(update_worker.run()) for update_worker in update_workers]
+
+    pushed = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def push(update: Update) -> None:
+        async with semaphore:
+            pushed[update.update_id] = time.perf_counter()
+            chat = Chat(id=update.message.chat.id, type="group")
+            await ingress(None, update, {"db_service": service, "event_chat": chat})
+
+    start = time.perf_counter()
+    # Started in update order, like the tasks of the polling loop
+    await asyncio.gather(*(push(update) for update in updates))
+    push_seconds = time.perf_counter() - start
+    while len(dispatcher.handled) < len(updates):
+        # A worker that failed would leave its updates queued forever
+        for task in tasks:
+            if task.done():
+                task.result()
+        await asyncio.sleep(0.001)
+    # The last updates are acknowledged once stopped
+    for update_worker in update_workers:
+        update_worker.stop()
+    await asyncio.gather(*tasks)
+    total_seconds = time.perf_counter() - start
+
+    latencies = sorted(dispatcher.handled[update_id] - pushed[update_id] for update_id in pushed)
+    chats = {chat_id for chat_id, _ in dispatcher.order}
+    in_order = all(
+        [update_id for chat, update_id in dispatcher.order if chat == chat_id]
+        == sorted(update_id for chat, update_id in dispatcher.order if chat == chat_id)
+        for chat_id in chats
+    )
+    return {
+        "workers": workers,
+        "updates": len(updates),
+        "push_per_sec": round(len(updates) / push_seconds, 1),
+        "updates_per_sec": round(len(updates) / total_seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        "in_order": in_order,
+    }
+
+
+async def main(args) -> None:
+    rng = random.Random(args.seed)
+    updates = [make_update(update_id, -1000 - rng.randrange(args.chats)) for update_id in range(1, args.updates + 1)]
+    results = []
+    print(f"{'workers':>8} {'push/s':>9} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8}", file=sys.stderr)
+    async with database_service(args.backend, args.uri, cache=False) as service:
+        for workers in args.workers:
+            result = await run(service, workers, updates, args.concurrency, args.handle_ms)
+            results.append(result)
+            print(
+                f"{workers:>8} {result['push_per_sec']:>9.1f} {result['updates_per_sec']:>10.1f} "
+                f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}" + ("" if result["in_order"] else "  OUT OF ORDER"),
+                file=sys.stderr,
+            )
+
+    report = {"backend": args.backend, "chats": args.chats, "handle_ms": args.handle_ms, "results": results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongod", "uri", "sqlite"], default="sqlite")
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=32, help="Updates being pushed at a time")
+    parser.add_argument("--handle-ms", type=float, default=0, help="Time the stand-in handler takes per update")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    asyncio.run(main(parser.parse_args()))
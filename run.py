@@ -10,7 +10,20 @@ from app.bot import main
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument(
+        "--mode",
+        choices=["polling", "webhook"],
+        default=None,
+        help="How to receive updates (default: webhook if WEBHOOK_URL is set, polling otherwise)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes handling the updates, 0 handles them in this process (default: UPDATE_WORKERS)",
+    )
     args = parser.parse_args()
 
     debug = args.debug if args.debug else bool(os.getenv("DEBUG"))
-    main(debug=debug)
+    webhook = None if args.mode is None else args.mode == "webhook"
+    main(debug=debug, webhook=webhook, workers=args.workers)
@@ -0,0 +1,74 @@
+import pytest
+from app.services.cache import PersonCache
+from app.services.database import DatabaseService
+from app.models.person import PersonRecord
+
+
+def make_persons():
+    return [
+        PersonRecord("1", "user1", ["developer", "python", "backend"]),
+        PersonRecord("2", "user2", ["developer", "javascript", "frontend"]),
+        PersonRecord("3", "user3", ["developer", "python", "frontend"]),
+        PersonRecord("4", "user4", ["designer", "ui", "ux"]),
+    ]
+
+
+class NoRoundTrips:
+    """Stands in for the Motor collection and fails on any access"""
+
+    def __getattr__(self, name):
+        raise AssertionError(f"Unexpected MongoDB access: collection.{name}")
+
+
+def test_tag_queries():
+    cache = PersonCache()
+    assert cache.load(make_persons())
+
+    assert cache.match_any(["python", "ux"]) == {"user1", "user3", "user4"}
+    assert cache.match_all(["python", "frontend"]) == {"user3"}
+    assert cache.match_all(["python", "ux"]) == set()
+    assert cache.match_all(["nonexistent"]) == set()
+    assert cache.get_random_person(["ux"]).username == "user4"
+    assert cache.get_random_person(["nonexistent"]) is None
+
+
+def test_write_through():
+    cache = PersonCache()
+    cache.load(make_persons())
+
+    cache.upsert(PersonRecord("5", "user5", ["python"]))
+    cache.add_tags("user4", ["python"])
+    cache.remove("user1")
+    cache.remove_by_id("3")
+
+    assert cache.match_all(["python"]) == {"user4", "user5"}
+    assert cache.get_person("user4").tags == ["designer", "ui", "ux", "python"]
+    assert cache.get_person("user1") is None
+    assert len(cache) == 3
+
+
+def test_eviction():
+    cache = PersonCache(max_size=3)
+    assert not cache.load(make_persons())
+    assert not cache.is_warm
+    # Oversized roster is not rescanned until the TTL passes
+    assert not cache.should_reload
+
+    cache = PersonCache(ttl=0)
+    cache.load(make_persons())
+    assert not cache.is_warm
+    assert cache.should_reload
+
+
+@pytest.mark.asyncio
+async def test_reads_are_served_without_round_trips():
+    service = DatabaseService("mongodb://localhost:27017", "test_db", cache=PersonCache())
+    service.cache.load(make_persons())
+    service.collection = NoRoundTrips()
+
+    person = await service.get_random_person(["frontend"])
+    assert person.username in {"user2", "user3"}
+    persons = await service.get_all_persons_by_tags(["developer", "python"])
+    assert {p.username for p in persons} == {"user1", "user3"}
+    assert (await service.get_person("user4")).tags == ["designer", "ui", "ux"]
+    assert len(await service.get_all_persons()) == 4
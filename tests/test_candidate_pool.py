@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+from pytest_asyncio import fixture
+
+from app.services.candidate_pool import CandidatePools
+from app.services.sqlite_database import SQLiteDatabaseService
+
+
+class CountingService(SQLiteDatabaseService):
+    """Counts the queries a pool makes"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = 0
+        self.version_reads = 0
+
+    async def sample_persons(self, tags=None, size=20):
+        self.samples += 1
+        return await super().sample_persons(tags, size)
+
+    async def get_roster_version(self) -> int:
+        self.version_reads += 1
+        return await super().get_roster_version()
+
+
+@fixture
+async def db_service():
+    service = CountingService(":memory:")
+    await service.initialize()
+    await service.bulk_upsert_persons([(f"user{i}", ["python"] if i % 2 else ["design"]) for i in range(10)])
+    yield service
+    await service.close()
+
+
+@pytest.mark.asyncio
+async def test_rerolls_without_queries_or_repeats(db_service):
+    pools = CandidatePools(size=20)
+    picked = [person.username for _ in range(8) for person in await pools.take(db_service)]
+    # Drawn once, handed out without replacement
+    assert db_service.samples == 1
+    assert len(set(picked)) == 8
+    await pools.close()
+
+
+@pytest.mark.asyncio
+async def test_tags_and_exclusions(db_service):
+    pools = CandidatePools(size=20)
+    persons = await pools.take(db_service, ["#Python"], count=10, exclude=["user1"])
+    assert {person.username for person in persons} == {"user3", "user5", "user7", "user9"}
+    # Excluded for one user, still there for the others
+    assert [person.username for person in await pools.take(db_service, ["python"])] == ["user1"]
+    await pools.close()
+
+
+@pytest.mark.asyncio
+async def test_refill_and_roster_changes(db_service):
+    pools = CandidatePools(size=4, recheck_interval=0)
+    first = await pools.take(db_service, ["python"])
+    await asyncio.sleep(0.05)
+    # Checked against the roster version in the background, not on the way to the reply
+    assert db_service.version_reads == 2
+
+    await db_service.delete_person(first[0].username)
+    await db_service.add_person("newcomer", ["python"])
+    await pools.take(db_service, ["python"])
+    await asyncio.sleep(0.05)
+    # The pool from before the write is dropped and drawn again
+    usernames = {person.username for person in await pools.take(db_service, ["python"], count=10)}
+    assert first[0].username not in usernames
+    assert usernames <= {"user1", "user3", "user5", "user7", "user9", "newcomer"}
+    await pools.close()
+
+
+@pytest.mark.asyncio
+async def test_forget_drops_the_pools_after_a_write(db_service):
+    pools = CandidatePools(size=4, recheck_interval=60)
+    await pools.take(db_service, ["python"])
+    await pools.take(db_service)
+    for username in ("user1", "user3", "user5", "user7", "user9"):
+        await db_service.delete_person(username)
+    pools.forget(db_service.chat_id)
+    assert len(pools) == 0
+
+    # Right away, not only after the recheck
+    assert await pools.take(db_service, ["python"]) == []
+    await pools.close()
+
+
+@pytest.mark.asyncio
+async def test_small_roster_never_repeats_the_last_pick(db_service):
+    pools = CandidatePools(size=20)
+    picks = [(await pools.take(db_service, ["design"]))[0].username for _ in range(20)]
+    assert all(previous != current for previous, current in zip(picks, picks[1:]))
+    await pools.close()
+
+
+def test_exclusions_are_kept_per_round():
+    pools = CandidatePools(recheck_interval=60)
+    assert pools.round_number(-100) is None
+    pools.remember_round(-100, 3)
+    assert pools.round_number(-100) == 3
+
+    pools.remember_exclusions(-100, 1, 3, ["user2"])
+    assert pools.exclusions(-100, 1, 3) == ["user2"]
+    # A new round makes them stale
+    assert pools.exclusions(-100, 1, 4) is None
+    assert pools.exclusions(-100, 2, 3) is None
+
+    # Reread after recheck_interval
+    pools.recheck_interval = 0
+    assert pools.round_number(-100) is None
@@ -0,0 +1,105 @@
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+from app.models.person import PersonRecord
+from app.services.cache import PersonCache
+from app.services.fair_sampler import FairIndex, FairSampler, FenwickTree
+
+
+def test_fenwick_tree():
+    tree = FenwickTree([1.0, 2.0, 3.0])
+    assert tree.total() == 6.0
+    tree.add(1, 5.0)
+    assert tree.total() == 11.0
+
+
+def test_draws_follow_weights():
+    now = datetime.utcnow()
+    sampler = FairSampler(random.Random(0))
+    # Waited 1, 2 and 3 hours, the last one with double priority: weights 1:2:6
+    sampler.set("a", 1.0, now - timedelta(hours=1))
+    sampler.set("b", 1.0, now - timedelta(hours=2))
+    sampler.set("c", 2.0, now - timedelta(hours=3))
+
+    counts = Counter(sampler.sample(now) for _ in range(9000))
+    assert abs(counts["a"] - 1000) < 150
+    assert abs(counts["b"] - 2000) < 200
+    assert abs(counts["c"] - 6000) < 250
+
+
+def test_updates_and_growth():
+    now = datetime.utcnow()
+    sampler = FairSampler(random.Random(0))
+    for i in range(100):
+        sampler.set(f"user{i}", 1.0, now - timedelta(days=1))
+    for i in range(99):
+        sampler.remove(f"user{i}")
+    assert len(sampler) == 1
+    assert {sampler.sample(now) for _ in range(50)} == {"user99"}
+
+    # Just picked or priority 0: nobody left to draw
+    sampler.set("user99", 1.0, now)
+    assert sampler.sample(now) is None
+    sampler.set("user99", 0.0, now - timedelta(days=1))
+    assert sampler.sample(now) is None
+
+
+def test_cache_fair_draw():
+    now = datetime.utcnow()
+    long_ago = now - timedelta(days=30)
+    cache = PersonCache()
+    cache.load([
+        PersonRecord("1", "waiting", ["python"], created_at=long_ago),
+        PersonRecord("2", "just_picked", ["python"], created_at=long_ago, last_picked_at=now),
+        PersonRecord("3", "other", ["design"], created_at=long_ago),
+    ])
+
+    assert {cache.get_fair_random_person(["python"], now=now).username for _ in range(20)} == {"waiting"}
+    assert cache.get_fair_random_person(["python"], exclude=["waiting"], now=now) is None
+
+    # Write-through keeps the sampler in sync
+    cache.upsert(PersonRecord("1", "waiting", ["python"], created_at=long_ago, last_picked_at=now))
+    cache.upsert(PersonRecord("2", "just_picked", ["python"], created_at=long_ago, last_picked_at=long_ago))
+    assert cache.get_fair_random_person(["python"], now=now).username == "just_picked"
+
+
+def test_fair_index():
+    now = datetime.utcnow()
+    long_ago = now - timedelta(days=30)
+    index = FairIndex()
+    # Ignored until the index is loaded
+    index.written([PersonRecord("0", "ghost", [], created_at=long_ago)])
+    assert index.version is None
+
+    index.load([
+        PersonRecord("1", "waiting", ["python"], created_at=long_ago),
+        PersonRecord("2", "just_picked", ["python"], created_at=long_ago, last_picked_at=now),
+        PersonRecord("3", "other", ["design"], created_at=long_ago),
+    ], version=7)
+    assert {index.draw(["python"], now=now).username for _ in range(20)} == {"waiting"}
+    assert index.draw(["python"], exclude=["waiting"], now=now) is None
+
+    # A pick doesn't bump the version, a roster write does
+    index.upsert(PersonRecord("1", "waiting", ["python"], created_at=long_ago, last_picked_at=now))
+    index.written([PersonRecord("4", "newcomer", ["python"], created_at=long_ago)], removed=["other"])
+    assert index.version == 8
+    assert len(index) == 3
+    assert index.draw(["python"], now=now).username == "newcomer"
+    assert index.draw(["design"], now=now) is None
+
+    index.invalidate()
+    assert index.version is None and len(index) == 0
+
+
+def test_retired_persons_leave_residue():
+    now = datetime.utcnow()
+    sampler = FairSampler(random.Random(0))
+    for i in range(10000):
+        sampler.set(f"user{i}", 1.0 + i % 7 / 3, now - timedelta(seconds=i * 37.3))
+    for i in range(9999):
+        sampler.set(f"user{i}", 0.0, now - timedelta(days=1))
+    assert {sampler.sample(now) for _ in range(50)} == {"user9999"}
+
+    sampler.remove("user9999")
+    assert sampler.sample(now) is None
@@ -1,5 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
 import pytest
 
+# Budgets for a cold `import app.bot` in a fresh interpreter - generous on purpose, they are
+# there to catch a heavy dependency sneaking into startup (see benchmarks/bench_startup.py)
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "10"))
+IMPORT_RSS_BUDGET_MB = float(os.getenv("IMPORT_RSS_BUDGET_MB", "350"))
+# Only loaded when the feature that needs them is used
+LAZY_MODULES = (
+    "apscheduler", "langchain", "langchain_openai", "langchain_community", "langchain_anthropic", "toml", "aiosqlite"
+)
+
+COLD_IMPORT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.bot
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "seconds": elapsed,
+    # kilobytes on Linux, bytes on macOS
+    "rss_mb": rss / 2**20 if sys.platform == "darwin" else rss / 2**10,
+    "modules": sorted(sys.modules),
+}))
+"""
+
 
 @pytest.fixture(autouse=True)
 def mock_env(monkeypatch):
@@ -11,3 +39,15 @@ def test_imports():
 
     assert main
     assert dp
+
+
+def test_cold_start_budget():
+    output = subprocess.run(
+        [sys.executable, "-c", COLD_IMPORT], capture_output=True, text=True, check=True, env=os.environ
+    ).stdout
+    report = json.loads(output.splitlines()[-1])
+
+    lazy = [module for module in report["modules"] if module.split(".")[0] in LAZY_MODULES]
+    assert not lazy, f"Imported at startup: {lazy}"
+    assert report["seconds"] < IMPORT_TIME_BUDGET, f"import app.bot took {report['seconds']:.2f}s"
+    assert report["rss_mb"] < IMPORT_RSS_BUDGET_MB, f"import app.bot took {report['rss_mb']:.0f} MB"
@@ -0,0 +1,32 @@
+import random
+from app.services.matching import make_pairs
+from app.services.pair_history import PairHistory
+
+
+def test_make_pairs_covers_everyone_once():
+    usernames = [f"user{i}" for i in range(11)]
+    match_round = make_pairs(PairHistory(usernames), random.Random(0))
+
+    assert sorted(len(group) for group in match_round.groups) == [2, 2, 2, 2, 3]
+    assert sorted(u for group in match_round.groups for u in group) == sorted(usernames)
+
+
+def test_make_pairs_avoids_recent_pairs():
+    usernames = [f"user{i}" for i in range(10)]
+    history = PairHistory(usernames)
+    first = make_pairs(history, random.Random(0))
+    for first_username, second_username in first.groups:
+        history.add(first_username, second_username)
+
+    second = make_pairs(history, random.Random(0))
+    assert second.repeats == 0
+    assert not any(history.has_met(*group) for group in second.groups)
+
+
+def test_make_pairs_small_pools():
+    assert make_pairs(PairHistory([])).groups == []
+    assert make_pairs(PairHistory(["user1"])).groups == []
+
+    history = PairHistory(["user1", "user2"])
+    history.add("user2", "user1")
+    assert make_pairs(history).repeats == 1
@@ -0,0 +1,132 @@
+import asyncio
+import pickle
+import queue
+import threading
+import time
+
+import pytest
+from aiogram import Router
+from aiogram.filters import Command, CommandStart
+from aiogram.types import Update
+
+from app.services.metrics import (
+    Histogram, MetricsRegistry, WorkerMetrics, command_name, registered_commands, report_metrics
+)
+from app.services.response_cache import ResponseCache
+
+
+def test_histogram_quantile():
+    histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+    for _ in range(90):
+        histogram.observe(0.005)
+    for _ in range(10):
+        histogram.observe(0.5)
+
+    assert histogram.count == 100
+    assert 0 < histogram.quantile(0.5) <= 0.01
+    assert 0.1 < histogram.quantile(0.99) <= 1.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    registry.command_latency["/list"].observe(0.02)
+    registry.command_errors["/list"] += 1
+    registry.mongo_latency[("persons", "find")].observe(0.003)
+
+    text = registry.render_prometheus()
+    assert 'bot_command_duration_seconds_bucket{command="/list",le="+Inf"} 1' in text
+    assert 'bot_command_errors_total{command="/list"} 1' in text
+    assert 'mongo_command_duration_seconds_count{collection="persons",command="find"} 1' in text
+    assert registry.summary()[0] == "In flight: 0"
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.command_errors['/x"y\\\n'] += 1
+    assert 'bot_command_errors_total{command="/x\\"y\\\\\\n"} 1' in registry.render_prometheus()
+
+
+def test_unregistered_commands_are_other():
+    router, settings = Router(), Router()
+    router.message.register(lambda message: None, Command("random", "List"))
+    settings.message.register(lambda message: None, CommandStart())
+    router.include_router(settings)
+    commands = registered_commands(router)
+    assert commands == {"/random", "/list", "/start"}
+
+    def update(text):
+        message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": text}
+        return Update(update_id=1, message=message)
+
+    assert command_name(update("/LIST@my_bot tag"), commands) == "/list"
+    assert command_name(update('/x"y\\'), commands) == "other"
+    assert command_name(update("hello"), commands) == "message"
+
+
+@pytest.mark.asyncio
+async def test_worker_metrics_are_merged():
+    ingress, worker = MetricsRegistry(), MetricsRegistry()
+    ingress.updates_dropped["duplicate"] += 1
+    worker.command_latency["/list"].observe(0.02)
+    worker.command_errors["/list"] += 1
+
+    worker_metrics = WorkerMetrics(queue.Queue())
+    worker_metrics.start()
+    reporter = asyncio.create_task(report_metrics(worker_metrics.queue, 0, worker, interval=10))
+    await asyncio.sleep(0)
+    # The last snapshot is sent when the worker stops
+    worker.command_latency["/list"].observe(0.03)
+    reporter.cancel()
+    await asyncio.gather(reporter, return_exceptions=True)
+    # Received by the thread
+    for _ in range(100):
+        merged = worker_metrics.merged(ingress)
+        if merged.command_latency["/list"].count == 2:
+            break
+        time.sleep(0.01)
+    assert merged.command_latency["/list"].count == 2
+    assert merged.command_errors["/list"] == 1
+    assert merged.updates_dropped["duplicate"] == 1
+    # Snapshots replace each other, they aren't added up
+    assert worker_metrics.merged(MetricsRegistry()).command_errors["/list"] == 1
+
+
+def test_observed_from_threads():
+    registry = MetricsRegistry()
+
+    def observe(thread):
+        for i in range(2000):
+            # A new series now and then, which changes the size of the dicts being read
+            registry.observe("mongo_latency", (f"collection{thread}", f"find{i % 50}"), 0.001)
+            registry.count("mongo_failures", (f"collection{thread}", "find"))
+
+    threads = [threading.Thread(target=observe, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        registry.render_prometheus()
+        pickle.loads(registry.snapshot())
+    for thread in threads:
+        thread.join()
+    assert sum(histogram.count for histogram in registry.mongo_latency.values()) == 8000
+    assert sum(registry.mongo_failures.values()) == 8000
+    assert pickle.loads(registry.snapshot()).mongo_failures == registry.mongo_failures
+
+
+def test_response_cache():
+    registry = MetricsRegistry()
+    cache = ResponseCache(max_size=2, max_chars=10, registry=registry)
+    assert cache.get("/list", ("/list", None, frozenset(), 1)) is None
+    cache.put(("/list", None, frozenset(), 1), ["a", "b"])
+    assert cache.get("/list", ("/list", None, frozenset(), 1)) == ["a", "b"]
+    # A write bumps the version, the old entry is just not asked for anymore
+    assert cache.get("/list", ("/list", None, frozenset(), 2)) is None
+
+    cache.put(("/list_by_tags", None, frozenset({"python"}), 1), [])
+    cache.put(("/list", None, frozenset(), 2), ["c"])
+    cache.put(("/list", None, frozenset(), 3), ["too long to keep"])
+    assert len(cache) == 2
+    assert cache.get("/list", ("/list", None, frozenset(), 1)) is None
+    assert registry.response_cache_requests == {("/list", "hit"): 1, ("/list", "miss"): 3}
+    assert 'bot_response_cache_requests_total{command="/list",result="hit"} 1' in registry.render_prometheus()
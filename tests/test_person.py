@@ -0,0 +1,23 @@
+from datetime import datetime
+from bson import ObjectId
+from app.models.person import Person, PersonRecord
+
+
+def test_record_has_all_person_fields():
+    # PersonRecord mirrors Person, new fields have to be added to both
+    assert set(PersonRecord.__slots__) == set(Person.model_fields)
+
+
+def test_record_from_db():
+    person_dict = {
+        "_id": ObjectId(),
+        "username": "test_user",
+        "tags": ["developer"],
+        "created_at": datetime(2024, 3, 29, 12),
+        "user_id": 42,
+    }
+    record = PersonRecord.from_db(person_dict)
+    assert record.to_person() == Person(**{**person_dict, "_id": str(person_dict["_id"])})
+
+    projected = PersonRecord.from_db({"username": "test_user"})
+    assert (projected.id, projected.tags, projected.created_at) == (None, [], None)
@@ -0,0 +1,30 @@
+import csv
+import json
+
+import pytest
+
+from app.services.roster_io import parse_roster
+
+
+def test_parse_csv():
+    data = "username,tags\n@alice,\"python, ml\"\nbob\n,orphan\n".encode()
+    assert list(parse_roster(data, "roster.csv")) == [("alice", ["python", "ml"]), ("bob", [])]
+
+
+def test_parse_json():
+    rows = [{"username": "@alice", "tags": ["python"]}, {"username": "bob", "tags": "a b,c"}, {"tags": ["x"]}]
+    assert list(parse_roster(json.dumps(rows).encode(), "roster.json")) == [
+        ("alice", ["python"]),
+        ("bob", ["a", "b", "c"]),
+    ]
+
+
+@pytest.mark.parametrize("rows", [{"username": "alice"}, ["alice"], [{"username": "alice", "tags": 5}]])
+def test_parse_json_malformed(rows):
+    with pytest.raises(ValueError):
+        list(parse_roster(json.dumps(rows).encode(), "roster.json"))
+
+
+def test_parse_csv_malformed():
+    with pytest.raises(csv.Error):
+        list(parse_roster(("alice," + "x" * 200_000).encode(), "roster.csv"))
@@ -0,0 +1,82 @@
+import random
+import string
+
+from app.services.search import SearchIndex, TrigramIndex, trigrams
+
+
+def brute_force(words, query, threshold=0.3):
+    """Similarity of the query to every word, the way the index is supposed to rank them"""
+    query_grams = trigrams(query)
+    matches = []
+    for word in words:
+        shared = len(query_grams & trigrams(word))
+        similarity = shared / (len(query_grams) + len(trigrams(word)) - shared)
+        if similarity >= threshold:
+            matches.append((word, similarity))
+    matches.sort(key=lambda match: (-match[1], match[0]))
+    return matches
+
+
+def test_trigrams():
+    assert trigrams("Bob") == {"  b", " bo", "bob", "ob ", "b  "}
+
+
+def test_search_matches_brute_force():
+    rng = random.Random(0)
+    words = {
+        "".join(rng.choice("abcdeklmnoprst_1") for _ in range(rng.randint(2, 14))) for _ in range(2000)
+    } | {"alice", "alicia", "bob", "python", "pytorch"}
+    index = TrigramIndex()
+    for word in words:
+        index.add(word)
+
+    queries = [rng.choice(sorted(words)) for _ in range(50)] + ["alise", "pyton", "a", "zzzz", ""]
+    for query in queries:
+        for threshold in (0.3, 0.5):
+            assert index.search(query, limit=len(words), threshold=threshold) == brute_force(words, query, threshold)
+        # The top ones only, possibly found at a higher threshold first
+        assert index.search(query, limit=3) == brute_force(words, query)[:3]
+
+
+def test_typos_and_removal():
+    index = TrigramIndex()
+    for word in ["alice", "alicia", "bob", "python", "pytorch"]:
+        index.add(word)
+
+    assert index.search("alise")[0][0] == "alice"
+    assert [word for word, _ in index.search("pyton")] == ["python", "pytorch"]
+    assert index.search("ALICE")[0] == ("alice", 1.0)
+
+    index.remove("alice")
+    index.remove("nobody")
+    assert "alice" not in index
+    assert [word for word, _ in index.search("alice")] == ["alicia"]
+    assert len(index) == 4
+    assert index.search("".join(random.choices(string.digits, k=8))) == []
+
+
+def test_write_through():
+    index = SearchIndex()
+    # Ignored until the index is built
+    index.add_person("ghost", ["python"])
+    assert index.version is None
+
+    index.load(["alice", "bob"], [("python", 2), ("design", 1)], version=5)
+    index.add_person("alicia", ["python", "golang"])
+    index.add_tags(["design", "design"])
+    index.remove_person("bob", ["python"])
+
+    assert index.version == 8
+    assert index.find_persons("@alice") == ["alice", "alicia"]
+    assert index.find_persons("bob") == []
+    assert index.find_tags("pyhton") == [("python", 2)]
+    assert index.find_tags("golang") == [("golang", 1)]
+    assert index.find_tags("desing") == [("design", 3)]
+
+    index.remove_person("alicia", ["golang"])
+    assert index.find_tags("golang") == []
+    assert index.suggest_tags(["pyton", "design", "qwerty"]) == {"pyton": "python"}
+
+    index.invalidate()
+    assert index.version is None
+    assert index.find_persons("alice") == []
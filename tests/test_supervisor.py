@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from aiogram.types import Update
+
+from app.services.supervisor import UpdateSupervisor, drain_tasks
+
+
+class UpdatesStandIn:
+    """Records the getUpdates calls confirming updates"""
+
+    def __init__(self):
+        self.offsets = []
+
+    async def get_updates(self, offset, limit, timeout):
+        self.offsets.append(offset)
+        return []
+
+
+async def handle(supervisor: UpdateSupervisor, update_id: int, seconds: float, handled: list):
+    async def handler(event, data):
+        await asyncio.sleep(seconds)
+        handled.append(event.update_id)
+
+    await supervisor(handler, Update(update_id=update_id), {})
+
+
+@pytest.mark.asyncio
+async def test_drain_tasks():
+    finishing = asyncio.create_task(asyncio.sleep(0.01))
+    hanging = asyncio.create_task(asyncio.sleep(10))
+    assert await drain_tasks([finishing, hanging], timeout=0.1) == {hanging}
+    assert finishing.done() and not finishing.cancelled()
+    assert hanging.cancelled()
+    assert await drain_tasks([], timeout=1) == set()
+
+
+@pytest.mark.asyncio
+async def test_supervisor_drains_and_confirms():
+    supervisor = UpdateSupervisor()
+    handled = []
+    tasks = [
+        asyncio.create_task(handle(supervisor, update_id, seconds, handled))
+        for update_id, seconds in [(10, 0.01), (11, 10), (12, 0.02), (13, 10)]
+    ]
+    await asyncio.sleep(0)
+    assert len(supervisor) == 4
+
+    assert await supervisor.drain(timeout=0.1) == 2
+    assert handled == [10, 12]
+    assert len(supervisor) == 0
+    assert all(task.done() for task in tasks)
+
+    # The first cancelled update comes again on the next start
+    bot = UpdatesStandIn()
+    await supervisor.confirm(bot)
+    assert bot.offsets == [11]
+
+
+@pytest.mark.asyncio
+async def test_supervisor_confirms_all_handled():
+    supervisor = UpdateSupervisor()
+    bot = UpdatesStandIn()
+    # Nothing taken, nothing to confirm
+    await supervisor.confirm(bot)
+    assert bot.offsets == []
+
+    handled = []
+    await asyncio.gather(*(handle(supervisor, update_id, 0, handled) for update_id in (5, 7, 6)))
+    assert await supervisor.drain(timeout=1) == 0
+    await supervisor.confirm(bot)
+    assert bot.offsets == [8]
@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+from app.services.metrics import MetricsRegistry
+from app.services.throttling import BucketStore, ThrottlingMiddleware
+
+
+def make_update(update_id: int, text: str, user_id: int = 1, chat_id: int = -100) -> Update:
+    user = User(id=user_id, is_bot=False, first_name="Test")
+    chat = Chat(id=chat_id, type="group")
+    message = Message(message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text=text)
+    return Update(update_id=update_id, message=message)
+
+
+async def feed(middleware: ThrottlingMiddleware, update: Update, handler=None):
+    async def default_handler(event, data):
+        return "handled"
+
+    data = {"event_from_user": update.message.from_user, "event_chat": update.message.chat}
+    return await middleware(handler or default_handler, update, data)
+
+
+def test_bucket_store():
+    buckets = BucketStore(rate=1, capacity=2, max_size=2)
+    assert buckets.take("a", now=0) and buckets.take("a", now=0)
+    assert not buckets.take("a", now=0)
+    assert buckets.take("a", now=1)
+
+    # The idle bucket is evicted first
+    buckets.take("b", now=1)
+    buckets.take("a", now=1)
+    buckets.take("c", now=1)
+    assert len(buckets) == 2
+    assert "b" not in buckets._buckets
+
+
+@pytest.mark.asyncio
+async def test_duplicates_and_rate_limits():
+    registry = MetricsRegistry()
+    middleware = ThrottlingMiddleware(user_rate=0.001, user_burst=2, chat_rate=0.001, chat_burst=3, registry=registry)
+
+    assert await feed(middleware, make_update(1, "/random")) == "handled"
+    # A polling retry of the same update
+    assert await feed(middleware, make_update(1, "/random")) is None
+    assert await feed(middleware, make_update(2, "/random")) == "handled"
+    assert await feed(middleware, make_update(3, "/random")) is None
+    # Someone else in the same chat still has their tokens, until the chat runs out
+    assert await feed(middleware, make_update(4, "/random", user_id=2)) == "handled"
+    assert await feed(middleware, make_update(5, "/random", user_id=3)) is None
+    assert dict(registry.updates_dropped) == {"duplicate": 1, "user_rate": 1, "chat_rate": 1}
+
+
+@pytest.mark.asyncio
+async def test_list_is_coalesced():
+    registry = MetricsRegistry()
+    middleware = ThrottlingMiddleware(registry=registry)
+    calls = []
+
+    async def slow_handler(event, data):
+        calls.append(event.update_id)
+        await asyncio.sleep(0.01)
+        return "handled"
+
+    results = await asyncio.gather(
+        feed(middleware, make_update(1, "/list"), slow_handler),
+        feed(middleware, make_update(2, "/list@my_bot", user_id=2), slow_handler),
+        feed(middleware, make_update(3, "/list_by_tags python", user_id=3), slow_handler),
+    )
+    assert results == ["handled", None, "handled"]
+    # Within the window after the answer too, but not in another chat
+    assert await feed(middleware, make_update(4, "/list", user_id=4), slow_handler) is None
+    assert await feed(middleware, make_update(5, "/list", chat_id=-200), slow_handler) == "handled"
+    assert calls == [1, 3, 5]
+    assert registry.updates_dropped["coalesced"] == 2
+
+
+@pytest.mark.asyncio
+async def test_dropped_callback_query_is_answered():
+    class FakeBot:
+        def __init__(self):
+            self.answered = []
+
+        async def answer_callback_query(self, callback_query_id):
+            self.answered.append(callback_query_id)
+
+    middleware = ThrottlingMiddleware(user_rate=0.001, user_burst=1, registry=MetricsRegistry())
+    user = User(id=1, is_bot=False, first_name="Test")
+    bot = FakeBot()
+
+    async def handler(event, data):
+        return "handled"
+
+    results = []
+    for update_id in (1, 1, 2):
+        query = CallbackQuery(id=f"q{update_id}", from_user=user, chat_instance="1", data="next")
+        results.append(await middleware(handler, Update(update_id=update_id, callback_query=query),
+                                        {"event_from_user": user, "bot": bot}))
+    # The duplicate and the throttled press get an empty answer, the handled one answers itself
+    assert results == ["handled", None, None]
+    assert bot.answered == ["q1", "q2"]
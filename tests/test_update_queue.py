@@ -0,0 +1,112 @@
+import asyncio
+import random
+
+import pytest
+from aiogram.types import Chat, Message, Update, User
+
+from app.services.update_queue import UpdateIngressMiddleware, UpdateWorker, chat_key
+
+
+class QueueStandIn:
+    """The update queue methods of DatabaseService over a dict"""
+
+    def __init__(self, items):
+        self.items = {item["_id"]: item for item in items}
+        self.leased = set()
+
+    async def release_updates(self, worker, workers):
+        self.leased.clear()
+        return 0
+
+    async def lease_updates(self, worker, workers, limit, lease_seconds):
+        available = [
+            item for update_id, item in sorted(self.items.items())
+            if item["chat_key"] % workers == worker and update_id not in self.leased
+        ][:limit]
+        self.leased.update(item["_id"] for item in available)
+        return available
+
+    async def ack_update(self, update_id):
+        del self.items[update_id]
+
+    async def push_update(self, update_id, chat_key, update):
+        # A slow insert must not let the next update overtake this one
+        await asyncio.sleep(random.random() / 100)
+        self.items[update_id] = {"_id": update_id, "chat_key": chat_key, "update": update}
+        return True
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.handled = []
+
+    async def feed_update(self, bot, update):
+        # Later updates of a chat finishing first would show up out of order
+        await asyncio.sleep(random.random() / 100)
+        self.handled.append((update.message.chat.id, update.update_id))
+
+
+def make_item(update_id: int, chat_id: int) -> dict:
+    message = {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "group"}, "text": "/random"}
+    return {"_id": update_id, "chat_key": abs(chat_id), "update": {"update_id": update_id, "message": message}}
+
+
+def test_chat_key():
+    user = User(id=1, is_bot=False, first_name="A")
+    assert chat_key({"event_chat": Chat(id=-100, type="group"), "event_from_user": user}) == 100
+    assert chat_key({"event_from_user": user}) == 1
+    assert chat_key({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_keeps_chat_order():
+    chats = [-100, -101, -102, -103]
+    queue = QueueStandIn([make_item(update_id, random.choice(chats)) for update_id in range(1, 201)])
+    dispatcher = RecordingDispatcher()
+    worker = UpdateWorker(dispatcher, None, queue, worker=1, workers=2, max_concurrent=4, poll_interval=0.01)
+
+    task = asyncio.create_task(worker.run())
+    while any(item["chat_key"] % 2 == 1 for item in queue.items.values()):
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    # Only the worker's own chats, each one in update order
+    assert {chat_id for chat_id, _ in dispatcher.handled} == {-101, -103}
+    for chat_id in (-101, -103):
+        update_ids = [update_id for chat, update_id in dispatcher.handled if chat == chat_id]
+        assert update_ids == sorted(update_ids)
+    assert all(item["chat_key"] % 2 == 0 for item in queue.items.values())
+
+
+@pytest.mark.asyncio
+async def test_worker_stop_drains_taken_updates():
+    queue = QueueStandIn([make_item(update_id, -100 - update_id) for update_id in range(1, 9)])
+    dispatcher = RecordingDispatcher()
+    worker = UpdateWorker(dispatcher, None, queue, worker=0, workers=1, max_concurrent=4, poll_interval=10)
+
+    task = asyncio.create_task(worker.run())
+    while not queue.leased:
+        await asyncio.sleep(0)
+    worker.stop()
+    # Stopping doesn't wait for the poll interval
+    await asyncio.wait_for(task, 1)
+
+    # Every update taken was handled and acknowledged, the rest stay queued
+    assert sorted(update_id for _, update_id in dispatcher.handled) == sorted(set(range(1, 9)) - set(queue.items))
+    assert dispatcher.handled
+    assert not queue.leased & set(queue.items)
+
+
+@pytest.mark.asyncio
+async def test_ingress_queues_in_arrival_order():
+    queue = QueueStandIn([])
+    middleware = UpdateIngressMiddleware()
+    chat = Chat(id=-100, type="group")
+
+    async def ingest(update_id):
+        message = Message(message_id=update_id, date=0, chat=chat, text="/random")
+        await middleware(None, Update(update_id=update_id, message=message), {"db_service": queue, "event_chat": chat})
+
+    await asyncio.gather(*(ingest(update_id) for update_id in range(1, 21)))
+    assert list(queue.items) == list(range(1, 21))
@@ -0,0 +1,29 @@
+import pytest
+from app.utils import chunk_lines, normalize_tag, normalize_tags
+
+
+async def agen(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.asyncio
+async def test_chunk_lines():
+    lines = [f"line {i:03d}\n" for i in range(100)]  # 9 chars each
+    chunks = [chunk async for chunk in chunk_lines(agen(lines), header="Header\n", limit=100)]
+
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[0].startswith("Header\n")
+    assert "".join(chunks) == "Header\n" + "".join(lines)
+
+
+@pytest.mark.asyncio
+async def test_chunk_lines_empty():
+    assert [chunk async for chunk in chunk_lines(agen([]), header="Header\n")] == []
+
+
+def test_normalize_tags():
+    assert normalize_tag("#Python") == "python"
+    assert normalize_tag("  Machine   Learning ") == "machine-learning"
+    assert normalize_tag("ＰＹＴＨＯＮ") == "python"
+    assert normalize_tags(["Python", "#python", "ml", "#", "ML"]) == ["python", "ml"]